@@ -5,6 +5,8 @@ from time import strftime, localtime, time
 from data.loader import FileIO
 from os.path import abspath
 from util.evaluation import ranking_evaluation
+from util.early_stop import EarlyStopping, Snapshot
+from util.conf import OptionConf
 import sys
 
 
@@ -21,6 +23,15 @@ class GraphRecommender(Recommender):
         self.topN = [int(num) for num in top]
         self.max_N = max(self.topN)
         self.msg = f'Emb size: {self.embedding_size}\n'
+        # early_stop=-patience N [-min_delta D] [-metric NDCG]: end training once the validation metric stops improving
+        self.early_stop = None
+        if conf.contain('early_stop'):
+            args = OptionConf(conf['early_stop'])
+            min_delta = float(args['-min_delta']) if args.contain('-min_delta') else 0.
+            metric = args['-metric'] if args.contain('-metric') else 'NDCG'
+            self.early_stop = EarlyStopping(int(args['-patience']), min_delta, metric)
+        # buffers the best embeddings are copied into in place by save()
+        self.best_snapshot = Snapshot()
 
 
     def print_model_info(self):
@@ -157,12 +168,14 @@ class GraphRecommender(Recommender):
         print('Evaluating the model...')
         rec_list = self.test('valid', model_type)
         measure = ranking_evaluation(self.data.valid_set, rec_list, [self.max_N])
+        performance = {}
+        for m in measure[1:]:
+            k, v = m.strip().split(':')
+            performance[k] = float(v)
+        if self.early_stop is not None and model_type == 'global_model':
+            self.early_stop.update(performance, epoch)
         if len(self.bestPerformance) > 0:
             count = 0
-            performance = {}
-            for m in measure[1:]:
-                k, v = m.strip().split(':')
-                performance[k] = float(v)
             for k in self.bestPerformance[1]:
                 if self.bestPerformance[1][k] > performance[k]:
                     count += 1
@@ -175,10 +188,6 @@ class GraphRecommender(Recommender):
                 self.best_epoch = epoch
         else:
             self.bestPerformance.append(epoch + 1)
-            performance = {}
-            for m in measure[1:]:
-                k, v = m.strip().split(':')
-                performance[k] = float(v)
             self.bestPerformance.append(performance)
             self.save()
             self.best_epoch = epoch
@@ -194,5 +203,10 @@ class GraphRecommender(Recommender):
         bp += 'NDCG' + ':' + str(self.bestPerformance[1]['NDCG'])
         print('*Best Performance* ')
         print('Epoch:', str(self.bestPerformance[0]) + ',', bp)
+        if self.stop_training():
+            print('Early stopping: no %s improvement since epoch %d' % (self.early_stop.metric, self.early_stop.best_epoch + 1))
         print('-' * 120)
         return measure
+
+    def stop_training(self):
+        return self.early_stop is not None and self.early_stop.should_stop
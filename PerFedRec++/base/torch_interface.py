@@ -9,4 +9,15 @@ class TorchGraphInterface(object):
         coo = X.tocoo()
         i = torch.LongTensor([coo.row, coo.col])
         v = torch.from_numpy(coo.data).float()
-        return torch.sparse.FloatTensor(i, v, coo.shape)
\ No newline at end of file
+        return torch.sparse.FloatTensor(i, v, coo.shape)
+
+    @staticmethod
+    def sparse_block_diag(mats):
+        """Merge square sparse tensors into one block-diagonal sparse tensor."""
+        indices, values, offset = [], [], 0
+        for mat in mats:
+            mat = mat.coalesce()
+            indices.append(mat.indices() + offset)
+            values.append(mat.values())
+            offset += mat.shape[0]
+        return torch.sparse_coo_tensor(torch.cat(indices, 1), torch.cat(values), (offset, offset)).coalesce()
@@ -1,6 +1,7 @@
 import numpy as np
 import random
 import scipy.sparse as sp
+import torch
 from math import floor
 
 class GraphAugmentor(object):
@@ -8,12 +9,12 @@ class GraphAugmentor(object):
         pass
 
     @staticmethod
-    def node_dropout(sp_adj, drop_rate):
-        """Input: a sparse adjacency matrix and a dropout rate."""
+    def node_dropout(sp_adj, drop_rate, rng=random):
+        """Input: a sparse adjacency matrix, a dropout rate and the random.Random to draw from."""
         adj_shape = sp_adj.get_shape()
         row_idx, col_idx = sp_adj.nonzero()
-        drop_user_idx = random.sample(range(adj_shape[0]), int(adj_shape[0] * drop_rate))
-        drop_item_idx = random.sample(range(adj_shape[1]), int(adj_shape[1] * drop_rate))
+        drop_user_idx = rng.sample(range(adj_shape[0]), int(adj_shape[0] * drop_rate))
+        drop_item_idx = rng.sample(range(adj_shape[1]), int(adj_shape[1] * drop_rate))
         indicator_user = np.ones(adj_shape[0], dtype=np.float32)
         indicator_item = np.ones(adj_shape[1], dtype=np.float32)
         indicator_user[drop_user_idx] = 0.
@@ -47,12 +48,12 @@ class GraphAugmentor(object):
 
 
     @staticmethod
-    def edge_dropout(sp_adj, drop_rate):
-        """Input: a sparse user-item adjacency matrix and a dropout rate."""
+    def edge_dropout(sp_adj, drop_rate, rng=random):
+        """Input: a sparse user-item adjacency matrix, a dropout rate and the random.Random to draw from."""
         adj_shape = sp_adj.get_shape()
         edge_count = sp_adj.count_nonzero()
         row_idx, col_idx = sp_adj.nonzero()
-        keep_idx = random.sample(range(edge_count), int(edge_count * (1 - drop_rate)))
+        keep_idx = rng.sample(range(edge_count), int(edge_count * (1 - drop_rate)))
         user_np = np.array(row_idx)[keep_idx]
         item_np = np.array(col_idx)[keep_idx]
         edges = np.ones_like(user_np, dtype=np.float32)
@@ -101,6 +102,44 @@ class GraphAugmentor(object):
 
 
 
+class TorchGraphAugmentor(object):
+    """Edge and node dropout computed on the device. The edge list of the interaction matrix is kept
+    resident in the order of the normalized adjacency, so a view only masks the edge values and
+    renormalizes them with scatter-add degrees."""
+    def __init__(self, interaction_mat, device=None):
+        coo = interaction_mat.tocoo()
+        self.user_num, self.item_num = coo.shape
+        self.n_nodes = self.user_num + self.item_num
+        user = torch.from_numpy(coo.row).long()
+        item = torch.from_numpy(coo.col).long() + self.user_num
+        edge_id = torch.arange(len(user))
+        rows, cols = torch.cat([user, item]), torch.cat([item, user])
+        order = torch.argsort(rows * self.n_nodes + cols)
+        self.indices = torch.stack([rows[order], cols[order]]).to(device)
+        self.edge_of_entry = torch.cat([edge_id, edge_id])[order].to(device)
+        self.user = user.to(device)
+        self.item = item.to(device)
+        self.ratings = torch.from_numpy(coo.data).float().to(device)
+
+    def edge_dropout(self, drop_rate, generator=None):
+        keep = torch.bernoulli(torch.full_like(self.ratings, 1 - drop_rate), generator=generator)
+        return self.laplacian(keep)
+
+    def node_dropout(self, drop_rate, generator=None):
+        keep_node = torch.bernoulli(torch.full((self.n_nodes,), 1 - drop_rate, device=self.ratings.device), generator=generator)
+        return self.laplacian(keep_node[self.user] * keep_node[self.item])
+
+    def laplacian(self, keep):
+        """Normalized user-item adjacency of the kept edges (keep holds one 0/1 value per edge)."""
+        values = self.ratings * keep
+        degree = torch.zeros(self.n_nodes, device=values.device)
+        degree.scatter_add_(0, self.user, values).scatter_add_(0, self.item, values)
+        d_inv = degree.pow(-0.5)
+        d_inv[torch.isinf(d_inv)] = 0.
+        values = (values * d_inv[self.user] * d_inv[self.item])[self.edge_of_entry]
+        kept = keep[self.edge_of_entry] > 0
+        return torch.sparse_coo_tensor(self.indices[:, kept], values[kept], (self.n_nodes, self.n_nodes), is_coalesced=True)
+
 class SequenceAugmentor(object):
     def __init__(self):
         pass
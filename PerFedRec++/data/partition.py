@@ -0,0 +1,75 @@
+import numpy as np
+import scipy.sparse as sp
+from data.graph import Graph
+
+
+class GraphPartitioner(object):
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def label_propagation(adj_mat, n_parts, n_iter=10, imbalance=0.05, seed=None):
+        """Input: a symmetric sparse adjacency matrix and the number of parts.
+        Balanced label propagation: every node moves to the part most of its neighbours live in,
+        as long as that part stays under its capacity. Returns the part id of every node."""
+        rng = np.random.default_rng(seed)
+        adj_mat = sp.csr_matrix(adj_mat)
+        n_nodes = adj_mat.shape[0]
+        capacity = int(np.ceil(n_nodes / n_parts * (1 + imbalance)))
+        parts = rng.permutation(n_nodes) % n_parts
+        for _ in range(n_iter):
+            one_hot = sp.csr_matrix((np.ones(n_nodes, dtype=np.float32), (np.arange(n_nodes), parts)), shape=(n_nodes, n_parts))
+            neighbour_count = np.asarray((adj_mat.dot(one_hot)).todense())
+            target = neighbour_count.argmax(axis=1)
+            gain = neighbour_count[np.arange(n_nodes), target] - neighbour_count[np.arange(n_nodes), parts]
+            movers = np.where((target != parts) & (gain > 0))[0]
+            if len(movers) == 0:
+                break
+            # accept the best movers of every target part until it is full
+            order = np.lexsort((-gain[movers], target[movers]))
+            movers = movers[order]
+            mover_target = target[movers]
+            group_start = np.searchsorted(mover_target, mover_target, side='left')
+            rank = np.arange(len(movers)) - group_start
+            room = capacity - np.bincount(parts, minlength=n_parts)
+            accepted = movers[rank < room[mover_target]]
+            if len(accepted) == 0:
+                break
+            parts[accepted] = target[accepted]
+        return parts
+
+    @staticmethod
+    def edge_cut(adj_mat, parts):
+        """Fraction of the edges whose end points fall into different parts."""
+        coo = sp.coo_matrix(adj_mat)
+        if coo.nnz == 0:
+            return 0.
+        return float(np.mean(parts[coo.row] != parts[coo.col]))
+
+
+class PartitionedGraph(object):
+    """Cluster-GCN style view of the user-item graph: the nodes are split into balanced parts once and
+    every training step runs on the normalized subgraph induced by one part or a random union of parts."""
+    def __init__(self, data, n_parts, n_iter=10, seed=None):
+        self.data = data
+        self.n_parts = n_parts
+        self.parts = GraphPartitioner.label_propagation(data.ui_adj, n_parts, n_iter=n_iter, seed=seed)
+        self.edge_cut = GraphPartitioner.edge_cut(data.ui_adj, self.parts)
+        self.part_nodes = [np.where(self.parts == p)[0] for p in range(n_parts)]
+
+    def subgraph(self, part_ids):
+        """Return the node ids of the selected parts, how many of them are users, their normalized induced
+        adjacency and the user-item interactions inside the subgraph (in local node ids)."""
+        nodes = np.sort(np.concatenate([self.part_nodes[p] for p in part_ids]))
+        sub_adj = self.data.ui_adj[nodes][:, nodes]
+        norm_sub_adj = Graph.normalize_graph_mat(sub_adj)
+        n_users = np.searchsorted(nodes, self.data.user_num)
+        # users come before items in the node order, so the upper triangle holds every (user, item) edge once
+        inter = sp.triu(sub_adj, k=1).tocoo()
+        edges = np.stack([inter.row, inter.col], axis=1)
+        return nodes, n_users, norm_sub_adj, edges
+
+    def next_subgraph(self, parts_per_batch=1, shuffle=True):
+        order = np.random.permutation(self.n_parts) if shuffle else np.arange(self.n_parts)
+        for start in range(0, self.n_parts, parts_per_batch):
+            yield self.subgraph(order[start:start + parts_per_batch])
@@ -47,6 +47,8 @@ if __name__ == '__main__':
     parser.add_argument('--clip_value', type=str, default='0.5')
     parser.add_argument('--pretrain_noise', type=str, default='0.1')
     parser.add_argument('--pretrain_nclient', type=str, default='256')
+    parser.add_argument('--resume', action='store_true', help='continue from the last checkpoint')
+    parser.add_argument('--checkpoint_every', type=str, default=None, help='checkpoint every N rounds (default 10)')
 
     args = parser.parse_args()
 
@@ -77,6 +79,10 @@ if __name__ == '__main__':
     conf.__setitem__('pretrain_noise', args.pretrain_noise )
     conf.__setitem__('pretrain_nclient', args.pretrain_nclient )
     conf.__setitem__('pretrain_epoch', args.pretrain_epoch )
+    if args.resume:
+        conf.__setitem__('resume', '1')
+    if not conf.contain('checkpoint') and (args.resume or args.checkpoint_every is not None):
+        conf.__setitem__('checkpoint', '-dir ./checkpoints/ -every ' + (args.checkpoint_every or '10'))
 
     rec = SELFRec(conf)
     rec.execute()
@@ -7,34 +7,44 @@ import random
 import copy
 from base.torch_interface import TorchGraphInterface
 from util.conf import OptionConf
+from util.history import HistoricalEmbedding, batch_nodes, propagate_batch
+from util.executor import ClientPool
+from util.noise import LDPNoise
+from util.federated import RowDelta, StreamingFedAvg, BatchedClients
 from data.augmentor import GraphAugmentor
 
 
-def FedAvg(w):
-    w_avg = copy.deepcopy(w[0])
-    for k in w_avg.keys():
-        for i in range(1, len(w)):
-            w_avg[k] += w[i][k]
-        w_avg[k] = torch.div(w_avg[k], len(w))
-    return w_avg
-
 class FedGNN(GraphRecommender):
     def __init__(self, conf, training_set, test_set,valid_set):
         super(FedGNN, self).__init__(conf, training_set, test_set,valid_set)
         args = OptionConf(self.config['FedGNN'])
         self.n_layers = int(args['-n_layer'])
+        # historical embeddings: -history R rebuilds the per-layer store at the start of every R-th round
+        self.history_rounds = int(args['-history']) if args.contain('-history') else 0
+        # simulate the selected clients in chunks of this size in one vectorized pass, 0 keeps the client loop
+        self.batched_clients = int(args['-batched_clients']) if args.contain('-batched_clients') else 0
+        # train the selected clients in this many CPU worker processes, 0 keeps them in this process
+        self.workers = int(args['-workers']) if args.contain('-workers') else 0
+        # LDP mechanism of the uploaded item table: laplace or gaussian
+        self.ldp = args['-ldp'] if args.contain('-ldp') else 'laplace'
         self.model = FedGNN_LGCN_Encoder(self.data, self.emb_size, self.n_layers)
         self.msg = conf['training.set']
 
     def train(self):
         model = self.model.cuda()
-        model_para_list = []
         N_client = 256
         self.N_client = N_client
         loc, scale = 0., 0.1
         delta = 0.3
         optimizer = torch.optim.Adam(model.parameters(), lr=self.lRate*N_client)
+        history = HistoricalEmbedding() if self.history_rounds > 0 else None
+        simulator = BatchedClients(model, optimizer, self.reg, self.batch_size, self.batched_clients) if self.batched_clients > 0 else None
+        ldp = LDPNoise(loc, scale, N_client, self.ldp, device=model.embedding_dict['item_emb'].device, seed=int(np.random.randint(2 ** 31)))
+        pool = ClientPool(model, optimizer, self.data, self.reg, self.batch_size, self.workers,
+                          seed=int(np.random.randint(2 ** 31))) if self.workers > 0 else None
         for epoch in range(self.maxEpoch):
+            if history is not None and epoch % self.history_rounds == 0:
+                history.expire()
             losses = []
             if epoch >= 0:
                 user_list = list(self.data.user.keys())
@@ -44,43 +54,58 @@ class FedGNN(GraphRecommender):
                 select_user_list_num = [self.data.user[_] for _ in select_user_list]
                 not_select_user_list_num = [self.data.user[_] for _ in not_select_user_list]
 
-            for n, batch in enumerate(next_batch_pairwise_fl_pse(self.data, self.batch_size, select_user_list)):
-                model_ini = copy.deepcopy(model.state_dict())
-                user_idx, pos_idx, neg_idx = batch
-                rec_user_emb, rec_item_emb = model(perturbed=False)
-                user_emb, pos_item_emb, neg_item_emb = rec_user_emb[user_idx], rec_item_emb[pos_idx], rec_item_emb[neg_idx]
-                batch_loss = bpr_loss(user_emb, pos_item_emb, neg_item_emb) + l2_reg_loss(self.reg, user_emb,pos_item_emb,neg_item_emb)/self.batch_size
-                optimizer.zero_grad()
-                batch_loss.backward()
-                optimizer.step()
-                if n % 100==0 and n>0:
-                    print('training:', epoch + 1, 'batch', n, 'batch_loss:', batch_loss.item())
-                losses.append(batch_loss.item())
-                model_aft = copy.deepcopy(model.state_dict())
-                model_para_list += [model_aft]
-                model.load_state_dict(model_ini)
+            original_params = copy.deepcopy(model.state_dict())
+            aggregator = StreamingFedAvg(original_params)
+            if pool is not None:
+                _, client_losses, client_updates = pool.step(epoch, select_user_list)
+                losses += client_losses
+                for update in client_updates:
+                    aggregator.add(update)
+            elif simulator is not None:
+                batches = list(next_batch_pairwise_fl_pse(self.data, self.batch_size, select_user_list))
+                client_losses, client_updates = simulator.step(batches)
+                losses += client_losses
+                for update in client_updates:
+                    aggregator.add(update)
+            else:
+                for n, batch in enumerate(next_batch_pairwise_fl_pse(self.data, self.batch_size, select_user_list)):
+                    user_idx, pos_idx, neg_idx = batch
+                    if history is not None:
+                        user_emb, pos_item_emb, neg_item_emb = model.forward_batch(history, user_idx, pos_idx, neg_idx)
+                    else:
+                        rec_user_emb, rec_item_emb = model(perturbed=False)
+                        user_emb, pos_item_emb, neg_item_emb = rec_user_emb[user_idx], rec_item_emb[pos_idx], rec_item_emb[neg_idx]
+                    batch_loss = bpr_loss(user_emb, pos_item_emb, neg_item_emb) + l2_reg_loss(self.reg, user_emb,pos_item_emb,neg_item_emb)/self.batch_size
+                    optimizer.zero_grad()
+                    batch_loss.backward()
+                    optimizer.step()
+                    if n % 100==0 and n>0:
+                        print('training:', epoch + 1, 'batch', n, 'batch_loss:', batch_loss.item())
+                    losses.append(batch_loss.item())
+                    aggregator.add(RowDelta.capture(model, original_params))
   
             print('Avg Loss:', sum(losses)/len(losses))
-            w_ = FedAvg(model_para_list)
-            model.load_state_dict(w_)
-            model_para_list = []
+            model.load_state_dict(aggregator.result())
             # LDP
             add_noise = True
             if add_noise:
-                i_random_noise = torch.tensor(np.random.laplace(loc=loc, scale=scale, size=(N_client,rec_item_emb.shape[0],rec_item_emb.shape[1])) )
-                i_random_noise = torch.mean(i_random_noise, dim=0).float().to('cuda')
+                i_random_noise = ldp.mean((self.data.item_num, self.emb_size))
                 model.add_noise_(i_random_noise)
 
             with torch.no_grad():
                 self.user_emb, self.item_emb = model.get_emb()
             if epoch % 5 == 0:
                 self.fast_evaluation(epoch)
+            if self.stop_training():
+                break
 
+        if pool is not None:
+            pool.close()
         self.user_emb, self.item_emb = self.best_user_emb, self.best_item_emb
 
     def save(self):
         with torch.no_grad():
-            self.best_user_emb, self.best_item_emb = copy.deepcopy(self.model.get_emb())
+            self.best_user_emb, self.best_item_emb = self.best_snapshot.take(*self.model.get_emb())
 
     def get_client_mat(self, drop_client_list):
         dropped_mat = None
@@ -122,6 +147,25 @@ class FedGNN_LGCN_Encoder(nn.Module):
     def add_noise_(self, noise):
         self.embedding_dict['item_emb'].data = self.embedding_dict['item_emb'].data + noise
 
+    def propagate(self, ego_embeddings):
+        """Unperturbed propagation of a stack of ego embeddings; every feature column is propagated on its own."""
+        all_embeddings = []
+        for k in range(self.layers):
+            ego_embeddings = torch.sparse.mm(self.sparse_norm_adj, ego_embeddings)
+            all_embeddings.append(ego_embeddings)
+        return torch.mean(torch.stack(all_embeddings, dim=1), dim=1)
+
+    def forward_batch(self, history, user_idx, *item_idx):
+        """Unperturbed embeddings of the batch entries, propagated exactly over their one-hop
+        neighbourhood and read from `history` beyond it."""
+        ego_embeddings = torch.cat([self.embedding_dict['user_emb'], self.embedding_dict['item_emb']], 0)
+        if history.stale():
+            history.rebuild(ego_embeddings, self.sparse_norm_adj, self.layers)
+        nodes, positions = batch_nodes(self.data.user_num, ego_embeddings.device, user_idx, *item_idx)
+        all_embeddings = propagate_batch(ego_embeddings, self.sparse_norm_adj, nodes, self.layers, history)[1:]
+        all_embeddings = torch.mean(torch.stack(all_embeddings, dim=1), dim=1)
+        return [all_embeddings[p] for p in positions]
+
     def forward(self, perturbed=False, perturbed_adj=None):
         self.eps=0.1
 
@@ -5,29 +5,42 @@ from util.sampler import *
 from util.loss_torch import bpr_loss,l2_reg_loss
 import random
 import copy
+from util.executor import ClientPool
+from util.noise import LDPNoise
+from util.federated import RowDelta, StreamingFedAvg, BatchedClients
+from util.conf import OptionConf
+from util.optim import lookup, make_optimizer
 
-def FedAvg(w):
-    w_avg = copy.deepcopy(w[0])
-    for k in w_avg.keys():
-        for i in range(1, len(w)):
-            w_avg[k] += w[i][k]
-        w_avg[k] = torch.div(w_avg[k], len(w))
-    return w_avg
 
 class FedMF(GraphRecommender):
     def __init__(self, conf, training_set, test_set,valid_set):
         super(FedMF, self).__init__(conf, training_set, test_set,valid_set)
         self.model = Matrix_Factorization(self.data, self.emb_size)
+        args = OptionConf(self.config['FedMF']) if self.config.contain('FedMF') else None
+        # simulate the selected clients in chunks of this size in one vectorized pass, 0 keeps the client loop
+        self.batched_clients = int(args['-batched_clients']) if args is not None and args.contain('-batched_clients') else 0
+        # train the selected clients in this many CPU worker processes, 0 keeps them in this process
+        self.workers = int(args['-workers']) if args is not None and args.contain('-workers') else 0
+        # LDP mechanism of the uploaded item table: laplace or gaussian
+        self.ldp = args['-ldp'] if args is not None and args.contain('-ldp') else 'laplace'
+        # adam, or lazy_adam / lazy_adagrad to update only the rows of the batch through sparse gradients
+        self.optimizer = self.config['optimizer'] if self.config.contain('optimizer') else 'adam'
+        if self.optimizer != 'adam' and (self.batched_clients > 0 or self.workers > 0):
+            raise ValueError('%s only runs with the sequential client loop' % self.optimizer)
         self.msg = conf['training.set']
 
     def train(self):
         model = self.model.cuda()
-        model_para_list = []
         N_client = 256
         self.N_client = N_client
         loc, scale = 0., 0.2
         delta = 0.3
-        optimizer = torch.optim.Adam(model.parameters(), lr=self.lRate*N_client)#
+        optimizer = make_optimizer(self.optimizer, model.parameters(), self.lRate*N_client)
+        sparse = self.optimizer != 'adam'
+        simulator = BatchedClients(model, optimizer, self.reg, self.batch_size, self.batched_clients) if self.batched_clients > 0 else None
+        ldp = LDPNoise(loc, scale, N_client, self.ldp, device=model.embedding_dict['item_emb'].device, seed=int(np.random.randint(2 ** 31)))
+        pool = ClientPool(model, optimizer, self.data, self.reg, self.batch_size, self.workers,
+                          seed=int(np.random.randint(2 ** 31))) if self.workers > 0 else None
         for epoch in range(self.maxEpoch):
             if epoch >= 0:
                 user_list = list(self.data.user.keys())
@@ -37,41 +50,49 @@ class FedMF(GraphRecommender):
                 select_user_list_num = [self.data.user[_] for _ in select_user_list]
                 not_select_user_list_num = [self.data.user[_] for _ in not_select_user_list]
 
-            for n, batch in enumerate(next_batch_pairwise_fl_pse(self.data, self.batch_size, select_user_list)):
-                model_ini = copy.deepcopy(model.state_dict())
-                user_idx, pos_idx, neg_idx = batch
-                rec_user_emb, rec_item_emb = model()
-                user_emb, pos_item_emb, neg_item_emb = rec_user_emb[user_idx], rec_item_emb[pos_idx], rec_item_emb[neg_idx]
-                batch_loss = bpr_loss(user_emb, pos_item_emb, neg_item_emb) + l2_reg_loss(self.reg, user_emb,pos_item_emb,neg_item_emb)/self.batch_size
-                optimizer.zero_grad()
-                batch_loss.backward()
-                optimizer.step()
-                if n % 100==0 and n>0:
-                    print('training:', epoch + 1, 'batch', n, 'batch_loss:', batch_loss.item())
-                model_aft = copy.deepcopy(model.state_dict())
-                model_para_list += [model_aft]
-                model.load_state_dict(model_ini)
-
-            w_ = FedAvg(model_para_list)
-            model.load_state_dict(w_)
-            model_para_list = []
+            original_params = copy.deepcopy(model.state_dict())
+            aggregator = StreamingFedAvg(original_params)
+            if pool is not None:
+                _, _, client_updates = pool.step(epoch, select_user_list)
+                for update in client_updates:
+                    aggregator.add(update)
+            elif simulator is not None:
+                _, client_updates = simulator.step(list(next_batch_pairwise_fl_pse(self.data, self.batch_size, select_user_list)))
+                for update in client_updates:
+                    aggregator.add(update)
+            else:
+                for n, batch in enumerate(next_batch_pairwise_fl_pse(self.data, self.batch_size, select_user_list)):
+                    user_idx, pos_idx, neg_idx = batch
+                    user_emb, pos_item_emb, neg_item_emb = model.lookup(user_idx, pos_idx, neg_idx, sparse)
+                    batch_loss = bpr_loss(user_emb, pos_item_emb, neg_item_emb) + l2_reg_loss(self.reg, user_emb,pos_item_emb,neg_item_emb)/self.batch_size
+                    optimizer.zero_grad()
+                    batch_loss.backward()
+                    optimizer.step()
+                    if n % 100==0 and n>0:
+                        print('training:', epoch + 1, 'batch', n, 'batch_loss:', batch_loss.item())
+                    aggregator.add(RowDelta.capture(model, original_params))
+
+            model.load_state_dict(aggregator.result())
             # LDP
             add_noise = True
             if add_noise:
-                i_random_noise = torch.tensor(np.random.laplace(loc=loc, scale=scale, size=(N_client,rec_item_emb.shape[0],rec_item_emb.shape[1])) )
-                i_random_noise = torch.mean(i_random_noise, dim=0).float().to('cuda')
+                i_random_noise = ldp.mean((self.data.item_num, self.emb_size))
                 model.add_noise_(i_random_noise)
             
             with torch.no_grad():
                 self.user_emb, self.item_emb = self.model()
             if epoch % 5 == 0:
                 self.fast_evaluation(epoch)
+            if self.stop_training():
+                break
 
+        if pool is not None:
+            pool.close()
         self.user_emb, self.item_emb = self.best_user_emb, self.best_item_emb
 
     def save(self):
         with torch.no_grad():
-            self.best_user_emb, self.best_item_emb = self.model.forward()
+            self.best_user_emb, self.best_item_emb = self.best_snapshot.take(*self.model.forward())
 
     def predict(self, u):
         with torch.no_grad():
@@ -98,7 +119,15 @@ class Matrix_Factorization(nn.Module):
     def add_noise_(self, noise):
         self.embedding_dict['item_emb'].data = self.embedding_dict['item_emb'].data + noise
     
+    def propagate(self, ego_embeddings):
+        return ego_embeddings
+
     def forward(self):
         return self.embedding_dict['user_emb'], self.embedding_dict['item_emb']
 
+    def lookup(self, user_idx, pos_idx, neg_idx, sparse=False):
+        """Embeddings of a batch; sparse=True gives row-sparse gradients on the tables."""
+        user_emb, item_emb = self.embedding_dict['user_emb'], self.embedding_dict['item_emb']
+        return lookup(user_emb, user_idx, sparse), lookup(item_emb, pos_idx, sparse), lookup(item_emb, neg_idx, sparse)
+
 
@@ -2,9 +2,12 @@ import torch
 import torch.nn as nn
 from base.graph_recommender import GraphRecommender
 from util.conf import OptionConf
-from util.sampler import next_batch_pairwise
+from util.sampler import next_batch_pairwise, next_batch_pairwise_subgraph
 from base.torch_interface import TorchGraphInterface
 from util.loss_torch import bpr_loss,l2_reg_loss
+from data.partition import PartitionedGraph
+from util.history import HistoricalEmbedding, batch_nodes, propagate_batch
+from util.precision import MixedPrecision
 # paper: LightGCN: Simplifying and Powering Graph Convolution Network for Recommendation. SIGIR'20
 
 
@@ -13,16 +16,28 @@ class LightGCN(GraphRecommender):
         super(LightGCN, self).__init__(conf, training_set, test_set,valid_set)
         args = OptionConf(self.config['LightGCN'])
         self.n_layers = int(args['-n_layer'])
+        # Cluster-GCN style training: -n_part splits the graph, -part_batch parts are merged per step
+        self.n_parts = int(args['-n_part']) if args.contain('-n_part') else 0
+        self.parts_per_batch = int(args['-part_batch']) if args.contain('-part_batch') else 1
+        # historical embeddings: -history R rebuilds the per-layer store every R steps
+        self.history = HistoricalEmbedding(int(args['-history'])) if args.contain('-history') else None
         self.model = LGCN_Encoder(self.data, self.emb_size, self.n_layers)
+        # fp32, or bf16 to store the adjacency and the propagated layers in bfloat16 (tables stay fp32)
+        self.model.set_precision(self.config['precision'] if self.config.contain('precision') else 'fp32')
 
     def train(self):
+        if self.n_parts > 1:
+            return self.train_partitioned()
         model = self.model.cuda()
         optimizer = torch.optim.Adam(model.parameters(), lr=self.lRate)
         for epoch in range(self.maxEpoch):
             for n, batch in enumerate(next_batch_pairwise(self.data, self.batch_size)):
                 user_idx, pos_idx, neg_idx = batch
-                rec_user_emb, rec_item_emb = model()
-                user_emb, pos_item_emb, neg_item_emb = rec_user_emb[user_idx], rec_item_emb[pos_idx], rec_item_emb[neg_idx]
+                if self.history is not None:
+                    user_emb, pos_item_emb, neg_item_emb = model.forward_batch(self.history, user_idx, pos_idx, neg_idx)
+                else:
+                    rec_user_emb, rec_item_emb = model()
+                    user_emb, pos_item_emb, neg_item_emb = rec_user_emb[user_idx], rec_item_emb[pos_idx], rec_item_emb[neg_idx]
                 batch_loss = bpr_loss(user_emb, pos_item_emb, neg_item_emb) + l2_reg_loss(self.reg, user_emb,pos_item_emb,neg_item_emb)/self.batch_size
                 # Backward and optimize
                 optimizer.zero_grad()
@@ -34,12 +49,40 @@ class LightGCN(GraphRecommender):
                 self.user_emb, self.item_emb = model()
             if epoch % 5 == 0:
                 self.fast_evaluation(epoch)
+            if self.stop_training():
+                break
                 
 
                 
         self.user_emb, self.item_emb = self.best_user_emb, self.best_item_emb
 
-
+    def train_partitioned(self):
+        model = self.model.cuda()
+        optimizer = torch.optim.Adam(model.parameters(), lr=self.lRate)
+        partition = PartitionedGraph(self.data, self.n_parts)
+        print('Graph partitioned into', self.n_parts, 'parts, edge cut:', round(partition.edge_cut, 4))
+        for epoch in range(self.maxEpoch):
+            n = 0
+            for nodes, n_users, sub_adj, edges in partition.next_subgraph(self.parts_per_batch):
+                sub_adj = TorchGraphInterface.convert_sparse_mat_to_tensor(sub_adj).cuda()
+                node_idx = torch.from_numpy(nodes).long().cuda()
+                for user_idx, pos_idx, neg_idx in next_batch_pairwise_subgraph(self.data, nodes, n_users, edges, self.batch_size):
+                    sub_emb = model.forward_subgraph(node_idx, n_users, sub_adj)
+                    user_emb, pos_item_emb, neg_item_emb = sub_emb[user_idx], sub_emb[pos_idx], sub_emb[neg_idx]
+                    batch_loss = bpr_loss(user_emb, pos_item_emb, neg_item_emb) + l2_reg_loss(self.reg, user_emb,pos_item_emb,neg_item_emb)/self.batch_size
+                    optimizer.zero_grad()
+                    batch_loss.backward()
+                    optimizer.step()
+                    if n % 100==0 and n>0:
+                        print('training:', epoch + 1, 'batch', n, 'batch_loss:', batch_loss.item())
+                    n += 1
+            with torch.no_grad():
+                self.user_emb, self.item_emb = model()
+            if epoch % 5 == 0:
+                self.fast_evaluation(epoch)
+            if self.stop_training():
+                break
+        self.user_emb, self.item_emb = self.best_user_emb, self.best_item_emb
 
     def save(self):
         with torch.no_grad():
@@ -51,7 +94,7 @@ class LightGCN(GraphRecommender):
         return score.cpu().numpy()
 
 
-class LGCN_Encoder(nn.Module):
+class LGCN_Encoder(MixedPrecision, nn.Module):
     def __init__(self, data, emb_size, n_layers):
         super(LGCN_Encoder, self).__init__()
         self.data = data
@@ -70,14 +113,36 @@ class LGCN_Encoder(nn.Module):
         return embedding_dict
 
     def forward(self):
-        ego_embeddings = torch.cat([self.embedding_dict['user_emb'], self.embedding_dict['item_emb']], 0)
+        ego_embeddings = self.to_compute(torch.cat([self.embedding_dict['user_emb'], self.embedding_dict['item_emb']], 0))
+        adj = self.low_adj(self.sparse_norm_adj)
         all_embeddings = [ego_embeddings]
         for k in range(self.layers):
-            ego_embeddings = torch.sparse.mm(self.sparse_norm_adj, ego_embeddings)
+            ego_embeddings = torch.sparse.mm(adj, ego_embeddings)
             all_embeddings += [ego_embeddings]
-        all_embeddings = torch.stack(all_embeddings, dim=1)
-        all_embeddings = torch.mean(all_embeddings, dim=1)
+        all_embeddings = self.layer_mean(all_embeddings)
         user_all_embeddings = all_embeddings[:self.data.user_num]
         item_all_embeddings = all_embeddings[self.data.user_num:]
         return user_all_embeddings, item_all_embeddings
 
+    def forward_batch(self, history, user_idx, *item_idx):
+        """Embeddings of the batch entries, propagated exactly over their one-hop neighbourhood and
+        read from `history` beyond it."""
+        ego_embeddings = torch.cat([self.embedding_dict['user_emb'], self.embedding_dict['item_emb']], 0)
+        if history.stale():
+            history.rebuild(ego_embeddings, self.sparse_norm_adj, self.layers)
+        nodes, positions = batch_nodes(self.data.user_num, ego_embeddings.device, user_idx, *item_idx)
+        all_embeddings = propagate_batch(ego_embeddings, self.sparse_norm_adj, nodes, self.layers, history)
+        all_embeddings = torch.mean(torch.stack(all_embeddings, dim=1), dim=1)
+        return [all_embeddings[p] for p in positions]
+
+    def forward_subgraph(self, nodes, n_users, sub_adj):
+        """Propagate only over the induced subgraph of `nodes` (global ids, the first n_users are users)."""
+        user_nodes, item_nodes = nodes[:n_users], nodes[n_users:] - self.data.user_num
+        ego_embeddings = torch.cat([self.embedding_dict['user_emb'][user_nodes], self.embedding_dict['item_emb'][item_nodes]], 0)
+        all_embeddings = [ego_embeddings]
+        for k in range(self.layers):
+            ego_embeddings = torch.sparse.mm(sub_adj, ego_embeddings)
+            all_embeddings += [ego_embeddings]
+        all_embeddings = torch.stack(all_embeddings, dim=1)
+        return torch.mean(all_embeddings, dim=1)
+
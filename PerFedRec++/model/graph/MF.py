@@ -4,30 +4,31 @@ from base.graph_recommender import GraphRecommender
 from util.sampler import next_batch_pairwise
 from util.loss_torch import bpr_loss,l2_reg_loss
 import sys
+from util.optim import lookup, make_optimizer
 
 class MF(GraphRecommender):
     def __init__(self, conf, training_set, test_set,valid_set):
         super(MF, self).__init__(conf, training_set, test_set,valid_set)
         self.model = Matrix_Factorization(self.data, self.emb_size)
+        # adam, or lazy_adam / lazy_adagrad to update only the rows of the batch through sparse gradients
+        self.optimizer = self.config['optimizer'] if self.config.contain('optimizer') else 'adam'
         
         
 
     def train(self):
         
         model = self.model.cuda()
-        optimizer = torch.optim.Adam(model.parameters(), lr=self.lRate)
+        optimizer = make_optimizer(self.optimizer, model.parameters(), self.lRate)
+        sparse = self.optimizer != 'adam'
         for epoch in range(self.maxEpoch):
             for n, batch in enumerate(next_batch_pairwise(self.data, self.batch_size)):
                 user_idx, pos_idx, neg_idx = batch
-                rec_user_emb, rec_item_emb = model()
-                print(rec_user_emb)
-                user_emb, pos_item_emb, neg_item_emb = rec_user_emb[user_idx], rec_item_emb[pos_idx], rec_item_emb[neg_idx]
+                user_emb, pos_item_emb, neg_item_emb = model.lookup(user_idx, pos_idx, neg_idx, sparse)
                 batch_loss = bpr_loss(user_emb, pos_item_emb, neg_item_emb) + l2_reg_loss(self.reg, user_emb,pos_item_emb,neg_item_emb)/self.batch_size
                 # Backward and optimize
                 optimizer.zero_grad()
                 batch_loss.backward()
                 optimizer.step()
-                rec_user_emb, rec_item_emb = model()
                 # print(rec_user_emb)
                 
                 # if n == 1:
@@ -38,11 +39,13 @@ class MF(GraphRecommender):
                 self.user_emb, self.item_emb = self.model()
             if epoch % 5 == 0:
                 self.fast_evaluation(epoch)
+            if self.stop_training():
+                break
         self.user_emb, self.item_emb = self.best_user_emb, self.best_item_emb
 
     def save(self):
         with torch.no_grad():
-            self.best_user_emb, self.best_item_emb = self.model.forward()
+            self.best_user_emb, self.best_item_emb = self.best_snapshot.take(*self.model.forward())
 
     def predict(self, u):
         with torch.no_grad():
@@ -69,4 +72,9 @@ class Matrix_Factorization(nn.Module):
     def forward(self):
         return self.embedding_dict['user_emb'], self.embedding_dict['item_emb']
 
+    def lookup(self, user_idx, pos_idx, neg_idx, sparse=False):
+        """Embeddings of a batch; sparse=True gives row-sparse gradients on the tables."""
+        user_emb, item_emb = self.embedding_dict['user_emb'], self.embedding_dict['item_emb']
+        return lookup(user_emb, user_idx, sparse), lookup(item_emb, pos_idx, sparse), lookup(item_emb, neg_idx, sparse)
+
 
@@ -3,105 +3,172 @@ import torch.nn as nn
 from base.graph_recommender import GraphRecommender
 from util.sampler import *
 from util.loss_torch import bpr_loss,l2_reg_loss
-import random
 import copy
 from base.torch_interface import TorchGraphInterface
 from util.conf import OptionConf
+from util.history import HistoricalEmbedding, batch_nodes, propagate_batch
+from util.executor import ClientPool
+from util.noise import LDPNoise
+from util.federated import RowDelta, StreamingFedAvg, ClusterFedAvg, BatchedClients, SharedPropagation, RoundAdam
 from data.augmentor import GraphAugmentor
-from sklearn.cluster import KMeans
+from util.cluster import MiniBatchKMeans
+from util.selection import ClientScheduler
+from util.local_store import LocalModelStore
+from util.client_store import ClientStateStore
+from util.precision import MixedPrecision
+from util.compress import UploadCompressor, make_codec
 import numpy as np
 
-def FedAvg(w):
-    w_avg = copy.deepcopy(w[0])
-    for k in w_avg.keys():
-        for i in range(1, len(w)):
-            w_avg[k] += w[i][k]
-        w_avg[k] = torch.div(w_avg[k], len(w))
-    return w_avg
-
-def FedReAvg(w,N_client):
-    w_avg = copy.deepcopy(w[0])
-    for k in w_avg.keys():
-        for i in range(1, N_client):
-            w_avg[k] += w[1][k]
-        w_avg[k] = torch.div(w_avg[k], N_client)
-    return w_avg
 
 class PerFedRec(GraphRecommender):
     def __init__(self, conf, training_set, test_set,valid_set):
         super(PerFedRec, self).__init__(conf, training_set, test_set,valid_set)
         args = OptionConf(self.config['PerFedRec'])
         self.n_layers = int(args['-n_layer'])
+        # historical embeddings: -history R rebuilds the per-layer store at the start of every R-th round
+        self.history_rounds = int(args['-history']) if args.contain('-history') else 0
+        # simulate the selected clients in chunks of this size in one vectorized pass, 0 keeps the client loop
+        self.batched_clients = int(args['-batched_clients']) if args.contain('-batched_clients') else 0
+        # train the selected clients in this many CPU worker processes, 0 keeps them in this process
+        self.workers = int(args['-workers']) if args.contain('-workers') else 0
+        # -round_adam 1 lets every client of a round step from the round-start Adam state and advances the optimizer
+        # once per round with the mean client gradient; an update then keeps only the client's own rows, with the
+        # momentum drift shared by the round. 0 keeps one step per client on the shared optimizer
+        self.round_adam = args.contain('-round_adam') and int(args['-round_adam']) == 1
+        # LDP mechanism of the uploaded item table: laplace or gaussian
+        self.ldp = args['-ldp'] if args.contain('-ldp') else 'laplace'
+        # -cluster_drift T re-clusters the users whenever the centroids drift by more than T instead of on the epoch schedule
+        self.cluster_drift = float(args['-cluster_drift']) if args.contain('-cluster_drift') else None
+        # selection between re-clusterings: uniform or interaction; after a re-clustering it is cluster-proportional
+        self.selection = args['-selection'] if args.contain('-selection') else 'uniform'
+        # -shared_forward 1 propagates once per round and reuses the result for every client
+        self.shared_forward = args.contain('-shared_forward') and int(args['-shared_forward']) == 1
+        # -client_store DIR keeps every client's personalized user row, last round and cluster on disk across rounds
+        self.client_store_path = args['-client_store'] if args.contain('-client_store') else None
+        self.client_store = None
         self.model = PerFedRec_LGCN_Encoder(self.data, self.emb_size, self.n_layers)
+        # fp32, or bf16 to store the adjacency and the propagated layers in bfloat16 (tables stay fp32)
+        self.model.set_precision(self.config['precision'] if self.config.contain('precision') else 'fp32')
         self.msg = conf['training.set']
         self.dataset_name = conf['training.set']
+        # compression=-codec topk_rows|topk|int8|int4|sign [-ratio R] [-error_feedback 0] [-residuals N] compresses every client upload;
+        # the client carries what the codec dropped over to its next upload. The residuals of the N (default 10000)
+        # most recent clients are kept, each at most the changed rows of one update in fp32
+        self.compressor = None
+        if conf.contain('compression'):
+            compression_args = OptionConf(conf['compression'])
+            ratio = float(compression_args['-ratio']) if compression_args.contain('-ratio') else 0.1
+            error_feedback = not compression_args.contain('-error_feedback') or compression_args['-error_feedback'] == '1'
+            max_residuals = int(compression_args['-residuals']) if compression_args.contain('-residuals') else 10000
+            self.compressor = UploadCompressor(make_codec(compression_args['-codec'], ratio), error_feedback,
+                                               max_residuals=max_residuals)
+            self.msg += ('\ncompression:' + conf['compression'])
 
     def train(self):
         model = self.model.cuda()
-        model_para_list = []
         N_client = 256
         self.N_client = N_client
         loc, scale = 0., 0.1
         delta = 0.3
         n_cluster = 5
+        clustering = MiniBatchKMeans(n_cluster, drift_threshold=self.cluster_drift)
+        interactions = np.asarray(self.data.interaction_mat.sum(axis=1)).flatten()
+        scheduler = ClientScheduler(self.data.user_num, N_client, self.selection, interactions=interactions, seed=int(np.random.randint(2 ** 31)))
         optimizer = torch.optim.Adam(model.parameters(), lr=self.lRate*N_client)
         self.loss_list = []
         self.ndcg_list = []
+        self.upload_list = []
+        history = HistoricalEmbedding() if self.history_rounds > 0 else None
+        simulator = BatchedClients(model, optimizer, self.reg, self.batch_size, self.batched_clients) if self.batched_clients > 0 else None
+        ldp = LDPNoise(loc, scale, N_client, self.ldp, device=model.embedding_dict['item_emb'].device, seed=int(np.random.randint(2 ** 31)))
+        pool = ClientPool(model, optimizer, self.data, self.reg, self.batch_size, self.workers,
+                          seed=int(np.random.randint(2 ** 31)), round_adam=self.round_adam) if self.workers > 0 else None
+        shared = SharedPropagation(model) if self.shared_forward and history is None else None
+        round_adam = RoundAdam(model, optimizer) if self.round_adam else None
+        if self.client_store_path is not None:
+            # cleared when reopened: a new run never sees the clients of an earlier one
+            self.client_store = ClientStateStore(self.client_store_path, self.data.user_num, self.emb_size)
+        self.clu_result = None
         for epoch in range(self.maxEpoch):
-            self.clu_result=None
+            if history is not None and epoch % self.history_rounds == 0:
+                history.expire()
             if epoch > 50 and epoch < 180 and epoch % 6 == 0:
                 self.cluster_client = True
             else:
                 self.cluster_client = False
 
-            self.local_model = {}
-            self.cluster_model = {}
+            self.cluster_model = None
             losses = []
             if epoch == 0:
-                user_list = list(self.data.user.keys())
-                random.shuffle(user_list)
-                select_user_list = user_list[:N_client]
-                not_select_user_list=user_list[N_client:]
+                selected, self.select_mask = scheduler.select()
+                self.select_user_list = [self.data.id2user[_] for _ in selected]
+            select_user_list = self.select_user_list
+            original_params = copy.deepcopy(model.state_dict())
+            self.local_model = LocalModelStore(original_params)
+            aggregator = StreamingFedAvg(original_params)
+            if self.cluster_client == True and epoch >= 1 and self.clu_result is not None:
+                self.cluster_model = ClusterFedAvg(original_params, n_cluster)
+            if pool is not None:
+                client_users, client_losses, client_updates = pool.step(epoch, select_user_list)
+                losses += client_losses
+                for user, update in zip(client_users, client_updates):
+                    self.fold_update(aggregator, user, update)
+            elif simulator is not None:
+                batches = list(next_batch_pairwise_fl_pse(self.data, self.batch_size, select_user_list))
+                client_users = [user_idx[0] for user_idx, _, _ in batches]
+                client_losses, client_updates = simulator.step(batches)
+                losses += client_losses
+                for user, update in zip(client_users, client_updates):
+                    self.fold_update(aggregator, user, update)
             else:
-                select_user_list = self.select_user_list
-                not_select_user_list = self.not_select_user_list
-            select_user_list_num = [self.data.user[_] for _ in select_user_list]
-            for n, batch in enumerate(next_batch_pairwise_fl_pse(self.data, self.batch_size, select_user_list)):
-                model_ini = copy.deepcopy(model.state_dict())
-                user_idx, pos_idx, neg_idx = batch
-                rec_user_emb, rec_item_emb = model(perturbed=False)
-                user_emb, pos_item_emb, neg_item_emb = rec_user_emb[user_idx], rec_item_emb[pos_idx], rec_item_emb[neg_idx]
-                batch_loss = bpr_loss(user_emb, pos_item_emb, neg_item_emb) + l2_reg_loss(self.reg, user_emb,pos_item_emb,neg_item_emb)/self.batch_size
-                optimizer.zero_grad()
-                batch_loss.backward()
-                optimizer.step()
+                if shared is not None:
+                    shared.refresh()
+                if round_adam is not None:
+                    round_adam.begin()
+                client_users = []
+                for n, batch in enumerate(next_batch_pairwise_fl_pse(self.data, self.batch_size, select_user_list)):
+                    user_idx, pos_idx, neg_idx = batch
+                    if history is not None:
+                        user_emb, pos_item_emb, neg_item_emb = model.forward_batch(history, user_idx, pos_idx, neg_idx)
+                    else:
+                        rec_user_emb, rec_item_emb = shared.forward() if shared is not None else model(perturbed=False)
+                        user_emb, pos_item_emb, neg_item_emb = rec_user_emb[user_idx], rec_item_emb[pos_idx], rec_item_emb[neg_idx]
+                    batch_loss = bpr_loss(user_emb, pos_item_emb, neg_item_emb) + l2_reg_loss(self.reg, user_emb,pos_item_emb,neg_item_emb)/self.batch_size
+                    optimizer.zero_grad()
+                    if shared is not None:
+                        shared.backward(batch_loss)
+                    else:
+                        batch_loss.backward()
+                    optimizer.step()
                 
-                if n % 100==0 and n>0:
-                    print('training:', epoch + 1, 'batch', n, 'batch_loss:', batch_loss.item())
-                losses.append(batch_loss.item())
-                model_aft = copy.deepcopy(model.state_dict())
-                model_para_list += [model_aft]
-
-                self.local_model[user_idx[0]] = FedReAvg([model_aft, model_ini], self.N_client)
-                if self.cluster_client == True and epoch>=1:
-                   if self.clu_result is not None:
-                        w_cluster_list = self.cluster_model.get( self.clu_result[user_idx[0]],[] )
-                        w_cluster_list+= [model_aft]
-                        self.cluster_model[self.clu_result[user_idx[0]]] = w_cluster_list
-
-                model.load_state_dict(model_ini)
-  
+                    if n % 100==0 and n>0:
+                        print('training:', epoch + 1, 'batch', n, 'batch_loss:', batch_loss.item())
+                    losses.append(batch_loss.item())
+                    # folded right away, so the round holds no more than one update at a time
+                    update = round_adam.capture(original_params) if round_adam is not None else RowDelta.capture(model, original_params)
+                    self.fold_update(aggregator, user_idx[0], update)
+                    client_users += [user_idx[0]]
+                if round_adam is not None:
+                    round_adam.end()
+
+            if self.compressor is not None:
+                sent, raw = self.compressor.reset_counts()
+                self.upload_list.append(sent)
+                print('Upload: %.3f MB (%.3f MB uncompressed, %.1fx)' % (sent / 2 ** 20, raw / 2 ** 20, raw / max(1, sent)))
+
+            if self.client_store is not None:
+                user_rows = torch.stack([self.local_model.user_row(user) for user in client_users]).cpu().numpy()
+                clusters = np.asarray(self.clu_result)[client_users] if self.clu_result is not None else None
+                self.client_store.put(client_users, user_rows, epoch, clusters)
+
             print('Avg Loss:', sum(losses)/len(losses))
             self.loss_list.append(sum(losses)/len(losses))
-            w_ = FedAvg(model_para_list)
-            model.load_state_dict(w_)
-            model_para_list = []
-            for i in self.cluster_model:
-                self.cluster_model[i] = FedAvg(self.cluster_model[i])
+            model.load_state_dict(aggregator.result())
+            if self.cluster_model is not None:
+                self.cluster_model.result()
             add_noise = True
             if add_noise:
-                i_random_noise = torch.tensor(np.random.laplace(loc=loc, scale=scale, size=(N_client,rec_item_emb.shape[0],rec_item_emb.shape[1])) )
-                i_random_noise = torch.mean(i_random_noise, dim=0).float().to('cuda')
+                i_random_noise = ldp.mean((self.data.item_num, self.emb_size))
                 model.add_noise_(i_random_noise)
 
             with torch.no_grad():
@@ -114,60 +181,48 @@ class PerFedRec(GraphRecommender):
                 if epoch > 1:
                     print('local_model')
                     self.fast_evaluation(epoch,model_type='local_model')
+            if self.stop_training():
+                break
 
+            if self.cluster_drift is not None:
+                self.cluster_client = clustering.needs_refit(self.user_emb)
             if self.cluster_client == True:
-                users_emb = copy.deepcopy( self.user_emb.data )
-                users_emb = users_emb.cpu().detach().numpy()
-                n_fed_client_each_round = self.N_client
-
-                n_client = self.data.user_num
-                kmeans = KMeans(n_clusters=n_cluster).fit(users_emb)
-                cluster_ids = kmeans.labels_
-                cluster_result = list(kmeans.labels_)
-                self.clu_result=cluster_result
-
-                sampled_ids = []
-                for c in np.unique(cluster_ids):
-                    ids = np.where(cluster_ids == c)[0]
-                    sampled_ids.extend(np.random.choice(ids, size=int(len(ids)/len(users_emb) * N_client), replace=False))
-                    print('cluster',c, ':',int(len(ids)/len(users_emb) * N_client))
-
-                idxs_users_ = list(set(sampled_ids))
-                for kk in (idxs_users_):
-                    if kk in select_user_list_num:
-                        idxs_users_.remove(kk)
-
-                while len(idxs_users_) < n_fed_client_each_round:
-                    r_= random.sample(range(0, n_client), 1)[0]
-                    if not r_ in idxs_users_ and not r_ in select_user_list_num:
-                        idxs_users_.append(r_)
-
-                not_select_user_idxs = list ( set([_ for _ in range(n_client)]) - set(idxs_users_) )
-                select_user_list = [self.data.id2user[_] for _ in idxs_users_]
-                not_select_user_list= [self.data.id2user[_] for _ in not_select_user_idxs]
-                
-                self.select_user_list=select_user_list
-                self.not_select_user_list=not_select_user_list
+                cluster_ids = clustering.fit(self.user_emb).cpu().numpy()
+                self.clu_result = list(cluster_ids)
+                print('cluster sizes:', np.bincount(cluster_ids, minlength=n_cluster))
+                selected, self.select_mask = scheduler.select(cluster_ids, strategy='cluster')
             else:
-                user_candidate_list = list ( set(self.data.user.keys()) - set(select_user_list) )
-                random.shuffle(user_candidate_list)
-                select_user_list = user_candidate_list[:N_client]
-                not_select_user_list=list ( set(self.data.user.keys()) - set(select_user_list) )
-                self.select_user_list=select_user_list
-                self.not_select_user_list=not_select_user_list
+                selected, self.select_mask = scheduler.select()
+            self.select_user_list = [self.data.id2user[_] for _ in selected]
 
         self.loss_list = [str(_) for _ in self.loss_list]
+        if pool is not None:
+            pool.close()
+        if self.client_store is not None:
+            self.client_store.flush()
         self.user_emb, self.item_emb = self.best_user_emb, self.best_item_emb
         torch.save(self.user_emb, f'{self.dataset_name}_{self.model_name_}_user.pt')
         torch.save(self.item_emb, f'{self.dataset_name}_{self.model_name_}_item.pt')
         self.msg += ('\nNDCG:'+' '.join(self.ndcg_list ))
         self.msg += ('\nLOSS:'+' '.join(self.loss_list )+'\n')
+        if self.compressor is not None:
+            self.msg += 'upload_bytes_per_round:%d\n' % (sum(self.upload_list) / max(1, len(self.upload_list)))
+
 
+    def fold_update(self, aggregator, user, update):
+        """Fold one client's update into the round: the (compressed) upload into the global and cluster
+        aggregates, the update itself into the client's local model."""
+        upload = self.compressor.compress(user, update) if self.compressor is not None else update
+        aggregator.add(upload)
+        self.local_model.add(user, update, 1. / self.N_client)
+        if self.cluster_model is not None:
+            self.cluster_model.add(upload, self.clu_result[user])
 
     def save(self):
         with torch.no_grad():
-            self.best_user_emb, self.best_item_emb = copy.deepcopy(self.model.get_emb())
-            self.best_local_model = copy.deepcopy(self.local_model)
+            self.best_user_emb, self.best_item_emb = self.best_snapshot.take(*self.model.get_emb())
+            # a new store is built every round, so the current one can be kept as is
+            self.best_local_model = self.local_model
 
     def get_client_mat(self, drop_client_list):
         dropped_mat = None
@@ -185,15 +240,27 @@ class PerFedRec(GraphRecommender):
         with torch.no_grad():         
             u = self.data.get_user_id(u)
             if u in self.local_model:
-                user_emb = self.local_model[u]['embedding_dict.user_emb']
-                item_emb = self.local_model[u]['embedding_dict.item_emb']
-                score = torch.matmul(user_emb[u], item_emb.transpose(0, 1))
-                return score.cpu().numpy()
+                return self.local_model.score(u).cpu().numpy()
+            elif self.client_store is not None and self.client_store.seen(u):
+                # personalized row from the client's last round against the current global item table
+                user_row = torch.as_tensor(self.client_store.get([u])[0][0], device=self.item_emb.device)
+                return torch.matmul(self.item_emb, user_row).cpu().numpy()
             else:
                 return None
 
+    def predict_cluster(self, u):
+        with torch.no_grad():
+            u = self.data.get_user_id(u)
+            if self.cluster_model is None or self.clu_result is None:
+                return None
+            cluster = self.cluster_model.model(self.clu_result[u])
+            if cluster is None:
+                return None
+            score = torch.matmul(cluster['embedding_dict.user_emb'][u], cluster['embedding_dict.item_emb'].transpose(0, 1))
+            return score.cpu().numpy()
+
 
-class PerFedRec_LGCN_Encoder(nn.Module):
+class PerFedRec_LGCN_Encoder(MixedPrecision, nn.Module):
     def __init__(self, data, emb_size, n_layers):
         super(PerFedRec_LGCN_Encoder, self).__init__()
         self.data = data
@@ -218,26 +285,46 @@ class PerFedRec_LGCN_Encoder(nn.Module):
     def add_noise_(self, noise):
         self.embedding_dict['item_emb'].data = self.embedding_dict['item_emb'].data + noise
 
+    def propagate(self, ego_embeddings):
+        """Unperturbed propagation of a stack of ego embeddings; every feature column is propagated on its own."""
+        ego_embeddings = self.to_compute(ego_embeddings)
+        adj = self.low_adj(self.sparse_norm_adj)
+        all_embeddings = []
+        for k in range(self.layers):
+            ego_embeddings = torch.sparse.mm(adj, ego_embeddings)
+            all_embeddings.append(ego_embeddings)
+        return self.layer_mean(all_embeddings)
+
+    def forward_batch(self, history, user_idx, *item_idx):
+        """Unperturbed embeddings of the batch entries, propagated exactly over their one-hop
+        neighbourhood and read from `history` beyond it."""
+        ego_embeddings = torch.cat([self.embedding_dict['user_emb'], self.embedding_dict['item_emb']], 0)
+        if history.stale():
+            history.rebuild(ego_embeddings, self.sparse_norm_adj, self.layers)
+        nodes, positions = batch_nodes(self.data.user_num, ego_embeddings.device, user_idx, *item_idx)
+        all_embeddings = propagate_batch(ego_embeddings, self.sparse_norm_adj, nodes, self.layers, history)[1:]
+        all_embeddings = torch.mean(torch.stack(all_embeddings, dim=1), dim=1)
+        return [all_embeddings[p] for p in positions]
+
     def forward(self, perturbed=False, perturbed_adj=None):
         self.eps=0.1
 
-        ego_embeddings = torch.cat([self.embedding_dict['user_emb'], self.embedding_dict['item_emb']], 0)
+        ego_embeddings = self.to_compute(torch.cat([self.embedding_dict['user_emb'], self.embedding_dict['item_emb']], 0))
         all_embeddings = []
         for k in range(self.layers):
             if perturbed_adj is not None:
                 if isinstance(perturbed_adj,list):
-                    ego_embeddings = torch.sparse.mm(perturbed_adj[k], ego_embeddings)
+                    ego_embeddings = torch.sparse.mm(self.low_adj(perturbed_adj[k]), ego_embeddings)
                 else:
-                    ego_embeddings = torch.sparse.mm(perturbed_adj, ego_embeddings)
+                    ego_embeddings = torch.sparse.mm(self.low_adj(perturbed_adj), ego_embeddings)
             else:
-                ego_embeddings = torch.sparse.mm(self.sparse_norm_adj, ego_embeddings)
+                ego_embeddings = torch.sparse.mm(self.low_adj(self.sparse_norm_adj), ego_embeddings)
 
             if perturbed:
                 random_noise = torch.rand_like(ego_embeddings).cuda()
                 ego_embeddings +=  F.normalize(random_noise, dim=-1) * self.eps
             all_embeddings.append(ego_embeddings)
-        all_embeddings = torch.stack(all_embeddings, dim=1)
-        all_embeddings = torch.mean(all_embeddings, dim=1)
+        all_embeddings = self.layer_mean(all_embeddings)
         user_all_embeddings, item_all_embeddings = torch.split(all_embeddings, [self.data.user_num, self.data.item_num])
         return user_all_embeddings, item_all_embeddings
 
@@ -3,80 +3,182 @@ import torch.nn as nn
 from base.graph_recommender import GraphRecommender
 from util.sampler import *
 from util.loss_torch import *
+import os
 import random
 import copy
 from base.torch_interface import TorchGraphInterface
 from util.conf import OptionConf
+from util.history import HistoricalEmbedding, batch_nodes, propagate_batch
+from util.prefetch import Prefetcher
+from util.executor import ClientPool
+from util.noise import LDPNoise
+from util.federated import RowDelta, StreamingFedAvg, ClusterFedAvg, BatchedClients, SharedPropagation, RoundAdam
 from data.augmentor import GraphAugmentor
-from sklearn.cluster import KMeans
+from util.cluster import MiniBatchKMeans
+from util.selection import ClientScheduler
+from util.local_store import LocalModelStore
+from util.client_store import ClientStateStore
+from util.precision import MixedPrecision
+from util.pretrain_cache import PretrainCache
+from util.checkpoint import Checkpointer, rng_state, set_rng_state
+from util.async_fed import ClientProfile, FedBuff, AsyncFederation
+from util.compress import UploadCompressor, make_codec
 import numpy as np
 
 
-def FedAvg(w):
-    w_avg = copy.deepcopy(w[0])
-    for k in w_avg.keys():
-        for i in range(1, len(w)):
-            w_avg[k] += w[i][k]
-        w_avg[k] = torch.div(w_avg[k], len(w))
-    return w_avg
-
-
-def FedReAvg(w, N_client):
-    w_avg = copy.deepcopy(w[0])
-    for k in w_avg.keys():
-        for i in range(1, N_client):
-            w_avg[k] += w[1][k]
-        w_avg[k] = torch.div(w_avg[k], N_client)
-    return w_avg
-
 
 class PerFedRec_plus(GraphRecommender):
     def __init__(self, conf, training_set, test_set, valid_set):
         super(PerFedRec_plus, self).__init__(conf, training_set, test_set, valid_set)
         args = OptionConf(self.config['PerFedRec'])
         self.n_layers = int(args['-n_layer'])
+        # historical embeddings: -history R rebuilds the per-layer store at the start of every R-th round
+        self.history_rounds = int(args['-history']) if args.contain('-history') else 0
+        # simulate the selected clients in chunks of this size in one vectorized pass, 0 keeps the client loop
+        self.batched_clients = int(args['-batched_clients']) if args.contain('-batched_clients') else 0
+        # train the selected clients in this many CPU worker processes, 0 keeps them in this process
+        self.workers = int(args['-workers']) if args.contain('-workers') else 0
+        # -round_adam 1 lets every client of a round step from the round-start Adam state and advances the optimizer
+        # once per round with the mean client gradient; an update then keeps only the client's own rows, with the
+        # momentum drift shared by the round. 0 keeps one step per client on the shared optimizer
+        self.round_adam = args.contain('-round_adam') and int(args['-round_adam']) == 1
+        # LDP mechanism of the uploaded item table: laplace or gaussian
+        self.ldp = args['-ldp'] if args.contain('-ldp') else 'laplace'
+        # -cluster_drift T re-clusters the users whenever the centroids drift by more than T instead of on the epoch schedule
+        self.cluster_drift = float(args['-cluster_drift']) if args.contain('-cluster_drift') else None
+        # selection between re-clusterings: uniform or interaction; after a re-clustering it is cluster-proportional
+        self.selection = args['-selection'] if args.contain('-selection') else 'uniform'
+        # -shared_forward 1 propagates once per round and reuses the result for every client
+        self.shared_forward = args.contain('-shared_forward') and int(args['-shared_forward']) == 1
+        # -client_store DIR keeps every client's personalized user row, last round and cluster on disk across rounds
+        self.client_store_path = args['-client_store'] if args.contain('-client_store') else None
+        self.client_store = None
+        # copy of the client store that the last checkpoint refers to
+        self.store_snapshot = None
+        # -cl_batch B pretrains on mini-batches of B users (and as many item blocks) per step instead of one step per epoch
+        self.cl_batch = int(args['-cl_batch']) if args.contain('-cl_batch') else 0
+        # -async K trains asynchronously (FedBuff): the server steps every K client updates, with -concurrency C
+        # clients in flight, -staleness sqrt|linear|none weighting of late updates and a -server_lr step size
+        self.async_buffer = int(args['-async']) if args.contain('-async') else 0
+        self.concurrency = int(args['-concurrency']) if args.contain('-concurrency') else 4 * self.async_buffer
+        # a client is never in flight twice
+        self.concurrency = min(self.concurrency, self.data.user_num)
+        self.staleness = args['-staleness'] if args.contain('-staleness') else 'sqrt'
+        self.server_lr = float(args['-server_lr']) if args.contain('-server_lr') else 1.
         pretrain_noise = float(conf['pretrain_noise'])
         self.model = PerFedRec_LGCN_Encoder(self.data, self.emb_size, self.n_layers, pretrain_noise)
+        # fp32, or bf16 to store the adjacency and the propagated layers in bfloat16 (tables stay fp32)
+        self.model.set_precision(self.config['precision'] if self.config.contain('precision') else 'fp32')
         self.msg += conf['training.set']
         self.dataset_name = conf['training.set']
         self.pretrain_epoch = conf['pretrain_epoch']
         self.noise_scale = float(conf['noise_scale'])
         self.clip_value = float(conf['clip_value'])
+        # 'coordinate' clamps every entry of a client's change, 'l2' rescales the whole change to the clip norm
+        self.clip_mode = conf['clip_mode'] if conf.contain('clip_mode') else 'coordinate'
         self.pretrain_nclient = int(conf['pretrain_nclient'])
+        # compression=-codec topk_rows|topk|int8|int4|sign [-ratio R] [-error_feedback 0] [-residuals N] compresses every client upload;
+        # the client clips before encoding and carries what the codec dropped over to its next upload. The residuals of the
+        # N (default 10000) most recent clients are kept, each at most the changed rows of one update in fp32
+        self.compressor = None
+        if conf.contain('compression'):
+            compression_args = OptionConf(conf['compression'])
+            ratio = float(compression_args['-ratio']) if compression_args.contain('-ratio') else 0.1
+            error_feedback = not compression_args.contain('-error_feedback') or compression_args['-error_feedback'] == '1'
+            max_residuals = int(compression_args['-residuals']) if compression_args.contain('-residuals') else 10000
+            self.compressor = UploadCompressor(make_codec(compression_args['-codec'], ratio), error_feedback, self.clip_value, self.clip_mode,
+                                               max_residuals)
+        # checkpoint=-dir DIR [-every N] writes the full training state every N rounds; resume=1 continues from it
+        self.checkpointer = None
+        self.resume = conf.contain('resume') and conf['resume'] == '1'
+        if conf.contain('checkpoint'):
+            checkpoint_args = OptionConf(conf['checkpoint'])
+            dataset = os.path.basename(os.path.dirname(os.path.abspath(conf['training.set'])))
+            path = os.path.join(checkpoint_args['-dir'], '%s_%s.pt' % (self.model_name, dataset))
+            every = int(checkpoint_args['-every']) if checkpoint_args.contain('-every') else 10
+            self.checkpointer = Checkpointer(path, every)
+        if self.async_buffer > 0 and (self.checkpointer is not None or self.resume):
+            raise ValueError('checkpoint and resume are not supported with -async')
+        # client_profile=-compute C -sigma S -latency L -stragglers F -slowdown X simulates device heterogeneity
+        # (seconds per client task); target_ndcg=T reports the simulated time at which validation NDCG first reaches T
+        self.profile = None
+        if conf.contain('client_profile') or self.async_buffer > 0:
+            profile_args = OptionConf(conf['client_profile'] if conf.contain('client_profile') else '')
+            profile_settings = {key: float(profile_args['-' + key]) for key in ['compute', 'sigma', 'latency', 'stragglers', 'slowdown']
+                                if profile_args.contain('-' + key)}
+            self.profile = ClientProfile(self.data.user_num, seed=int(np.random.randint(2 ** 31)), **profile_settings)
+        self.target_ndcg = float(conf['target_ndcg']) if conf.contain('target_ndcg') else None
+        self.sim_time = 0.
+        self.time_to_target = None
+        # pretrain_cache=DIR reuses the pretrained tables of an earlier run with the same data and pretraining settings
+        self.pretrain_cache = None
+        if conf.contain('pretrain_cache'):
+            settings = {'embedding.size': self.emb_size, 'learnRate': self.lRate, 'n_layer': self.n_layers,
+                        'pretrain_epoch': int(self.pretrain_epoch), 'pretrain_noise': pretrain_noise,
+                        'pretrain_nclient': self.pretrain_nclient, 'cl_batch': self.cl_batch,
+                        'precision': conf['precision'] if conf.contain('precision') else 'fp32'}
+            self.pretrain_cache = PretrainCache(conf['pretrain_cache'], conf['training.set'], settings)
+            self.pretrain_settings = settings
 
         self.msg += ('pretrain_epoch:' + conf['pretrain_epoch'] + '\n')
         self.msg += ('noise_scale:' + (conf['noise_scale']) + '\n')
         self.msg += ('clip_value:' + (conf['clip_value']) + '\n')
+        self.msg += ('clip_mode:' + self.clip_mode + '\n')
         self.msg += ('pretrain_noise:' + (conf['pretrain_noise']) + '\n')
         self.msg += ('pretrain_nclient:' + (conf['pretrain_nclient']) + '\n')
+        if self.compressor is not None:
+            self.msg += ('compression:' + conf['compression'] + '\n')
 
         print(self.msg)
 
 
     def train(self):
         model = self.model.cuda()
-        model_para_list = []
         N_client = 256
         self.N_client = N_client
         loc, scale = 0., 0.1
         delta = 0.3
         n_cluster = 5
+        clustering = MiniBatchKMeans(n_cluster, drift_threshold=self.cluster_drift)
+        interactions = np.asarray(self.data.interaction_mat.sum(axis=1)).flatten()
+        scheduler = ClientScheduler(self.data.user_num, N_client, self.selection, interactions=interactions, seed=int(np.random.randint(2 ** 31)))
         scale = self.noise_scale
         clip_value = self.clip_value
         optimizer = torch.optim.Adam(model.parameters(), lr=self.lRate * 50)
         self.local_model = None
         Pretraining = True
+        resume_state = self.checkpointer.load() if self.checkpointer is not None and self.resume else None
+        if resume_state is not None:
+            print('Resuming from round', resume_state['epoch'] + 2, 'of', self.checkpointer.path)
+            Pretraining = False
+        cached = self.pretrain_cache.load() if self.pretrain_cache is not None and Pretraining else None
+        if cached is not None:
+            print('Loading pretrained embeddings from', self.pretrain_cache.path)
+            with torch.no_grad():
+                for table, value in zip([model.embedding_dict['user_emb'], model.embedding_dict['item_emb']], cached):
+                    table.copy_(torch.from_numpy(np.array(value)).to(table.device))
+            Pretraining = False
 
-        if Pretraining == True:
+        if Pretraining == True and self.cl_batch > 0:
             self.msg += '\npretrain\n'
+            self.pretrain_minibatch(optimizer)
+        elif Pretraining == True:
+            self.msg += '\npretrain\n'
+            # the client graph of the next pretraining epoch is built while the current one trains
+            prefetcher = Prefetcher(self.get_client_mat)
+            next_user_list = list(self.data.user.keys())
+            random.shuffle(next_user_list)
             for epoch in range(int(self.pretrain_epoch)):
-                user_list = list(self.data.user.keys())
-                random.shuffle(user_list)
+                user_list = next_user_list
                 select_user_list = user_list[:self.pretrain_nclient]
                 not_select_user_list = user_list[self.pretrain_nclient:]
                 select_user_list_num = [self.data.user[_] for _ in select_user_list]
                 not_select_user_list_num = [self.data.user[_] for _ in not_select_user_list]
-                dropped_adj, dropped_adj_ten = self.get_client_mat(not_select_user_list_num)
+                dropped_adj, dropped_adj_ten = prefetcher.get(not_select_user_list_num)
+                if epoch + 1 < int(self.pretrain_epoch):
+                    next_user_list = list(self.data.user.keys())
+                    random.shuffle(next_user_list)
+                    prefetcher.submit([self.data.user[_] for _ in next_user_list[self.pretrain_nclient:]])
                 self.cl_rate = 1
                 cl_loss = self.cl_rate * self.cal_cl_loss(self.data, select_user_list_num, dropped_adj, dropped_adj_ten)
                 optimizer.zero_grad()
@@ -85,152 +187,334 @@ class PerFedRec_plus(GraphRecommender):
                 with torch.no_grad():
                     self.user_emb, self.item_emb = model.get_emb()
                 self.fast_evaluation(epoch)
+            prefetcher.close()
+        if Pretraining == True and self.pretrain_cache is not None:
+            self.pretrain_cache.store(*[table.cpu().numpy() for table in model.get_emb()], settings=self.pretrain_settings)
+        # pretraining evaluations do not count towards early stopping
+        if self.early_stop is not None:
+            self.early_stop.reset()
 
         optimizer = torch.optim.Adam(model.parameters(), lr=self.lRate * N_client)
 
         self.loss_list = []
+        self.upload_list = []
         self.ndcg_list = []
 
-        for epoch in range(self.maxEpoch):
+        history = HistoricalEmbedding() if self.history_rounds > 0 else None
+        simulator = BatchedClients(model, optimizer, self.reg, self.batch_size, self.batched_clients) if self.batched_clients > 0 else None
+        ldp = LDPNoise(loc, scale, N_client, self.ldp, device=model.embedding_dict['item_emb'].device, seed=int(np.random.randint(2 ** 31)))
+        self.clu_result = None
+        if self.async_buffer > 0:
+            self.train_async(model, optimizer)
+            self.user_emb, self.item_emb = self.best_user_emb, self.best_item_emb
+            return
+        start_epoch = 0
+        if resume_state is not None:
+            # before the worker pool is built, so that it starts from the restored model and optimizer state
+            start_epoch = self.restore_checkpoint(resume_state, optimizer, scheduler, clustering, ldp, history)
+        pool = ClientPool(model, optimizer, self.data, self.reg, self.batch_size, self.workers,
+                          seed=int(np.random.randint(2 ** 31)), round_adam=self.round_adam) if self.workers > 0 else None
+        shared = SharedPropagation(model) if self.shared_forward and history is None else None
+        round_adam = RoundAdam(model, optimizer) if self.round_adam else None
+        if self.client_store_path is not None:
+            # a resumed run continues with the store as it was at its checkpoint
+            snapshot = resume_state['client_store'] if resume_state is not None else None
+            if snapshot is not None:
+                ClientStateStore.restore(snapshot, self.client_store_path)
+                self.store_snapshot = snapshot
+            self.client_store = ClientStateStore(self.client_store_path, self.data.user_num, self.emb_size,
+                                                 resume=snapshot is not None)
+        # the next round's client graph is built while the current round is being evaluated
+        prefetcher = Prefetcher(self.get_client_mat)
+        for epoch in range(start_epoch, self.maxEpoch):
+            if history is not None and epoch % self.history_rounds == 0:
+                history.expire()
 
             original_params = copy.deepcopy(model.state_dict())
-            self.clu_result = None
+            aggregator = StreamingFedAvg(original_params, clip_value, self.clip_mode)
             if epoch > 40 and epoch < 180 and (epoch - 2) % 6 == 0:
                 self.cluster_client = True
             else:
                 self.cluster_client = False
 
-            self.local_model = {}
-            self.cluster_model = {}
+            self.local_model = LocalModelStore(original_params)
+            self.cluster_model = None
+            if self.cluster_client == True and epoch >= 1 and self.clu_result is not None:
+                self.cluster_model = ClusterFedAvg(original_params, n_cluster)
             losses = []
             if epoch == 0:
-                user_list = list(self.data.user.keys())
-                random.shuffle(user_list)
-                select_user_list = user_list[:N_client]
-                not_select_user_list = user_list[N_client:]
+                selected, self.select_mask = scheduler.select()
+                self.select_user_list = [self.data.id2user[_] for _ in selected]
+            select_user_list = self.select_user_list
+
+            dropped_adj, dropped_adj_ten = prefetcher.get(~self.select_mask)
+            if pool is not None:
+                client_users, client_losses, client_updates = pool.step(epoch, select_user_list)
+                losses += client_losses
+                for user, update in zip(client_users, client_updates):
+                    self.fold_update(aggregator, user, update)
+            elif simulator is not None:
+                batches = list(next_batch_pairwise_fl_pse(self.data, self.batch_size, select_user_list))
+                client_users = [user_idx[0] for user_idx, _, _ in batches]
+                client_losses, client_updates = simulator.step(batches)
+                losses += client_losses
+                for user, update in zip(client_users, client_updates):
+                    self.fold_update(aggregator, user, update)
             else:
-                select_user_list = self.select_user_list
-                not_select_user_list = self.not_select_user_list
-            select_user_list_num = [self.data.user[_] for _ in select_user_list]
-            not_select_user_list_num = [self.data.user[_] for _ in not_select_user_list]
-
-            dropped_adj, dropped_adj_ten = self.get_client_mat(not_select_user_list_num)
-            for n, batch in enumerate(next_batch_pairwise_fl_pse(self.data, self.batch_size, select_user_list)):
-                model_ini = copy.deepcopy(model.state_dict())
-                user_idx, pos_idx, neg_idx = batch
-                rec_user_emb, rec_item_emb = model(perturbed=False)
-                user_emb, pos_item_emb, neg_item_emb = rec_user_emb[user_idx], rec_item_emb[pos_idx], rec_item_emb[
-                    neg_idx]
-                batch_loss = bpr_loss(user_emb, pos_item_emb, neg_item_emb) + l2_reg_loss(self.reg, user_emb,
-                                                                                          pos_item_emb,
-                                                                                          neg_item_emb) / self.batch_size
-                optimizer.zero_grad()
-                batch_loss.backward()
-                optimizer.step()
-
-                if n % 100 == 0 and n > 0:
-                    print('training:', epoch + 1, 'batch', n, 'batch_loss:', batch_loss.item())
-                losses.append(batch_loss.item())
-                model_aft = copy.deepcopy(model.state_dict())
-                model_para_list += [model_aft]
-
-                self.local_model[user_idx[0]] = model_aft
-
-                if self.cluster_client == True and epoch >= 1:
-                    if self.clu_result is not None:
-                        w_cluster_list = self.cluster_model.get(self.clu_result[user_idx[0]], [])
-                        w_cluster_list += [model_aft]
-                        self.cluster_model[self.clu_result[user_idx[0]]] = w_cluster_list
-
-                model.load_state_dict(model_ini)
+                if shared is not None:
+                    shared.refresh()
+                if round_adam is not None:
+                    round_adam.begin()
+                client_users = []
+                for n, batch in enumerate(next_batch_pairwise_fl_pse(self.data, self.batch_size, select_user_list)):
+                    user_idx, pos_idx, neg_idx = batch
+                    if history is not None:
+                        user_emb, pos_item_emb, neg_item_emb = model.forward_batch(history, user_idx, pos_idx, neg_idx)
+                    else:
+                        rec_user_emb, rec_item_emb = shared.forward() if shared is not None else model(perturbed=False)
+                        user_emb, pos_item_emb, neg_item_emb = rec_user_emb[user_idx], rec_item_emb[pos_idx], rec_item_emb[
+                            neg_idx]
+                    batch_loss = bpr_loss(user_emb, pos_item_emb, neg_item_emb) + l2_reg_loss(self.reg, user_emb,
+                                                                                              pos_item_emb,
+                                                                                              neg_item_emb) / self.batch_size
+                    optimizer.zero_grad()
+                    if shared is not None:
+                        shared.backward(batch_loss)
+                    else:
+                        batch_loss.backward()
+                    optimizer.step()
+
+                    if n % 100 == 0 and n > 0:
+                        print('training:', epoch + 1, 'batch', n, 'batch_loss:', batch_loss.item())
+                    losses.append(batch_loss.item())
+                    # folded right away, so the round holds no more than one update at a time
+                    update = round_adam.capture(original_params) if round_adam is not None else RowDelta.capture(model, original_params)
+                    self.fold_update(aggregator, user_idx[0], update)
+                    client_users += [user_idx[0]]
+                if round_adam is not None:
+                    round_adam.end()
+
+            if self.compressor is not None:
+                self.report_upload()
+
+            if self.client_store is not None:
+                user_rows = torch.stack([self.local_model.user_row(user) for user in client_users]).cpu().numpy()
+                clusters = np.asarray(self.clu_result)[client_users] if self.clu_result is not None else None
+                self.client_store.put(client_users, user_rows, epoch, clusters)
 
             print('Avg Loss:', sum(losses) / len(losses))
             self.loss_list.append(sum(losses) / len(losses))
-            model_params_list = model_para_list
-            params_diff = []
-            for state_dict in model_params_list:
-                diff = {}
-                for key in original_params:
-                    diff[key] = state_dict[key] - original_params[key]
-                    diff[key] = torch.clamp(diff[key], min=-clip_value, max=clip_value)
-                    diff[key] = diff[key] + original_params[key]
-                params_diff.append(diff)
-            noisy_diff = params_diff
-            final_state_dict = {}
-            for key in original_params:
-                combined = torch.sum(torch.stack([diff[key] for diff in noisy_diff], dim=0), dim=0) / len(noisy_diff)
-                final_state_dict[key] = combined
-            model.load_state_dict(final_state_dict)
-
-            model_para_list = []
-            for i in self.cluster_model:
-                self.cluster_model[i] = FedAvg(self.cluster_model[i])
+            # every client's change was clipped before averaging
+            model.load_state_dict(aggregator.result())
+            if self.profile is not None:
+                # a synchronous round lasts as long as its slowest client
+                self.sim_time += self.profile.round_time(client_users)
+
+            if self.cluster_model is not None:
+                self.cluster_model.result()
             # LDP
             add_noise = True
             if add_noise:
-                i_random_noise = torch.tensor(np.random.laplace(loc=loc, scale=scale, size=(
-                N_client, rec_item_emb.shape[0], rec_item_emb.shape[1])))
-                i_random_noise = torch.mean(i_random_noise, dim=0).float().to('cuda')
+                i_random_noise = ldp.mean((self.data.item_num, self.emb_size))
                 model.add_noise_(i_random_noise)
 
             with torch.no_grad():
                 self.user_emb, self.item_emb = model.get_emb()
+            if self.cluster_drift is not None:
+                self.cluster_client = clustering.needs_refit(self.user_emb)
+            if self.cluster_client == True:
+                cluster_ids = clustering.fit(self.user_emb).cpu().numpy()
+                self.clu_result = list(cluster_ids)
+                print('cluster sizes:', np.bincount(cluster_ids, minlength=n_cluster))
+                selected, self.select_mask = scheduler.select(cluster_ids, strategy='cluster')
+            else:
+                selected, self.select_mask = scheduler.select()
+            self.select_user_list = [self.data.id2user[_] for _ in selected]
+            if epoch + 1 < self.maxEpoch:
+                prefetcher.submit(~self.select_mask)
+
             if epoch > 0 and epoch % 5 == 0:
                 measure = self.fast_evaluation(epoch)
                 measure_ndcg = measure[-1].split(':')[-1]
                 self.ndcg_list.append(measure_ndcg)
+                self.check_target(float(measure_ndcg), epoch)
 
                 if epoch > 1:
                     print('local_model')
                     self.fast_evaluation(epoch, model_type='local_model')
-
-            if self.cluster_client == True:
-                users_emb = copy.deepcopy(self.user_emb.data)
-                users_emb = users_emb.cpu().detach().numpy()
-                n_fed_client_each_round = self.N_client
-                n_client = self.data.user_num
-                kmeans = KMeans(n_clusters=n_cluster).fit(users_emb)
-                cluster_ids = kmeans.labels_
-                cluster_result = list(kmeans.labels_)
-                self.clu_result = cluster_result
-
-                sampled_ids = []
-                for c in np.unique(cluster_ids):
-                    ids = np.where(cluster_ids == c)[0]
-                    sampled_ids.extend(
-                        np.random.choice(ids, size=int(len(ids) / len(users_emb) * N_client), replace=False))
-                    print('cluster', c, ':', int(len(ids) / len(users_emb) * N_client))
-
-                idxs_users_ = list(set(sampled_ids))
-                for kk in (idxs_users_):
-                    if kk in select_user_list_num:
-                        idxs_users_.remove(kk)
-
-                while len(idxs_users_) < n_fed_client_each_round:
-                    r_ = random.sample(range(0, n_client), 1)[0]
-                    if not r_ in idxs_users_ and not r_ in select_user_list_num:
-                        idxs_users_.append(r_)
-
-                not_select_user_idxs = list(set([_ for _ in range(n_client)]) - set(idxs_users_))
-                select_user_list = [self.data.id2user[_] for _ in idxs_users_]
-                not_select_user_list = [self.data.id2user[_] for _ in not_select_user_idxs]
-
-                self.select_user_list = select_user_list
-                self.not_select_user_list = not_select_user_list
-            else:
-                user_candidate_list = list(set(self.data.user.keys()) - set(select_user_list))
-                random.shuffle(user_candidate_list)
-                select_user_list = user_candidate_list[:N_client]
-                not_select_user_list = list(set(self.data.user.keys()) - set(select_user_list))
-                self.select_user_list = select_user_list
-                self.not_select_user_list = not_select_user_list
+            if self.checkpointer is not None and self.checkpointer.due(epoch):
+                self.checkpointer.save(self.checkpoint_state(epoch, optimizer, scheduler, clustering, ldp, history))
+            if self.stop_training():
+                break
+        prefetcher.close()
+        if self.checkpointer is not None:
+            self.checkpointer.close()
+            if self.client_store is not None:
+                ClientStateStore.remove_snapshots(self.checkpointer.path + '.client_store.', self.store_snapshot)
+        if pool is not None:
+            pool.close()
+        if self.client_store is not None:
+            self.client_store.flush()
+        if self.compressor is not None:
+            self.msg += '\nupload_bytes_per_round:%d' % (sum(self.upload_list) / max(1, len(self.upload_list)))
         self.user_emb, self.item_emb = self.best_user_emb, self.best_item_emb
 
 
+    def train_async(self, model, optimizer):
+        """FedBuff-style training: maxEpoch server steps of async_buffer client updates each, on the simulated
+        clock of self.profile. Clustering is not used in this mode."""
+        state = copy.deepcopy(model.state_dict())
+        server = FedBuff(state, self.async_buffer, self.server_lr, self.staleness, self.clip_value, self.clip_mode)
+        # the LDP noise of a server step averages the noise of the clients it aggregates
+        ldp = LDPNoise(0., self.noise_scale, self.async_buffer, self.ldp, device=model.embedding_dict['item_emb'].device,
+                       seed=int(np.random.randint(2 ** 31)))
+        rng = np.random.default_rng(int(np.random.randint(2 ** 31)))
+        # personalized rows are kept against the server state of the step they arrive in
+        self.local_model = LocalModelStore(copy.deepcopy(state))
+        self.cluster_model = None
+        # with -round_adam every client of a server step starts from the optimizer state of that step
+        round_adam = RoundAdam(model, optimizer) if self.round_adam else None
+        if round_adam is not None:
+            round_adam.begin()
+
+        def clients():
+            while True:
+                users = [self.data.id2user[u] for u in rng.permutation(self.data.user_num)]
+                for batch in next_batch_pairwise_fl_pse(self.data, self.batch_size, users):
+                    yield batch[0][0], batch
+
+        def train_client(batch):
+            user_idx, pos_idx, neg_idx = batch
+            rec_user_emb, rec_item_emb = model(perturbed=False)
+            user_emb, pos_item_emb, neg_item_emb = rec_user_emb[user_idx], rec_item_emb[pos_idx], rec_item_emb[neg_idx]
+            batch_loss = bpr_loss(user_emb, pos_item_emb, neg_item_emb) + l2_reg_loss(self.reg, user_emb, pos_item_emb,
+                                                                                      neg_item_emb) / self.batch_size
+            optimizer.zero_grad()
+            batch_loss.backward()
+            optimizer.step()
+            update = round_adam.capture(server.state) if round_adam is not None else RowDelta.capture(model, server.state)
+            self.local_model.add(user_idx[0], update)
+            if self.compressor is not None:
+                update = self.compressor.compress(user_idx[0], update)
+            return batch_loss.item(), update
+
+        def on_step(version, now, losses):
+            epoch = version - 1
+            model.load_state_dict(server.state)
+            model.add_noise_(ldp.mean((self.data.item_num, self.emb_size)))
+            with torch.no_grad():
+                for key, value in model.state_dict().items():
+                    server.state[key].copy_(value)
+                self.user_emb, self.item_emb = model.get_emb()
+            if round_adam is not None:
+                round_adam.end()
+                round_adam.begin()
+            self.sim_time = now
+            print('Step', version, 'time %.1fs' % now, 'mean staleness %.2f' % server.mean_staleness(),
+                  'Avg Loss:', sum(losses) / len(losses))
+            self.loss_list.append(sum(losses) / len(losses))
+            if self.compressor is not None:
+                self.report_upload()
+            if epoch > 0 and epoch % 5 == 0:
+                measure = self.fast_evaluation(epoch)
+                measure_ndcg = measure[-1].split(':')[-1]
+                self.ndcg_list.append(measure_ndcg)
+                self.check_target(float(measure_ndcg), epoch)
+            self.local_model = LocalModelStore(copy.deepcopy(server.state))
+            return self.stop_training()
+
+        simulation = AsyncFederation(server, self.profile, train_client, clients(), self.concurrency)
+        simulation.run(self.maxEpoch, on_step)
+        if self.compressor is not None:
+            self.msg += '\nupload_bytes_per_round:%d' % (sum(self.upload_list) / max(1, len(self.upload_list)))
+
+    def fold_update(self, aggregator, user, update):
+        """Fold one client's update into the round: the (compressed) upload into the global and cluster
+        aggregates, the update itself into the client's local model."""
+        upload = self.compressor.compress(user, update) if self.compressor is not None else update
+        aggregator.add(upload)
+        self.local_model.add(user, update)
+        if self.cluster_model is not None:
+            self.cluster_model.add(upload, self.clu_result[user])
+
+    def report_upload(self):
+        """Print the upload size of the last round (or server step) and keep it for the results file."""
+        sent, raw = self.compressor.reset_counts()
+        self.upload_list.append(sent)
+        print('Upload: %.3f MB (%.3f MB uncompressed, %.1fx)' % (sent / 2 ** 20, raw / 2 ** 20, raw / max(1, sent)))
+
+    def check_target(self, ndcg, epoch):
+        """Record the simulated time at which the validation NDCG first reaches target_ndcg."""
+        if self.target_ndcg is None or self.time_to_target is not None or ndcg < self.target_ndcg:
+            return
+        self.time_to_target = self.sim_time
+        print('NDCG %.5f reached target %.5f at step %d after %.1f simulated seconds' % (ndcg, self.target_ndcg, epoch + 1, self.sim_time))
+        self.msg += '\ntime_to_target:%.1f' % self.sim_time
+
+    def checkpoint_state(self, epoch, optimizer, scheduler, clustering, ldp, history):
+        """Everything the rounds after `epoch` depend on, RNG states included. The client store is copied next to
+        the checkpoint; the copies older than the last written checkpoint are removed."""
+        if self.client_store is not None:
+            self.checkpointer.wait()
+            prefix = self.checkpointer.path + '.client_store.'
+            ClientStateStore.remove_snapshots(prefix, self.store_snapshot)
+            self.store_snapshot = prefix + str(epoch)
+            self.client_store.snapshot(self.store_snapshot)
+        clustering_generator = None if clustering.generator is None else clustering.generator.get_state()
+        return {'epoch': epoch, 'model': self.model.state_dict(), 'optimizer': optimizer.state_dict(),
+                'select_user_list': self.select_user_list, 'select_mask': self.select_mask, 'clu_result': self.clu_result,
+                'scheduler': (scheduler.rng.bit_generator.state, scheduler.mask),
+                'clustering': (clustering.centroids, clustering.labels, clustering_generator),
+                'ldp': ldp.generator.get_state(), 'history': history,
+                'best': (self.bestPerformance, getattr(self, 'best_epoch', None), self.best_snapshot.buffers,
+                         getattr(self, 'best_local_model', None)),
+                'early_stop': self.early_stop, 'loss_list': self.loss_list, 'ndcg_list': self.ndcg_list,
+                'local_model': self.local_model, 'cluster_model': self.cluster_model,
+                'upload': (None if self.compressor is None else self.compressor.residuals, self.upload_list),
+                'client_store': self.store_snapshot if self.client_store is not None else None,
+                'simulation': (self.sim_time, self.time_to_target,
+                               None if self.profile is None else self.profile.rng.bit_generator.state),
+                'rng': rng_state()}
+
+    def restore_checkpoint(self, state, optimizer, scheduler, clustering, ldp, history):
+        """Load a checkpoint_state() into the trainer and the round helpers; returns the next round."""
+        self.model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        self.select_user_list, self.select_mask, self.clu_result = state['select_user_list'], state['select_mask'], state['clu_result']
+        scheduler.rng.bit_generator.state, scheduler.mask = state['scheduler']
+        clustering.centroids, clustering.labels, clustering_generator = state['clustering']
+        if clustering_generator is not None:
+            clustering._rand_generator(clustering.centroids.device).set_state(clustering_generator)
+        ldp.generator.set_state(state['ldp'])
+        if history is not None and state['history'] is not None:
+            history.__dict__.update(state['history'].__dict__)
+        self.bestPerformance, self.best_epoch, buffers, self.best_local_model = state['best']
+        if buffers is not None:
+            self.best_snapshot.buffers = buffers
+            self.best_user_emb, self.best_item_emb = buffers
+        self.early_stop = state['early_stop']
+        self.loss_list, self.ndcg_list = state['loss_list'], state['ndcg_list']
+        self.local_model, self.cluster_model = state['local_model'], state['cluster_model']
+        residuals, self.upload_list = state['upload']
+        if self.compressor is not None and residuals is not None:
+            # the error-feedback residuals the clients carry over (at most max_residuals of them)
+            self.compressor.residuals = residuals
+        # the simulated clock, the round time draws and the time at which the target NDCG was reached
+        self.sim_time, self.time_to_target, profile_rng = state['simulation']
+        if self.profile is not None and profile_rng is not None:
+            self.profile.rng.bit_generator.state = profile_rng
+        if self.time_to_target is not None:
+            self.msg += '\ntime_to_target:%.1f' % self.time_to_target
+        with torch.no_grad():
+            self.user_emb, self.item_emb = self.model.get_emb()
+        set_rng_state(state['rng'])
+        return state['epoch'] + 1
+
     def save(self):
         with torch.no_grad():
-            self.best_user_emb, self.best_item_emb = copy.deepcopy(self.model.get_emb())
-            self.best_local_model = copy.deepcopy(self.local_model)
+            self.best_user_emb, self.best_item_emb = self.best_snapshot.take(*self.model.get_emb())
+            # a new store is built every round, so the current one can be kept as is
+            self.best_local_model = self.local_model
 
     def get_client_mat(self, drop_client_list):
         dropped_mat = None
@@ -248,23 +532,31 @@ class PerFedRec_plus(GraphRecommender):
         with torch.no_grad():
             u = self.data.get_user_id(u)
             if u in self.local_model:
-                user_emb = self.local_model[u]['embedding_dict.user_emb']
-                item_emb = self.local_model[u]['embedding_dict.item_emb']
-                score = torch.matmul(user_emb[u], item_emb.transpose(0, 1))
-                return score.cpu().numpy()
+                return self.local_model.score(u).cpu().numpy()
+            elif self.client_store is not None and self.client_store.seen(u):
+                # personalized row from the client's last round against the current global item table
+                user_row = torch.as_tensor(self.client_store.get([u])[0][0], device=self.item_emb.device)
+                return torch.matmul(self.item_emb, user_row).cpu().numpy()
             else:
                 return None
 
+    def predict_cluster(self, u):
+        with torch.no_grad():
+            u = self.data.get_user_id(u)
+            if self.cluster_model is None or self.clu_result is None:
+                return None
+            cluster = self.cluster_model.model(self.clu_result[u])
+            if cluster is None:
+                return None
+            score = torch.matmul(cluster['embedding_dict.user_emb'][u], cluster['embedding_dict.item_emb'].transpose(0, 1))
+            return score.cpu().numpy()
+
     def cal_cl_loss(self, idx, select_user_list_num, dropped_adj, dropped_adj_ten):
         cl_sampple = self.N_client
-        user_list = list(self.data.user.keys())
-        random.shuffle(user_list)
-        select_user_list = user_list[:cl_sampple]
-        select_user_list_num = [self.data.user[_] for _ in select_user_list]
         user_num = idx.user_num
         item_num = idx.item_num
-        rand_user_num = select_user_list_num
-        rand_item_num = random.sample([_ for _ in range(item_num)], cl_sampple)
+        rand_user_num = random.sample(range(user_num), cl_sampple)
+        rand_item_num = random.sample(range(item_num), cl_sampple)
         u_idx = torch.unique(torch.Tensor(rand_user_num).type(torch.long)).cuda()
         i_idx = torch.unique(torch.Tensor(rand_item_num).type(torch.long)).cuda()
         dropped_adj = self.data.interaction_mat
@@ -274,6 +566,34 @@ class PerFedRec_plus(GraphRecommender):
         item_cl_loss = InfoNCE(item_view_1[i_idx], item_view_2[i_idx], 0.2)
         return user_cl_loss + item_cl_loss
 
+    def pretrain_minibatch(self, optimizer, temperature=0.2, chunk=1024):
+        """Contrastive pretraining over mini-batches of nodes: every epoch walks a permutation of the users in
+        blocks of cl_batch (and of the items in as many blocks); each step propagates both perturbed views in
+        one pass and computes InfoNCE in chunks of negatives."""
+        model = self.model
+        device = model.embedding_dict['user_emb'].device
+        user_num, item_num = self.data.user_num, self.data.item_num
+        n_steps = -(-user_num // self.cl_batch)
+        item_batch = -(-item_num // n_steps)
+        for epoch in range(int(self.pretrain_epoch)):
+            users = torch.randperm(user_num, device=device)
+            items = torch.randperm(item_num, device=device)
+            for n in range(n_steps):
+                u_idx = users[n * self.cl_batch:(n + 1) * self.cl_batch]
+                i_idx = items[n * item_batch:(n + 1) * item_batch]
+                (user_view_1, item_view_1), (user_view_2, item_view_2) = model.perturbed_views(2)
+                cl_loss = chunked_InfoNCE(user_view_1[u_idx], user_view_2[u_idx], temperature, chunk)
+                if len(i_idx) > 0:
+                    cl_loss = cl_loss + chunked_InfoNCE(item_view_1[i_idx], item_view_2[i_idx], temperature, chunk)
+                optimizer.zero_grad()
+                cl_loss.backward()
+                optimizer.step()
+                if n % 100 == 0 and n > 0:
+                    print('pretraining:', epoch + 1, 'batch', n, 'cl_loss:', cl_loss.item())
+            with torch.no_grad():
+                self.user_emb, self.item_emb = model.get_emb()
+            self.fast_evaluation(epoch)
+
     def contrastive_augment(self, _mat):
         self.drop_rate = 0.1
         dropped_mat = None
@@ -282,7 +602,7 @@ class PerFedRec_plus(GraphRecommender):
         return TorchGraphInterface.convert_sparse_mat_to_tensor(dropped_mat).cuda()
 
 
-class PerFedRec_LGCN_Encoder(nn.Module):
+class PerFedRec_LGCN_Encoder(MixedPrecision, nn.Module):
     def __init__(self, data, emb_size, n_layers, pretrain_noise):
         super(PerFedRec_LGCN_Encoder, self).__init__()
         self.data = data
@@ -308,24 +628,60 @@ class PerFedRec_LGCN_Encoder(nn.Module):
     def add_noise_(self, noise):
         self.embedding_dict['item_emb'].data = self.embedding_dict['item_emb'].data + noise
 
+    def propagate(self, ego_embeddings):
+        """Unperturbed propagation of a stack of ego embeddings; every feature column is propagated on its own."""
+        ego_embeddings = self.to_compute(ego_embeddings)
+        adj = self.low_adj(self.sparse_norm_adj)
+        all_embeddings = []
+        for k in range(self.layers):
+            ego_embeddings = torch.sparse.mm(adj, ego_embeddings)
+            all_embeddings.append(ego_embeddings)
+        return self.layer_mean(all_embeddings)
+
+    def forward_batch(self, history, user_idx, *item_idx):
+        """Unperturbed embeddings of the batch entries, propagated exactly over their one-hop
+        neighbourhood and read from `history` beyond it."""
+        ego_embeddings = torch.cat([self.embedding_dict['user_emb'], self.embedding_dict['item_emb']], 0)
+        if history.stale():
+            history.rebuild(ego_embeddings, self.sparse_norm_adj, self.layers)
+        nodes, positions = batch_nodes(self.data.user_num, ego_embeddings.device, user_idx, *item_idx)
+        all_embeddings = propagate_batch(ego_embeddings, self.sparse_norm_adj, nodes, self.layers, history)[1:]
+        all_embeddings = torch.mean(torch.stack(all_embeddings, dim=1), dim=1)
+        return [all_embeddings[p] for p in positions]
+
+    def perturbed_views(self, n_views=2):
+        """n_views perturbed propagations in one pass: the views are stacked along the feature axis, so every
+        layer is a single sparse product, and each view draws its own noise."""
+        ego_embeddings = torch.cat([self.embedding_dict['user_emb'], self.embedding_dict['item_emb']], 0)
+        n_nodes, dim = ego_embeddings.shape
+        ego_embeddings = self.to_compute(ego_embeddings.repeat(1, n_views))
+        adj = self.low_adj(self.sparse_norm_adj)
+        all_embeddings = []
+        for k in range(self.layers):
+            ego_embeddings = torch.sparse.mm(adj, ego_embeddings)
+            random_noise = torch.rand_like(ego_embeddings).view(n_nodes, n_views, dim)
+            ego_embeddings = ego_embeddings + F.normalize(random_noise, dim=-1).view(n_nodes, -1) * self.pretrain_noise
+            all_embeddings.append(ego_embeddings)
+        all_embeddings = self.layer_mean(all_embeddings).view(n_nodes, n_views, dim)
+        return [torch.split(all_embeddings[:, v], [self.data.user_num, self.data.item_num]) for v in range(n_views)]
+
     def forward(self, perturbed=False, perturbed_adj=None):
         self.eps = self.pretrain_noise
-        ego_embeddings = torch.cat([self.embedding_dict['user_emb'], self.embedding_dict['item_emb']], 0)
+        ego_embeddings = self.to_compute(torch.cat([self.embedding_dict['user_emb'], self.embedding_dict['item_emb']], 0))
         all_embeddings = []
         for k in range(self.layers):
             if perturbed_adj is not None:
                 if isinstance(perturbed_adj, list):
-                    ego_embeddings = torch.sparse.mm(perturbed_adj[k], ego_embeddings)
+                    ego_embeddings = torch.sparse.mm(self.low_adj(perturbed_adj[k]), ego_embeddings)
                 else:
-                    ego_embeddings = torch.sparse.mm(perturbed_adj, ego_embeddings)
+                    ego_embeddings = torch.sparse.mm(self.low_adj(perturbed_adj), ego_embeddings)
             else:
-                ego_embeddings = torch.sparse.mm(self.sparse_norm_adj, ego_embeddings)
+                ego_embeddings = torch.sparse.mm(self.low_adj(self.sparse_norm_adj), ego_embeddings)
             if perturbed:
                 random_noise = torch.rand_like(ego_embeddings).cuda()
                 ego_embeddings += F.normalize(random_noise, dim=-1) * self.eps
             all_embeddings.append(ego_embeddings)
-        all_embeddings = torch.stack(all_embeddings, dim=1)
-        all_embeddings = torch.mean(all_embeddings, dim=1)
+        all_embeddings = self.layer_mean(all_embeddings)
         user_all_embeddings, item_all_embeddings = torch.split(all_embeddings, [self.data.user_num, self.data.item_num])
         return user_all_embeddings, item_all_embeddings
 
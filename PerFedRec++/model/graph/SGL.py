@@ -1,3 +1,5 @@
+import random
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -6,7 +8,8 @@ from util.conf import OptionConf
 from util.sampler import next_batch_pairwise
 from base.torch_interface import TorchGraphInterface
 from util.loss_torch import bpr_loss, l2_reg_loss, InfoNCE
-from data.augmentor import GraphAugmentor
+from data.augmentor import GraphAugmentor, TorchGraphAugmentor
+from util.prefetch import Prefetcher
 
 # Paper: self-supervised graph learning for recommendation. SIGIR'21
 
@@ -20,20 +23,34 @@ class SGL(GraphRecommender):
         drop_rate = float(args['-droprate'])
         n_layers = int(args['-n_layer'])
         temp = float(args['-temp'])
-        self.model = SGL_Encoder(self.data, self.emb_size, drop_rate, n_layers, temp, aug_type)
+        # -device_aug 1 builds the dropped graphs on the device instead of through SciPy
+        device_aug = args.contain('-device_aug') and args['-device_aug'] == '1'
+        self.model = SGL_Encoder(self.data, self.emb_size, drop_rate, n_layers, temp, aug_type, device_aug)
 
     def train(self):
         model = self.model.cuda()
         optimizer = torch.optim.Adam(model.parameters(), lr=self.lRate)
+        seed = int(np.random.randint(2 ** 31))
+
+        def dropped_views(epoch):
+            # own RNGs seeded per epoch: the producer runs next to the training loop, which draws from the global ones
+            rng = random.Random(seed + epoch)
+            generator = torch.Generator(device=model.sparse_norm_adj.device).manual_seed(seed + epoch)
+            return model.graph_reconstruction(rng, generator), model.graph_reconstruction(rng, generator)
+
+        # the dropped graphs of the next epoch are built while the current epoch trains
+        prefetcher = Prefetcher(dropped_views)
         for epoch in range(self.maxEpoch):
-            dropped_adj1 = model.graph_reconstruction()
-            dropped_adj2 = model.graph_reconstruction()
+            dropped_adj1, dropped_adj2 = prefetcher.get(epoch)
+            if epoch + 1 < self.maxEpoch:
+                prefetcher.submit(epoch + 1)
+            view_adj = model.stack_views([model.sparse_norm_adj, dropped_adj1, dropped_adj2])
             for n, batch in enumerate(next_batch_pairwise(self.data, self.batch_size)):
                 user_idx, pos_idx, neg_idx = batch
-                rec_user_emb, rec_item_emb = model()
+                (rec_user_emb, rec_item_emb), (user_view_1, item_view_1), (user_view_2, item_view_2) = model.forward_views(view_adj, 3)
                 user_emb, pos_item_emb, neg_item_emb = rec_user_emb[user_idx], rec_item_emb[pos_idx], rec_item_emb[neg_idx]
                 rec_loss = bpr_loss(user_emb, pos_item_emb, neg_item_emb)
-                cl_loss = self.cl_rate * model.cal_cl_loss([user_idx,pos_idx],dropped_adj1,dropped_adj2)
+                cl_loss = self.cl_rate * model.cal_cl_loss([user_idx,pos_idx], user_view_1, user_view_2, item_view_1, item_view_2)
                 batch_loss =  rec_loss + l2_reg_loss(self.reg, user_emb, pos_item_emb,neg_item_emb) + cl_loss
                 # Backward and optimize
                 optimizer.zero_grad()
@@ -45,6 +62,9 @@ class SGL(GraphRecommender):
                 self.user_emb, self.item_emb = self.model()
             if epoch>=5:
                 self.fast_evaluation(epoch)
+            if self.stop_training():
+                break
+        prefetcher.close()
         self.user_emb, self.item_emb = self.best_user_emb, self.best_item_emb
 
     def save(self):
@@ -58,7 +78,7 @@ class SGL(GraphRecommender):
 
 
 class SGL_Encoder(nn.Module):
-    def __init__(self, data, emb_size, drop_rate, n_layers, temp, aug_type):
+    def __init__(self, data, emb_size, drop_rate, n_layers, temp, aug_type, device_aug=False):
         super(SGL_Encoder, self).__init__()
         self.data = data
         self.drop_rate = drop_rate
@@ -69,6 +89,7 @@ class SGL_Encoder(nn.Module):
         self.norm_adj = data.norm_adj
         self.embedding_dict = self._init_model()
         self.sparse_norm_adj = TorchGraphInterface.convert_sparse_mat_to_tensor(self.norm_adj).cuda()
+        self.augmentor = TorchGraphAugmentor(data.interaction_mat, self.sparse_norm_adj.device) if device_aug else None
 
     def _init_model(self):
         initializer = nn.init.xavier_uniform_
@@ -78,21 +99,26 @@ class SGL_Encoder(nn.Module):
         })
         return embedding_dict
 
-    def graph_reconstruction(self):
-        if self.aug_type==0 or 1:
-            dropped_adj = self.random_graph_augment()
+    def graph_reconstruction(self, rng=random, generator=None):
+        """rng (a random.Random) draws the SciPy views, generator (a torch.Generator) the on-device ones."""
+        if self.aug_type in [0, 1]:
+            dropped_adj = self.random_graph_augment(rng, generator)
         else:
             dropped_adj = []
             for k in range(self.n_layers):
-                dropped_adj.append(self.random_graph_augment())
+                dropped_adj.append(self.random_graph_augment(rng, generator))
         return dropped_adj
 
-    def random_graph_augment(self):
+    def random_graph_augment(self, rng=random, generator=None):
+        if self.augmentor is not None:
+            if self.aug_type == 0:
+                return self.augmentor.node_dropout(self.drop_rate, generator)
+            return self.augmentor.edge_dropout(self.drop_rate, generator)
         dropped_mat = None
         if self.aug_type == 0:
-            dropped_mat = GraphAugmentor.node_dropout(self.data.interaction_mat, self.drop_rate)
+            dropped_mat = GraphAugmentor.node_dropout(self.data.interaction_mat, self.drop_rate, rng)
         elif self.aug_type == 1 or self.aug_type == 2:
-            dropped_mat = GraphAugmentor.edge_dropout(self.data.interaction_mat, self.drop_rate)
+            dropped_mat = GraphAugmentor.edge_dropout(self.data.interaction_mat, self.drop_rate, rng)
         dropped_mat = self.data.convert_to_laplacian_mat(dropped_mat)
         return TorchGraphInterface.convert_sparse_mat_to_tensor(dropped_mat).cuda()
 
@@ -113,11 +139,33 @@ class SGL_Encoder(nn.Module):
         user_all_embeddings, item_all_embeddings = torch.split(all_embeddings, [self.data.user_num, self.data.item_num])
         return user_all_embeddings, item_all_embeddings
 
-    def cal_cl_loss(self, idx, perturbed_mat1, perturbed_mat2):
+    def stack_views(self, adjs):
+        """Merge the adjacency of every view (a matrix or a per-layer list) into one block-diagonal
+        matrix, or one per layer, so that forward_views propagates all views with a single matmul."""
+        if any(isinstance(adj, list) for adj in adjs):
+            return [TorchGraphInterface.sparse_block_diag([adj[k] if isinstance(adj, list) else adj for adj in adjs])
+                    for k in range(self.n_layers)]
+        return TorchGraphInterface.sparse_block_diag(adjs)
+
+    def forward_views(self, view_adj, n_views):
+        """Embeddings of every view stacked in view_adj, in the order given to stack_views."""
+        ego_embeddings = torch.cat([self.embedding_dict['user_emb'], self.embedding_dict['item_emb']], 0)
+        ego_embeddings = ego_embeddings.repeat(n_views, 1)
+        all_embeddings = [ego_embeddings]
+        for k in range(self.n_layers):
+            if isinstance(view_adj, list):
+                ego_embeddings = torch.sparse.mm(view_adj[k], ego_embeddings)
+            else:
+                ego_embeddings = torch.sparse.mm(view_adj, ego_embeddings)
+            all_embeddings.append(ego_embeddings)
+        all_embeddings = torch.stack(all_embeddings, dim=1)
+        all_embeddings = torch.mean(all_embeddings, dim=1)
+        views = torch.split(all_embeddings, self.data.user_num + self.data.item_num)
+        return [torch.split(view, [self.data.user_num, self.data.item_num]) for view in views]
+
+    def cal_cl_loss(self, idx, user_view_1, user_view_2, item_view_1, item_view_2):
         u_idx = torch.unique(torch.Tensor(idx[0]).type(torch.long)).cuda()
         i_idx = torch.unique(torch.Tensor(idx[1]).type(torch.long)).cuda()
-        user_view_1, item_view_1 = self.forward(perturbed_mat1)
-        user_view_2, item_view_2 = self.forward(perturbed_mat2)
         view1 = torch.cat((user_view_1[u_idx],item_view_1[i_idx]),0)
         view2 = torch.cat((user_view_2[u_idx],item_view_2[i_idx]),0)
         # user_cl_loss = InfoNCE(user_view_1[u_idx], user_view_2[u_idx], self.temp)
@@ -25,10 +25,10 @@ class SimGCL(GraphRecommender):
         for epoch in range(self.maxEpoch):
             for n, batch in enumerate(next_batch_pairwise(self.data, self.batch_size)):
                 user_idx, pos_idx, neg_idx = batch
-                rec_user_emb, rec_item_emb = model()
+                (rec_user_emb, rec_item_emb), (user_view_1, item_view_1), (user_view_2, item_view_2) = model.forward_views((False, True, True))
                 user_emb, pos_item_emb, neg_item_emb = rec_user_emb[user_idx], rec_item_emb[pos_idx], rec_item_emb[neg_idx]
                 rec_loss = bpr_loss(user_emb, pos_item_emb, neg_item_emb)
-                cl_loss = self.cl_rate * self.cal_cl_loss([user_idx,pos_idx])
+                cl_loss = self.cl_rate * self.cal_cl_loss([user_idx,pos_idx], user_view_1, user_view_2, item_view_1, item_view_2)
                 batch_loss =  rec_loss + l2_reg_loss(self.reg, user_emb, pos_item_emb) + cl_loss
                 # Backward and optimize
                 optimizer.zero_grad()
@@ -39,13 +39,13 @@ class SimGCL(GraphRecommender):
             with torch.no_grad():
                 self.user_emb, self.item_emb = self.model()
             self.fast_evaluation(epoch)
+            if self.stop_training():
+                break
         self.user_emb, self.item_emb = self.best_user_emb, self.best_item_emb
 
-    def cal_cl_loss(self, idx):
+    def cal_cl_loss(self, idx, user_view_1, user_view_2, item_view_1, item_view_2):
         u_idx = torch.unique(torch.Tensor(idx[0]).type(torch.long)).cuda()
         i_idx = torch.unique(torch.Tensor(idx[1]).type(torch.long)).cuda()
-        user_view_1, item_view_1 = self.model(perturbed=True)
-        user_view_2, item_view_2 = self.model(perturbed=True)
         user_cl_loss = InfoNCE(user_view_1[u_idx], user_view_2[u_idx], 0.2)
         item_cl_loss = InfoNCE(item_view_1[i_idx], item_view_2[i_idx], 0.2)
         return user_cl_loss + item_cl_loss
@@ -92,3 +92,24 @@ class SimGCL_Encoder(nn.Module):
         all_embeddings = torch.mean(all_embeddings, dim=1)
         user_all_embeddings, item_all_embeddings = torch.split(all_embeddings, [self.data.user_num, self.data.item_num])
         return user_all_embeddings, item_all_embeddings
+
+    def forward_views(self, perturbed=(False, True, True)):
+        """Propagate several views at once: the views share the adjacency, so they are stacked along the
+        feature axis and every layer is a single sparse matmul. perturbed[v] adds noise to view v."""
+        n_views = len(perturbed)
+        ego_embeddings = torch.cat([self.embedding_dict['user_emb'], self.embedding_dict['item_emb']], 0)
+        ego_embeddings = ego_embeddings.repeat(1, n_views)
+        noise_mask = torch.tensor(perturbed, dtype=ego_embeddings.dtype, device=ego_embeddings.device).view(1, n_views, 1)
+        all_embeddings = []
+        for k in range(self.n_layers):
+            ego_embeddings = torch.sparse.mm(self.sparse_norm_adj, ego_embeddings)
+            if any(perturbed):
+                views = ego_embeddings.view(-1, n_views, self.emb_size)
+                random_noise = torch.rand_like(views)
+                views = views + torch.sign(views) * F.normalize(random_noise, dim=-1) * self.eps * noise_mask
+                ego_embeddings = views.view(-1, n_views * self.emb_size)
+            all_embeddings.append(ego_embeddings)
+        all_embeddings = torch.stack(all_embeddings, dim=1)
+        all_embeddings = torch.mean(all_embeddings, dim=1)
+        views = torch.split(all_embeddings, self.emb_size, dim=1)
+        return [torch.split(view, [self.data.user_num, self.data.item_num]) for view in views]
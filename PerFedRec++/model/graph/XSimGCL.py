@@ -41,6 +41,8 @@ class XSimGCL(GraphRecommender):
             with torch.no_grad():
                 self.user_emb, self.item_emb = self.model()
             self.fast_evaluation(epoch)
+            if self.stop_training():
+                break
         self.user_emb, self.item_emb = self.best_user_emb, self.best_item_emb
 
     def cal_cl_loss(self, idx, user_view1,user_view2,item_view1,item_view2):
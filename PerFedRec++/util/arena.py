@@ -0,0 +1,37 @@
+import torch
+
+
+class ParameterArena(object):
+    """Layout of a set of named parameters in one flat 1-D vector, with a named slice per parameter.
+    Client deltas, clipping and averaging then run as single vectorized ops over a flat vector or a
+    (clients x params) matrix instead of per-key loops."""
+    def __init__(self, state):
+        self.keys = list(state.keys())
+        self.shapes = [state[key].shape for key in self.keys]
+        self.sizes = [state[key].numel() for key in self.keys]
+        self.offsets = dict(zip(self.keys, [sum(self.sizes[:k]) for k in range(len(self.keys))]))
+        self.numel = sum(self.sizes)
+        self.device = state[self.keys[0]].device
+        self.dtype = state[self.keys[0]].dtype
+
+    def zeros(self, *leading):
+        return torch.zeros(*leading, self.numel, device=self.device, dtype=self.dtype)
+
+    def flatten(self, state):
+        return torch.cat([state[key].reshape(-1) for key in self.keys])
+
+    def unflatten(self, flat):
+        """Named views of a flat vector, shaped like the parameters."""
+        return {key: flat[..., self.offsets[key]:self.offsets[key] + size].view(*flat.shape[:-1], *shape)
+                for key, size, shape in zip(self.keys, self.sizes, self.shapes)}
+
+    @staticmethod
+    def clip(deltas, clip_value, mode='coordinate'):
+        """Clip flat deltas in place, either every coordinate to [-clip_value, clip_value] or, with mode 'l2',
+        every client's (last axis) L2 norm to clip_value."""
+        if mode == 'coordinate':
+            return deltas.clamp_(min=-clip_value, max=clip_value)
+        if mode == 'l2':
+            norm = torch.linalg.vector_norm(deltas, dim=-1, keepdim=True)
+            return deltas.mul_(torch.clamp(clip_value / (norm + 1e-12), max=1.))
+        raise ValueError('unknown clipping mode %s' % mode)
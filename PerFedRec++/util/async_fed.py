@@ -0,0 +1,175 @@
+import asyncio
+import heapq
+import math
+import numpy as np
+import torch
+from util.federated import StreamingFedAvg
+
+
+def staleness_weight(staleness, mode='sqrt'):
+    """Down-weighting of an update computed `staleness` server steps ago: sqrt (1/sqrt(1+s), as in FedBuff),
+    linear (1/(1+s)) or none."""
+    if mode == 'sqrt':
+        return 1. / math.sqrt(1. + staleness)
+    if mode == 'linear':
+        return 1. / (1. + staleness)
+    if mode == 'none':
+        return 1.
+    raise ValueError('unknown staleness weighting %s' % mode)
+
+
+class ClientProfile(object):
+    """Simulated device heterogeneity. Every client gets a fixed speed factor (lognormal with `sigma`; a
+    `stragglers` fraction of the clients is `slowdown` times slower), and every task takes
+    compute * speed * lognormal jitter plus an exponential network latency of mean `latency` (in seconds)."""
+    def __init__(self, n_users, compute=1., sigma=0.5, latency=0.2, stragglers=0., slowdown=10., seed=None):
+        self.rng = np.random.default_rng(seed)
+        self.compute = compute
+        self.sigma = sigma
+        self.latency = latency
+        self.speed = self.rng.lognormal(0., sigma, n_users)
+        self.speed[self.rng.random(n_users) < stragglers] *= slowdown
+
+    def duration(self, user):
+        jitter = self.rng.lognormal(0., self.sigma / 2)
+        return self.compute * self.speed[user] * jitter + self.rng.exponential(self.latency)
+
+    def round_time(self, users):
+        """Time of a synchronous round: the slowest of its clients."""
+        return max(self.duration(user) for user in users)
+
+
+class VirtualClock(object):
+    """Simulated time for asyncio tasks: sleep() returns a future that advance() resolves in wake-up order,
+    moving `now` forward instead of waiting for real time to pass."""
+    def __init__(self):
+        self.now = 0.
+        self.sleepers = []
+        self.count = 0
+
+    def sleep(self, delay):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.sleepers, (self.now + delay, self.count, future))
+        self.count += 1
+        return future
+
+    async def advance(self):
+        """Let the ready tasks run up to their next sleep, then wake the earliest sleeper and let it run.
+        False when no task is asleep."""
+        await asyncio.sleep(0)
+        if len(self.sleepers) == 0:
+            return False
+        self.now, _, future = heapq.heappop(self.sleepers)
+        if not future.cancelled():
+            future.set_result(None)
+        await asyncio.sleep(0)
+        return True
+
+
+class FedBuff(object):
+    """Buffered asynchronous aggregation: client updates (RowDelta against the server state they started from)
+    are folded into a running sum weighted by their staleness, and every `buffer_size` updates the server steps
+    state += server_lr * sum / buffer_size. `state` is the live server state and is updated in place."""
+    def __init__(self, state, buffer_size, server_lr=1., staleness='sqrt', clip_value=None, clip='coordinate'):
+        self.state = state
+        self.buffer_size = buffer_size
+        self.server_lr = server_lr
+        self.staleness = staleness
+        self.clip_value = clip_value
+        self.clip = clip
+        self.version = 0
+        self.received = 0
+        self.staleness_sum = 0
+        self.buffer = self._new_buffer()
+
+    def _new_buffer(self):
+        return StreamingFedAvg(self.state, self.clip_value, self.clip)
+
+    def receive(self, update, version):
+        """Buffer the update of a client that started from server step `version`; True if it triggered a step."""
+        staleness = self.version - version
+        self.buffer.add(update, staleness_weight(staleness, self.staleness))
+        self.received += 1
+        self.staleness_sum += staleness
+        if self.received % self.buffer_size != 0:
+            return False
+        self.buffer.fold_shared()
+        with torch.no_grad():
+            flat = self.buffer.arena.flatten(self.state) + self.buffer.total * (self.server_lr / self.buffer_size)
+            for key, value in self.buffer.arena.unflatten(flat).items():
+                self.state[key].copy_(value)
+        self.version += 1
+        self.buffer = self._new_buffer()
+        return True
+
+    def mean_staleness(self):
+        return self.staleness_sum / max(1, self.received)
+
+
+class AsyncFederation(object):
+    """Asynchronous federated training simulated with asyncio tasks on a virtual clock.
+    `concurrency` clients are in flight at any time. A client trains from the server state at dispatch
+    (train(batch) returns its loss and RowDelta and leaves the server state unchanged), takes the simulated
+    time of its profile to compute and upload, and hands its update to the FedBuff server; a new client is
+    dispatched as soon as one finishes, so slow clients never hold up the others.
+    `clients` yields (user, batch) pairs; on_step(version, now, losses) is called after every server step and
+    may return True to stop."""
+    def __init__(self, server, profile, train, clients, concurrency):
+        self.server = server
+        self.profile = profile
+        self.train = train
+        self.clients = clients
+        self.concurrency = concurrency
+        self.clock = VirtualClock()
+        self.in_flight = set()
+        self.losses = []
+        self.stopped = False
+
+    async def _client(self, user, batch, on_step):
+        version = self.server.version
+        loss, update = self.train(batch)
+        await self.clock.sleep(self.profile.duration(user))
+        self.in_flight.discard(user)
+        self.losses.append(loss)
+        if self.server.receive(update, version) and not self.stopped:
+            if on_step(self.server.version, self.clock.now, self.losses):
+                self.stopped = True
+            self.losses = []
+
+    def _next_client(self):
+        """The next client that is not in flight, or None once the clients repeat without a free one."""
+        skipped = set()
+        for user, batch in self.clients:
+            if user not in self.in_flight:
+                return user, batch
+            if user in skipped:
+                return None
+            skipped.add(user)
+        return None
+
+    async def _run(self, n_steps, on_step):
+        tasks = []
+        while self.server.version < n_steps and not self.stopped:
+            while len(self.in_flight) < self.concurrency:
+                client = self._next_client()
+                if client is None:
+                    break
+                self.in_flight.add(client[0])
+                tasks.append(asyncio.ensure_future(self._client(client[0], client[1], on_step)))
+            awake = await self.clock.advance()
+            for task in tasks:
+                if task.done():
+                    # re-raise the error of a failed client
+                    task.result()
+            tasks = [task for task in tasks if not task.done()]
+            if not awake:
+                break
+        # updates still in flight are dropped
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def run(self, n_steps, on_step):
+        """Simulate until the server has taken n_steps steps (or on_step asks to stop); returns the clock."""
+        asyncio.run(self._run(n_steps, on_step))
+        return self.clock.now
@@ -0,0 +1,66 @@
+import os
+import copy
+import random
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+
+
+def rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class Checkpointer(object):
+    """Periodic training checkpoints written in a background thread.
+    save() copies the state on the calling thread (so training can go on modifying it) and hands the copy to a
+    single writer thread, which writes a temporary file, fsyncs it and renames it over the checkpoint: a crash
+    mid-write leaves the previous checkpoint intact. At most one write is in flight."""
+    def __init__(self, path, every=10):
+        self.path = path
+        self.every = every
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def due(self, epoch):
+        return self.every > 0 and (epoch + 1) % self.every == 0
+
+    def save(self, state):
+        state = copy.deepcopy(state)
+        self.wait()
+        self.pending = self.executor.submit(self._write, state)
+
+    def _write(self, state):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def wait(self):
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        return torch.load(self.path, weights_only=False)
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
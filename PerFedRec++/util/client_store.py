@@ -0,0 +1,131 @@
+import os
+import glob
+import shutil
+from collections import OrderedDict
+import numpy as np
+
+
+class ClientStateStore(object):
+    """Per-client state kept across rounds: the personalized user row, the last round the client took part in
+    and its cluster id. The rows live in a memory-mapped .npy file under `path` with an LRU tier of at most
+    `capacity` rows in memory; changed rows are written back when evicted or on flush(). An existing directory
+    with the same shape is resumed from the stored state with `resume`, and cleared otherwise, so that a new
+    run never sees the clients of an earlier one. snapshot() copies the tables next to a training checkpoint and
+    restore() puts them back, so that a resumed run sees the store as it was at the checkpoint."""
+    tables = ['rows.npy', 'last_round.npy', 'cluster.npy']
+
+    def __init__(self, path, n_users, dim, capacity=65536, dtype=np.float32, resume=False):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.capacity = capacity
+        self.rows = self._open(os.path.join(path, 'rows.npy'), (n_users, dim), dtype, 0, resume)
+        self.last_round = self._open(os.path.join(path, 'last_round.npy'), (n_users,), np.int64, -1, resume)
+        self.cluster = self._open(os.path.join(path, 'cluster.npy'), (n_users,), np.int64, -1, resume)
+        # user -> [row, last round, cluster, dirty]; the metadata travels with the row, so that the disk never
+        # holds the round of a row it does not hold
+        self.cache = OrderedDict()
+
+    @staticmethod
+    def _open(file, shape, dtype, fill, resume):
+        if os.path.exists(file):
+            table = np.lib.format.open_memmap(file, mode='r+')
+            if table.shape == shape and table.dtype == dtype:
+                if not resume:
+                    table[:] = fill
+                return table
+        table = np.lib.format.open_memmap(file, mode='w+', dtype=dtype, shape=shape)
+        table[:] = fill
+        return table
+
+    def seen(self, users):
+        return self.get_meta(users)[0] >= 0
+
+    def get_meta(self, users):
+        """Last rounds and cluster ids of the given users, without loading their rows."""
+        users = np.asarray(users, dtype=np.int64).reshape(-1)
+        last_round, cluster = np.array(self.last_round[users]), np.array(self.cluster[users])
+        for k, user in enumerate(users.tolist()):
+            entry = self.cache.get(user)
+            if entry is not None:
+                last_round[k], cluster[k] = entry[1], entry[2]
+        return last_round, cluster
+
+    def get(self, users):
+        """Rows, last rounds and cluster ids of the given users (rows of unseen users are zero)."""
+        users = np.asarray(users, dtype=np.int64).reshape(-1)
+        missing = np.asarray([k for k, user in enumerate(users.tolist()) if user not in self.cache], dtype=np.int64)
+        if len(missing) > 0:
+            rows = self.rows[users[missing]]
+            last_round, cluster = self.last_round[users[missing]], self.cluster[users[missing]]
+            for k, row, round_id, cluster_id in zip(users[missing].tolist(), rows, last_round.tolist(), cluster.tolist()):
+                self.cache[k] = [row.copy(), round_id, cluster_id, False]
+        out = np.empty((len(users), self.rows.shape[1]), dtype=self.rows.dtype)
+        last_round = np.empty(len(users), dtype=np.int64)
+        cluster = np.empty(len(users), dtype=np.int64)
+        for k, user in enumerate(users.tolist()):
+            self.cache.move_to_end(user)
+            out[k], last_round[k], cluster[k], _ = self.cache[user]
+        self._evict()
+        return out, last_round, cluster
+
+    def put(self, users, rows, round_id=None, clusters=None):
+        """Store the rows of the given users; round_id and clusters update their metadata."""
+        users = np.asarray(users, dtype=np.int64).reshape(-1)
+        rows = np.asarray(rows, dtype=self.rows.dtype).reshape(len(users), -1)
+        last_round, cluster = self.get_meta(users)
+        if round_id is not None:
+            last_round[:] = round_id
+        if clusters is not None:
+            cluster[:] = clusters
+        for user, row, round_id, cluster_id in zip(users.tolist(), rows, last_round.tolist(), cluster.tolist()):
+            self.cache[user] = [row.copy(), round_id, cluster_id, True]
+            self.cache.move_to_end(user)
+        self._evict()
+
+    def _write(self, dirty):
+        """Write (user, entry) pairs to disk, rows and metadata together."""
+        if dirty:
+            users = [user for user, _ in dirty]
+            self.rows[users] = np.stack([entry[0] for _, entry in dirty])
+            self.last_round[users] = [entry[1] for _, entry in dirty]
+            self.cluster[users] = [entry[2] for _, entry in dirty]
+            for _, entry in dirty:
+                entry[3] = False
+
+    def _evict(self):
+        dirty = []
+        while len(self.cache) > self.capacity:
+            user, entry = self.cache.popitem(last=False)
+            if entry[3]:
+                dirty.append((user, entry))
+        self._write(dirty)
+
+    def flush(self):
+        self._write([(user, entry) for user, entry in self.cache.items() if entry[3]])
+        for table in (self.rows, self.last_round, self.cluster):
+            table.flush()
+
+    def snapshot(self, target):
+        """Flush and copy the tables into the directory `target`, written under a temporary name first."""
+        self.flush()
+        tmp = target + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for name in self.tables:
+            shutil.copyfile(os.path.join(self.path, name), os.path.join(tmp, name))
+        shutil.rmtree(target, ignore_errors=True)
+        os.replace(tmp, target)
+
+    @staticmethod
+    def restore(snapshot, path):
+        """Replace the tables under `path` by those of a snapshot; open the store with resume afterwards."""
+        os.makedirs(path, exist_ok=True)
+        for name in ClientStateStore.tables:
+            shutil.copyfile(os.path.join(snapshot, name), os.path.join(path, name))
+
+    @staticmethod
+    def remove_snapshots(prefix, keep):
+        """Delete the snapshot directories named prefix* except `keep`."""
+        for directory in glob.glob(glob.escape(prefix) + '*'):
+            if directory != keep:
+                shutil.rmtree(directory, ignore_errors=True)
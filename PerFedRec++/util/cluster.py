@@ -0,0 +1,71 @@
+import torch
+
+
+class MiniBatchKMeans(object):
+    """Mini-batch KMeans in torch, run on the device of the embeddings.
+    Every fit() warm-starts from the previous centroids (k-means++ seeding only the first time), and drift()
+    measures how far the centroids implied by the current embeddings have moved from the fitted ones, so the
+    caller can re-cluster only when the clusters actually changed."""
+    def __init__(self, n_clusters, batch_size=1024, n_iter=50, drift_threshold=0.1, seed=None):
+        self.n_clusters = n_clusters
+        self.batch_size = batch_size
+        self.n_iter = n_iter
+        self.drift_threshold = drift_threshold
+        self.seed = seed
+        self.generator = None
+        self.centroids = None
+        self.labels = None
+
+    def _rand_generator(self, device):
+        if self.generator is None:
+            self.generator = torch.Generator(device=device)
+            if self.seed is None:
+                self.generator.seed()
+            else:
+                self.generator.manual_seed(self.seed)
+        return self.generator
+
+    def _init_centroids(self, x):
+        generator = self._rand_generator(x.device)
+        first = torch.randint(len(x), (1,), generator=generator, device=x.device)
+        centroids = x[first]
+        for _ in range(1, self.n_clusters):
+            dist = torch.cdist(x, centroids).min(dim=1).values.pow(2)
+            weights = dist if dist.sum() > 0 else torch.ones_like(dist)
+            centroids = torch.cat([centroids, x[torch.multinomial(weights, 1, generator=generator)]])
+        return centroids
+
+    def assign(self, x):
+        return torch.cdist(x, self.centroids).argmin(dim=1)
+
+    def fit(self, x):
+        """Update the centroids with n_iter mini-batches of x and return the labels of every row."""
+        x = x.detach()
+        generator = self._rand_generator(x.device)
+        if self.centroids is None:
+            self.centroids = self._init_centroids(x)
+        counts = torch.zeros(self.n_clusters, device=x.device)
+        for _ in range(self.n_iter):
+            batch = x[torch.randint(len(x), (min(self.batch_size, len(x)),), generator=generator, device=x.device)]
+            labels = self.assign(batch)
+            batch_counts = torch.bincount(labels, minlength=self.n_clusters).float()
+            sums = torch.zeros_like(self.centroids).index_add_(0, labels, batch)
+            counts += batch_counts
+            # per-centre learning rate 1 / count, i.e. every centre is the running mean of its samples
+            self.centroids += (sums - batch_counts.unsqueeze(1) * self.centroids) / counts.clamp(min=1).unsqueeze(1)
+        self.labels = self.assign(x)
+        return self.labels
+
+    def drift(self, x):
+        """Relative distance between the fitted centroids and the means of the current assignment of x."""
+        if self.centroids is None:
+            return float('inf')
+        x = x.detach()
+        labels = self.assign(x)
+        counts = torch.bincount(labels, minlength=self.n_clusters).float().unsqueeze(1)
+        means = torch.zeros_like(self.centroids).index_add_(0, labels, x)
+        means = torch.where(counts > 0, means / counts.clamp(min=1), self.centroids)
+        return float(torch.linalg.norm(means - self.centroids) / (torch.linalg.norm(self.centroids) + 1e-12))
+
+    def needs_refit(self, x):
+        return self.drift(x) > self.drift_threshold
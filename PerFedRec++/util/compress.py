@@ -0,0 +1,254 @@
+import math
+from collections import OrderedDict
+import torch
+from util.federated import RowDelta
+
+# bytes of a row or entry index on the wire (int32)
+INDEX_BYTES = 4
+
+
+def merge_rows(rows_a, values_a, rows_b, values_b):
+    """Sum of two row-sparse tensors over the union of their rows."""
+    rows, inverse = torch.unique(torch.cat([rows_a, rows_b]), return_inverse=True)
+    values = torch.zeros((len(rows),) + tuple(values_a.shape[1:]), device=values_a.device, dtype=values_a.dtype)
+    values.index_add_(0, inverse, torch.cat([values_a, values_b]))
+    return rows, values
+
+
+def row_view(values):
+    """values as a (rows x entries) matrix, also when there are no rows."""
+    return values.reshape(values.shape[0], math.prod(values.shape[1:]))
+
+
+def pack_bits(bits):
+    """Pack a flat bool tensor into uint8, 8 entries per byte."""
+    padded = torch.zeros(math.ceil(len(bits) / 8) * 8, dtype=torch.uint8, device=bits.device)
+    padded[:len(bits)] = bits
+    weights = 2 ** torch.arange(8, dtype=torch.uint8, device=bits.device)
+    return (padded.view(-1, 8) * weights).sum(dim=1).to(torch.uint8)
+
+
+def unpack_bits(packed, n):
+    shifts = torch.arange(8, dtype=torch.uint8, device=packed.device)
+    return ((packed.unsqueeze(1) >> shifts) & 1).flatten()[:n].bool()
+
+
+class CompressedDelta(object):
+    """Upload of one client: the codec payload of every parameter. add_to() decodes a payload only over the
+    rows (or entries) it carries and scatters it straight into the aggregation buffer, so no dense copy of
+    the client's update is ever built. Clipping happens on the client before encoding.
+    `shared` is the round's dense drift of the RowDelta (times `shared_scale` after L2 clipping); the server
+    computes it from its own optimizer state, so it is referenced rather than encoded and not counted as sent."""
+    compressed = True
+
+    def __init__(self, codec, payloads, shared=None, shared_scale=1.):
+        self.codec = codec
+        self.payloads = payloads
+        self.shared = shared
+        self.shared_scale = shared_scale
+
+    def add_rows_to(self, state, scale=1.):
+        """Scatter the payloads only; the shared drift is left to the caller."""
+        for key, payload in self.payloads.items():
+            self.codec.scatter(state[key], payload, scale)
+        return state
+
+    def add_to(self, state, scale=1.):
+        if self.shared is not None:
+            for key in self.payloads:
+                state[key].add_(self.shared[key], alpha=scale * self.shared_scale)
+        return self.add_rows_to(state, scale)
+
+    def to_delta(self):
+        """The decoded update as a RowDelta."""
+        rows, values = {}, {}
+        for key, payload in self.payloads.items():
+            rows[key], values[key] = self.codec.decode(payload)
+        shared = self.shared
+        if shared is not None and self.shared_scale != 1.:
+            shared = {key: value * self.shared_scale for key, value in shared.items()}
+        return RowDelta(rows, values, shared)
+
+    def nbytes(self):
+        return sum(self.codec.nbytes(payload) for payload in self.payloads.values())
+
+
+class Codec(object):
+    """Encodes the changed rows of one parameter (rows, values) into a payload and back."""
+    def compress(self, delta, shared_scale=1.):
+        """Encodes the client's own rows; a shared drift is passed through as is."""
+        return CompressedDelta(self, {key: self.encode(delta.rows[key], delta.values[key]) for key in delta.rows},
+                               delta.shared, shared_scale)
+
+    def scatter(self, table, payload, scale):
+        rows, values = self.decode(payload)
+        table.index_add_(0, rows, values.to(table.dtype), alpha=scale)
+
+
+class TopKRows(Codec):
+    """Keeps the `ratio` fraction of the changed rows with the largest L2 norm, in fp32."""
+    def __init__(self, ratio):
+        self.ratio = ratio
+
+    def encode(self, rows, values):
+        k = min(len(rows), max(1, math.ceil(self.ratio * len(rows))))
+        keep = torch.topk(row_view(values).norm(dim=1), k).indices
+        return rows[keep], values[keep]
+
+    def decode(self, payload):
+        return payload
+
+    def nbytes(self, payload):
+        rows, values = payload
+        return rows.numel() * INDEX_BYTES + values.numel() * values.element_size()
+
+
+class TopKElements(Codec):
+    """Keeps the `ratio` fraction of the changed entries with the largest magnitude, as (row, column) entries."""
+    def __init__(self, ratio):
+        self.ratio = ratio
+
+    def encode(self, rows, values):
+        flat = values.reshape(-1)
+        k = min(len(flat), max(1, math.ceil(self.ratio * len(flat))))
+        keep = torch.topk(flat.abs(), k).indices
+        width = math.prod(values.shape[1:])
+        return rows[keep // width], keep % width, flat[keep], width
+
+    def decode(self, payload):
+        entry_rows, columns, entries, width = payload
+        rows, inverse = torch.unique(entry_rows, return_inverse=True)
+        values = torch.zeros(len(rows), width, device=entries.device, dtype=entries.dtype)
+        values[inverse, columns] = entries
+        return rows, values
+
+    def scatter(self, table, payload, scale):
+        entry_rows, columns, entries, width = payload
+        table.view(-1).index_add_(0, entry_rows * width + columns, entries.to(table.dtype), alpha=scale)
+
+    def nbytes(self, payload):
+        entry_rows, columns, entries, _ = payload
+        return entries.numel() * (INDEX_BYTES + entries.element_size())
+
+
+class StochasticQuantizer(Codec):
+    """Quantizes every changed row to `bits` (8 or 4) signed levels of its max magnitude with stochastic
+    rounding, which keeps the decoded row unbiased. 4-bit levels are packed two per byte."""
+    def __init__(self, bits=8):
+        if bits not in [4, 8]:
+            raise ValueError('only 8 and 4 bit quantization are supported')
+        self.bits = bits
+        self.levels = 2 ** (bits - 1) - 1
+
+    def encode(self, rows, values):
+        shape = values.shape
+        values = row_view(values)
+        scale = values.abs().max(dim=1, keepdim=True).values.clamp(min=1e-12) / self.levels
+        scaled = values / scale
+        q = torch.floor(scaled + torch.rand_like(scaled)).clamp_(-self.levels, self.levels).to(torch.int8)
+        if self.bits == 4:
+            nibbles = (q.flatten() + 8).to(torch.uint8)
+            if len(nibbles) % 2 == 1:
+                nibbles = torch.cat([nibbles, nibbles.new_zeros(1)])
+            q = nibbles[0::2] | (nibbles[1::2] << 4)
+        return rows, q, scale.squeeze(1), shape
+
+    def decode(self, payload):
+        rows, q, scale, shape = payload
+        if self.bits == 4:
+            q = torch.stack([q & 15, q >> 4], dim=1).flatten()[:math.prod(shape)].to(torch.int8) - 8
+        values = q.reshape(len(rows), math.prod(shape[1:])).float() * scale.unsqueeze(1)
+        return rows, values.reshape(shape)
+
+    def nbytes(self, payload):
+        rows, q, scale, _ = payload
+        return rows.numel() * INDEX_BYTES + q.numel() * q.element_size() + scale.numel() * scale.element_size()
+
+
+class SignCompressor(Codec):
+    """One bit per entry: the sign of every changed entry, scaled by the mean magnitude of its row."""
+    def encode(self, rows, values):
+        shape = values.shape
+        values = row_view(values)
+        return rows, pack_bits((values >= 0).flatten()), values.abs().mean(dim=1), shape
+
+    def decode(self, payload):
+        rows, bits, scale, shape = payload
+        signs = unpack_bits(bits, math.prod(shape)).float() * 2 - 1
+        return rows, (signs.reshape(len(rows), math.prod(shape[1:])) * scale.unsqueeze(1)).reshape(shape)
+
+    def nbytes(self, payload):
+        rows, bits, scale, _ = payload
+        return rows.numel() * INDEX_BYTES + bits.numel() + scale.numel() * scale.element_size()
+
+
+def make_codec(name, ratio=0.1):
+    """topk_rows, topk (entries), int8, int4 or sign."""
+    if name == 'topk_rows':
+        return TopKRows(ratio)
+    if name == 'topk':
+        return TopKElements(ratio)
+    if name == 'int8':
+        return StochasticQuantizer(8)
+    if name == 'int4':
+        return StochasticQuantizer(4)
+    if name == 'sign':
+        return SignCompressor()
+    raise ValueError('unknown codec %s' % name)
+
+
+class UploadCompressor(object):
+    """Client side of the upload path. A client's RowDelta gets the residual the client kept from its earlier
+    uploads added (error feedback), is clipped, and is encoded; whatever the codec dropped becomes the client's
+    new residual, stored row-sparse. A shared drift is not encoded (see CompressedDelta), so the residual only
+    covers the client's own rows. The residuals of at most `max_residuals` clients are kept; the one that
+    uploaded least recently is dropped first (None keeps them all). Counts the bytes sent and the bytes of the
+    uncompressed updates."""
+    def __init__(self, codec, error_feedback=True, clip_value=None, clip='coordinate', max_residuals=10000):
+        self.codec = codec
+        self.error_feedback = error_feedback
+        self.clip_value = clip_value
+        self.clip = clip
+        self.max_residuals = max_residuals
+        # user -> RowDelta, least recently uploading first
+        self.residuals = OrderedDict()
+        self.sent_bytes = 0
+        self.raw_bytes = 0
+
+    def _clip(self, delta):
+        """The clipped delta and the factor its shared drift is to be scaled by."""
+        if self.clip_value is None:
+            return delta, 1.
+        if self.clip == 'l2':
+            weight = min(1., self.clip_value / (delta.norm() + 1e-12))
+            return RowDelta(delta.rows, {key: value * weight for key, value in delta.values.items()}, delta.shared), weight
+        return delta.clamp(self.clip_value), 1.
+
+    def compress(self, user, delta):
+        self.raw_bytes += delta.nbytes()
+        residual = self.residuals.pop(user, None)
+        if residual is not None:
+            merged = [merge_rows(delta.rows[key], delta.values[key], residual.rows[key], residual.values[key]) for key in delta.rows]
+            delta = RowDelta({key: rows for key, (rows, _) in zip(delta.rows, merged)},
+                             {key: values for key, (_, values) in zip(delta.rows, merged)}, delta.shared)
+        delta, shared_scale = self._clip(delta)
+        upload = self.codec.compress(delta, shared_scale)
+        self.sent_bytes += upload.nbytes()
+        if self.error_feedback:
+            rows, values = {}, {}
+            for key in delta.rows:
+                sent_rows, sent_values = self.codec.decode(upload.payloads[key])
+                key_rows, key_values = merge_rows(delta.rows[key], delta.values[key], sent_rows, -sent_values)
+                nonzero = row_view(key_values).ne(0).any(dim=1)
+                rows[key], values[key] = key_rows[nonzero], key_values[nonzero]
+            if any(len(key_rows) > 0 for key_rows in rows.values()):
+                self.residuals[user] = RowDelta(rows, values)
+            while self.max_residuals is not None and len(self.residuals) > self.max_residuals:
+                self.residuals.popitem(last=False)
+        return upload
+
+    def reset_counts(self):
+        """Bytes sent and uncompressed bytes since the last reset."""
+        counts = (self.sent_bytes, self.raw_bytes)
+        self.sent_bytes, self.raw_bytes = 0, 0
+        return counts
@@ -0,0 +1,46 @@
+import torch
+
+
+class EarlyStopping(object):
+    """Stops training once `metric` has not improved by more than `min_delta` for `patience` evaluations."""
+    def __init__(self, patience=10, min_delta=0., metric='NDCG'):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.metric = metric
+        self.best = None
+        self.best_epoch = None
+        self.bad_evaluations = 0
+
+    def update(self, performance, epoch):
+        """Record the validation performance (metric name -> value) of an epoch; True if it improved."""
+        value = performance[self.metric]
+        if self.best is None or value > self.best + self.min_delta:
+            self.best, self.best_epoch = value, epoch
+            self.bad_evaluations = 0
+            return True
+        self.bad_evaluations += 1
+        return False
+
+    def reset(self):
+        self.best, self.best_epoch = None, None
+        self.bad_evaluations = 0
+
+    @property
+    def should_stop(self):
+        return self.bad_evaluations >= self.patience
+
+
+class Snapshot(object):
+    """Copy of a few tensors kept in buffers allocated once: every take() copies in place into the same
+    memory instead of deep-copying into new tensors."""
+    def __init__(self):
+        self.buffers = None
+
+    def take(self, *tensors):
+        with torch.no_grad():
+            if self.buffers is None or any(b.shape != t.shape for b, t in zip(self.buffers, tensors)):
+                self.buffers = [t.detach().clone() for t in tensors]
+            else:
+                for buffer, tensor in zip(self.buffers, tensors):
+                    buffer.copy_(tensor)
+        return self.buffers
@@ -0,0 +1,156 @@
+import copy
+import random
+import multiprocessing
+import numpy as np
+import torch
+from util.federated import RowDelta, RoundAdam, adam_drift
+from util.sampler import next_batch_pairwise_fl_pse
+from util.loss_torch import bpr_loss, l2_reg_loss
+
+# state of a worker process, set by _init_worker
+_worker = {}
+
+
+def _cpu_replica(model):
+    replica = copy.deepcopy(model).cpu()
+    for name, value in vars(replica).items():
+        if torch.is_tensor(value):
+            setattr(replica, name, value.cpu())
+    return replica
+
+
+def _init_worker(replica, data, tables, moments, step, conf):
+    torch.set_num_threads(1)
+    # tensors sent to a worker arrive in shared memory: copy the replica so that no two workers train one table
+    replica = copy.deepcopy(replica)
+    _worker.update(model=replica, data=data, tables=tables, moments=moments, step=step, conf=conf)
+
+
+def _train_shard(task):
+    """Sequential client loop of one worker over its shard of the selected users. The worker keeps its own
+    Adam state for the round and writes the final moments into its slot of the shared moment table. With
+    round_adam every client steps from the round-start Adam state and sends its own rows only (the coordinator
+    adds the round's drift), and the moments are advanced once by the clients' mean gradient."""
+    epoch, slot, users = task
+    model, data, conf = _worker['model'], _worker['data'], _worker['conf']
+    seed = conf['seed'] + epoch * len(_worker['moments']) + slot
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    model.load_state_dict(_worker['tables'])
+    params = [model.embedding_dict['user_emb'], model.embedding_dict['item_emb']]
+    optimizer = torch.optim.Adam(params, lr=conf['lr'], betas=conf['betas'], eps=conf['eps'])
+    step = float(_worker['step'])
+    if step > 0:
+        for k, param in enumerate(params):
+            optimizer.state[param] = {'step': torch.tensor(step),
+                                      'exp_avg': _worker['moments'][slot][0][k].clone(),
+                                      'exp_avg_sq': _worker['moments'][slot][1][k].clone()}
+    base = copy.deepcopy(model.state_dict())
+    round_adam = RoundAdam(model, optimizer) if conf['round_adam'] else None
+    if round_adam is not None:
+        round_adam.begin()
+    user_num = params[0].shape[0]
+    results = []
+    for user_idx, pos_idx, neg_idx in next_batch_pairwise_fl_pse(data, conf['batch_size'], users):
+        all_embeddings = model.propagate(torch.cat(params, 0))
+        rec_user_emb, rec_item_emb = all_embeddings[:user_num], all_embeddings[user_num:]
+        user_emb, pos_item_emb, neg_item_emb = rec_user_emb[user_idx], rec_item_emb[pos_idx], rec_item_emb[neg_idx]
+        batch_loss = bpr_loss(user_emb, pos_item_emb, neg_item_emb) + l2_reg_loss(conf['reg'], user_emb, pos_item_emb, neg_item_emb) / conf['batch_size']
+        optimizer.zero_grad()
+        batch_loss.backward()
+        optimizer.step()
+        update = round_adam.capture(base) if round_adam is not None else RowDelta.capture(model, base)
+        results.append((user_idx[0], batch_loss.item(),
+                        {key: (update.rows[key].numpy(), update.values[key].numpy()) for key in update.rows}))
+    if round_adam is not None:
+        round_adam.end()
+    for k, param in enumerate(params):
+        if param in optimizer.state:
+            _worker['moments'][slot][0][k].copy_(optimizer.state[param]['exp_avg'])
+            _worker['moments'][slot][1][k].copy_(optimizer.state[param]['exp_avg_sq'])
+    return results
+
+
+class ClientPool(object):
+    """Process pool that trains the selected clients of a round in parallel on CPU.
+    The global user and item tables and the Adam moments are published once per round through shared memory;
+    each worker trains a shard of the clients with its own seeded RNG (including negative sampling) and only
+    the row deltas of its clients travel back. The round's optimizer state is the mean of the workers' moments.
+    With `round_adam` (see RoundAdam) only the own rows of the clients travel back, the Adam drift every client
+    shares is computed once by the coordinator, and the moments are averaged weighted by the workers' clients.
+    Workers start from a fork server and receive a CPU replica of the model, never CUDA tensors."""
+    def __init__(self, model, optimizer, data, reg, batch_size, n_workers, seed=0, round_adam=False):
+        self.model = model
+        self.round_adam = round_adam
+        self.optimizer = optimizer
+        self.n_workers = n_workers
+        self.keys = ['embedding_dict.user_emb', 'embedding_dict.item_emb']
+        self.params = [model.embedding_dict['user_emb'], model.embedding_dict['item_emb']]
+        self.tables = {key: torch.zeros(value.shape).share_memory_() for key, value in model.state_dict().items()}
+        self.moments = [[[torch.zeros(p.shape).share_memory_() for p in self.params] for _ in range(2)] for _ in range(n_workers)]
+        self.step_count = torch.zeros(1).share_memory_()
+        group = optimizer.param_groups[0]
+        conf = {'lr': group['lr'], 'betas': group['betas'], 'eps': group['eps'], 'reg': reg, 'batch_size': batch_size, 'seed': seed,
+                'round_adam': round_adam}
+        # the coordinator has initialised CUDA by now, which a forked child cannot use: workers are forked from a
+        # clean server process instead, which loads this module and the torch.optim internals once for all of them
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload([__name__, 'torch._dynamo'])
+        self.pool = context.Pool(n_workers, initializer=_init_worker,
+                                 initargs=(_cpu_replica(model), data, self.tables, self.moments, self.step_count, conf))
+
+    def publish(self):
+        with torch.no_grad():
+            for key, value in self.model.state_dict().items():
+                self.tables[key].copy_(value.detach().cpu())
+            state = self.optimizer.state.get(self.params[0], {})
+            self.step_count[0] = float(state['step']) if 'step' in state else 0.
+            for k, param in enumerate(self.params):
+                if param in self.optimizer.state:
+                    for slot in range(self.n_workers):
+                        self.moments[slot][0][k].copy_(self.optimizer.state[param]['exp_avg'].cpu())
+                        self.moments[slot][1][k].copy_(self.optimizer.state[param]['exp_avg_sq'].cpu())
+
+    def step(self, epoch, select_user_list):
+        """Train the selected users for one round. Returns their user ids, losses and RowDelta updates."""
+        self.publish()
+        drift = adam_drift(self.optimizer, self.params, self.keys) if self.round_adam else None
+        shards = [(epoch, slot, select_user_list[slot::self.n_workers]) for slot in range(self.n_workers)]
+        device = self.params[0].device
+        users, losses, updates, counts = [], [], [], []
+        for results in self.pool.map(_train_shard, shards):
+            counts.append(len(results))
+            for user, loss, delta in results:
+                users.append(user)
+                losses.append(loss)
+                rows = {key: torch.from_numpy(delta[key][0]).to(device) for key in delta}
+                values = {key: torch.from_numpy(delta[key][1]).to(device) for key in delta}
+                updates.append(RowDelta(rows, values, drift))
+        self.merge_optimizer_state(counts)
+        return users, losses, updates
+
+    def merge_optimizer_state(self, counts):
+        """Merge the workers' moments: their mean, one step per client of the longest shard; with round_adam
+        their mean weighted by the workers' clients, one step per round."""
+        if sum(counts) == 0:
+            return
+        with torch.no_grad():
+            for k, param in enumerate(self.params):
+                state = self.optimizer.state[param]
+                exp_avg = torch.stack([self.moments[slot][0][k] for slot in range(self.n_workers)])
+                exp_avg_sq = torch.stack([self.moments[slot][1][k] for slot in range(self.n_workers)])
+                step = float(state['step']) if 'step' in state else 0.
+                if self.round_adam:
+                    weights = torch.tensor(counts, dtype=exp_avg.dtype).view(-1, *[1] * (exp_avg.dim() - 1)) / sum(counts)
+                    exp_avg, exp_avg_sq = (weights * exp_avg).sum(0), (weights * exp_avg_sq).sum(0)
+                    state['step'] = torch.tensor(step + 1)
+                else:
+                    exp_avg, exp_avg_sq = exp_avg.mean(0), exp_avg_sq.mean(0)
+                    state['step'] = torch.tensor(step + max(counts))
+                state['exp_avg'] = exp_avg.to(param.device)
+                state['exp_avg_sq'] = exp_avg_sq.to(param.device)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
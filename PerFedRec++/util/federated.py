@@ -0,0 +1,443 @@
+import torch
+from util.arena import ParameterArena
+
+
+class SharedDrift(dict):
+    """Dense change common to all clients of a round (e.g. the momentum drift of Adam), keyed like the state.
+    It is computed once per round and referenced by every client's RowDelta; its squared norm and its clamped
+    copies are cached, so clipping a client costs O(its rows) and the aggregators fold it in once per round."""
+    def __init__(self, *args, **kwargs):
+        super(SharedDrift, self).__init__(*args, **kwargs)
+        self._square = None
+        self._clamped = {}
+
+    def square(self):
+        """Squared L2 norm over all keys."""
+        if self._square is None:
+            self._square = float(sum(value.pow(2).sum() for value in self.values()))
+        return self._square
+
+    def clamped(self, clip_value):
+        if clip_value not in self._clamped:
+            self._clamped[clip_value] = SharedDrift({key: torch.clamp(value, min=-clip_value, max=clip_value) for key, value in self.items()})
+        return self._clamped[clip_value]
+
+
+class RowDelta(object):
+    """Update of one simulated client: for every parameter, the indices of the rows that changed
+    during the local step and their difference to the round-start state.
+    `shared` optionally holds a dense change common to all clients of a round (a SharedDrift, e.g. the momentum
+    drift of Adam); it is referenced, not copied, and the rows then store the client's difference to it."""
+    shared_scale = 1.
+
+    def __init__(self, rows, values, shared=None):
+        self.rows = rows
+        self.values = values
+        self.shared = shared if shared is None or isinstance(shared, SharedDrift) else SharedDrift(shared)
+
+    @staticmethod
+    def capture(model, base):
+        """Diff the model against the round-start state `base` and roll the changed rows back, so the
+        model is ready for the next client without a full state copy."""
+        rows, values = {}, {}
+        with torch.no_grad():
+            for key, param in model.state_dict().items():
+                changed = (param != base[key]).view(param.shape[0], -1).any(dim=1).nonzero().flatten()
+                rows[key] = changed
+                values[key] = param[changed] - base[key][changed]
+                param[changed] = base[key][changed]
+        return RowDelta(rows, values)
+
+    def clamp(self, clip_value):
+        if self.shared is None:
+            return RowDelta(self.rows, {key: torch.clamp(value, min=-clip_value, max=clip_value) for key, value in self.values.items()})
+        shared = self.shared.clamped(clip_value)
+        values = {}
+        for key, value in self.values.items():
+            rows = self.rows[key]
+            values[key] = torch.clamp(self.shared[key][rows] + value, min=-clip_value, max=clip_value) - shared[key][rows]
+        return RowDelta(self.rows, values, shared)
+
+    def add_rows_to(self, state, scale=1.):
+        """Add the client's own rows only; the shared drift is left to the caller."""
+        for key in self.rows:
+            state[key].index_add_(0, self.rows[key], self.values[key], alpha=scale)
+        return state
+
+    def add_to(self, state, scale=1.):
+        if self.shared is not None:
+            for key in self.rows:
+                state[key].add_(self.shared[key], alpha=scale)
+        return self.add_rows_to(state, scale)
+
+    def apply_to(self, base, scale=1.):
+        """Dense state of the client: base + scale * delta."""
+        return self.add_to({key: value.clone() for key, value in base.items()}, scale)
+
+    def norm(self):
+        """L2 norm of the whole change."""
+        square = 0. if self.shared is None else self.shared.square()
+        for key in self.rows:
+            if self.shared is None:
+                square += float(self.values[key].pow(2).sum())
+            else:
+                shared = self.shared[key][self.rows[key]]
+                square += float((shared + self.values[key]).pow(2).sum() - shared.pow(2).sum())
+        return max(0., square) ** 0.5
+
+    def nbytes(self):
+        return sum(self.rows[key].numel() * self.rows[key].element_size() +
+                   self.values[key].numel() * self.values[key].element_size() for key in self.rows)
+
+    @staticmethod
+    def average(base, deltas):
+        """FedAvg of the client states, computed as base + mean(delta)."""
+        aggregator = StreamingFedAvg(base)
+        for delta in deltas:
+            aggregator.add(delta)
+        return aggregator.result()
+
+
+class StreamingFedAvg(object):
+    """FedAvg that folds every client update into a running sum as soon as it arrives, so the round needs a
+    single extra flat buffer whatever the number of clients. Updates are RowDelta objects or full client states;
+    `clip_value` clips every client's change before it is added, per coordinate or, with clip='l2', by the L2
+    norm of the whole change, and `weight` scales its contribution. Compressed uploads (util.compress) are
+    scattered in as they are. Only the own rows of an update are added on arrival; a shared drift is folded in
+    once, with the total weight of its clients, by fold_shared()."""
+    def __init__(self, base, clip_value=None, clip='coordinate'):
+        self.base = base
+        self.arena = ParameterArena(base)
+        self.clip_value = clip_value
+        self.clip = clip
+        self.total = self.arena.zeros()
+        self.weight = 0.
+        # id(drift) -> [drift, summed weight]
+        self.shared = {}
+
+    def add(self, update, weight=1.):
+        if getattr(update, 'compressed', False) or isinstance(update, RowDelta):
+            if getattr(update, 'compressed', False):
+                # compressed uploads were clipped by the client before encoding and are scattered without decoding
+                scale = weight
+            elif self.clip_value is not None and self.clip == 'l2':
+                scale = weight * min(1., self.clip_value / (update.norm() + 1e-12))
+            else:
+                if self.clip_value is not None:
+                    update = update.clamp(self.clip_value)
+                scale = weight
+            update.add_rows_to(self.arena.unflatten(self.total), scale)
+            if update.shared is not None:
+                entry = self.shared.setdefault(id(update.shared), [update.shared, 0.])
+                entry[1] += scale * update.shared_scale
+        else:
+            delta = self.arena.flatten(update) - self.arena.flatten(self.base)
+            if self.clip_value is not None:
+                ParameterArena.clip(delta, self.clip_value, self.clip)
+            self.total.add_(delta, alpha=weight)
+        self.weight += weight
+
+    def fold_shared(self):
+        """Add the pending shared drifts into the running sum."""
+        total = self.arena.unflatten(self.total)
+        for drift, weight in self.shared.values():
+            for key, value in drift.items():
+                total[key].add_(value, alpha=weight)
+        self.shared = {}
+
+    def result(self):
+        """base + weighted mean of the client changes; the base itself when nothing was added."""
+        self.fold_shared()
+        flat = self.arena.flatten(self.base)
+        if self.weight > 0:
+            flat += self.total / self.weight
+        return self.arena.unflatten(flat)
+
+
+class ClusterFedAvg(object):
+    """One streaming FedAvg per cluster, kept as a single (n_clusters x params) tensor of running sums.
+    Each update is scatter-added into the row of its cluster, so the cluster models cost O(n_clusters x model)
+    whatever the number of clients; after result() every row holds the flat model of its cluster."""
+    def __init__(self, base, n_clusters):
+        self.base = base
+        self.arena = ParameterArena(base)
+        self.total = self.arena.zeros(n_clusters)
+        self.weight = torch.zeros(n_clusters, device=self.arena.device, dtype=self.arena.dtype)
+        # id(drift) -> [drift, summed weight per cluster]
+        self.shared = {}
+
+    def add(self, update, cluster, weight=1.):
+        if isinstance(update, RowDelta) or getattr(update, 'compressed', False):
+            update.add_rows_to(self.arena.unflatten(self.total[cluster]), weight)
+            if update.shared is not None:
+                # folded in once per cluster by result()
+                entry = self.shared.setdefault(id(update.shared), [update.shared, torch.zeros_like(self.weight)])
+                entry[1][cluster] += weight * update.shared_scale
+        else:
+            self.total[cluster].add_(self.arena.flatten(update) - self.arena.flatten(self.base), alpha=weight)
+        self.weight[cluster] += weight
+
+    def result(self):
+        """Turn the running sums into the cluster models in place; clusters without clients keep the base."""
+        for drift, weights in self.shared.values():
+            for cluster in weights.nonzero().flatten().tolist():
+                total = self.arena.unflatten(self.total[cluster])
+                for key, value in drift.items():
+                    total[key].add_(value, alpha=float(weights[cluster]))
+        self.shared = {}
+        self.total /= self.weight.clamp(min=1e-12).unsqueeze(1)
+        self.total += self.arena.flatten(self.base)
+        return self.total
+
+    def model(self, cluster):
+        """Named views of one cluster model (after result()), or None when the cluster had no client."""
+        if self.weight[cluster] <= 0:
+            return None
+        return self.arena.unflatten(self.total[cluster])
+
+
+def adam_drift(optimizer, params, keys):
+    """Change that the next Adam step gives every row without gradient (the momentum drift), per key.
+    Parameters without state yet get an initialized one (and no drift)."""
+    group = optimizer.param_groups[0]
+    lr, (beta1, beta2), eps = group['lr'], group['betas'], group['eps']
+    drift = SharedDrift()
+    with torch.no_grad():
+        for key, param in zip(keys, params):
+            state = optimizer.state[param]
+            if len(state) == 0:
+                state['step'] = torch.tensor(0.)
+                state['exp_avg'] = torch.zeros_like(param, memory_format=torch.preserve_format)
+                state['exp_avg_sq'] = torch.zeros_like(param, memory_format=torch.preserve_format)
+            step = float(state['step']) + 1
+            bias_correction1, bias_correction2 = 1 - beta1 ** step, 1 - beta2 ** step
+            drift[key] = -lr * (beta1 * state['exp_avg'] / bias_correction1) / \
+                ((beta2 * state['exp_avg_sq'] / bias_correction2).sqrt() + eps)
+    return drift
+
+
+class RoundAdam(object):
+    """Adam for a sequential client loop in which every client steps from the round-start optimizer state, as
+    BatchedClients does in one pass. begin() snapshots the state and the round's momentum drift; capture()
+    turns a client's step into a RowDelta of the rows it has gradient for, with the drift as the `shared` part,
+    and rolls the parameters and the optimizer state back; end() advances the state by one step with the
+    mean client gradient. A client's update thus costs O(its rows) instead of O(rows with momentum).
+    The model must expose an `embedding_dict` with user_emb and item_emb."""
+    def __init__(self, model, optimizer):
+        self.optimizer = optimizer
+        self.keys = ['embedding_dict.user_emb', 'embedding_dict.item_emb']
+        self.params = [model.embedding_dict['user_emb'], model.embedding_dict['item_emb']]
+        self.start = None
+
+    def begin(self):
+        # a new dict every round: updates of earlier rounds keep referencing their own drift
+        self.shared = adam_drift(self.optimizer, self.params, self.keys)
+        self.start = [{name: value.clone() for name, value in self.optimizer.state[param].items()} for param in self.params]
+        self.grad_sum = [torch.zeros_like(param) for param in self.params]
+        self.grad_sq_sum = [torch.zeros_like(param) for param in self.params]
+        self.count = 0
+
+    def capture(self, base):
+        """Call after the client's optimizer.step(): its update against the round-start state `base`."""
+        rows, values = {}, {}
+        with torch.no_grad():
+            for k, (key, param) in enumerate(zip(self.keys, self.params)):
+                grad = param.grad if param.grad is not None else torch.zeros_like(param)
+                own = grad.ne(0).view(grad.shape[0], -1).any(dim=1).nonzero().flatten()
+                rows[key] = own
+                values[key] = param[own] - base[key][own] - self.shared[key][own]
+                param.copy_(base[key])
+                self.grad_sum[k] += grad
+                self.grad_sq_sum[k] += grad.pow(2)
+                state = self.optimizer.state[param]
+                state['step'] = self.start[k]['step'].clone()
+                state['exp_avg'].copy_(self.start[k]['exp_avg'])
+                state['exp_avg_sq'].copy_(self.start[k]['exp_avg_sq'])
+        self.count += 1
+        return RowDelta(rows, values, self.shared)
+
+    def end(self):
+        if self.start is None or self.count == 0:
+            return
+        beta1, beta2 = self.optimizer.param_groups[0]['betas']
+        with torch.no_grad():
+            for k, param in enumerate(self.params):
+                state = self.optimizer.state[param]
+                state['exp_avg'].mul_(beta1).add_(self.grad_sum[k] / self.count, alpha=1 - beta1)
+                state['exp_avg_sq'].mul_(beta2).add_(self.grad_sq_sum[k] / self.count, alpha=1 - beta2)
+                state['step'] = self.start[k]['step'] + 1
+        self.start = None
+
+
+class BatchedClients(object):
+    """Runs the local step of many simulated clients in one vectorized pass.
+    The ego embeddings are repeated once per client along the feature axis, so a single propagation and a
+    single backward give every client its own gradient (the propagation treats feature columns independently).
+    Each client then takes one Adam step from the round-start optimizer state, computed for all clients at
+    once; the shared state advances by one step with the mean client gradient.
+    The model must expose `propagate(ego_embeddings)` and an `embedding_dict` with user_emb and item_emb."""
+    def __init__(self, model, optimizer, reg, batch_size, chunk=64):
+        self.model = model
+        self.optimizer = optimizer
+        self.reg = reg
+        self.batch_size = batch_size
+        self.chunk = chunk
+        self.keys = ['embedding_dict.user_emb', 'embedding_dict.item_emb']
+        self.params = [model.embedding_dict['user_emb'], model.embedding_dict['item_emb']]
+
+    def _adam_state(self):
+        moments = []
+        for param in self.params:
+            state = self.optimizer.state[param]
+            if len(state) == 0:
+                state['step'] = torch.tensor(0.)
+                state['exp_avg'] = torch.zeros_like(param, memory_format=torch.preserve_format)
+                state['exp_avg_sq'] = torch.zeros_like(param, memory_format=torch.preserve_format)
+            moments.append((state['exp_avg'], state['exp_avg_sq']))
+        step = float(self.optimizer.state[self.params[0]]['step']) + 1
+        exp_avg = torch.cat([m for m, _ in moments], 0)
+        exp_avg_sq = torch.cat([v for _, v in moments], 0)
+        return step, exp_avg, exp_avg_sq
+
+    def client_losses(self, out, user_idx, pos_idx, neg_idx, segment, n_clients):
+        """Per-client bpr_loss + l2_reg_loss / batch_size with segment reductions. out: nodes x clients x dim."""
+        user_emb, pos_item_emb, neg_item_emb = out[user_idx, segment], out[pos_idx, segment], out[neg_idx, segment]
+        pos_score = torch.mul(user_emb, pos_item_emb).sum(dim=1)
+        neg_score = torch.mul(user_emb, neg_item_emb).sum(dim=1)
+        pair_loss = -torch.log(10e-6 + torch.sigmoid(pos_score - neg_score))
+        count = torch.bincount(segment, minlength=n_clients).float()
+        loss = torch.zeros(n_clients, device=out.device).index_add_(0, segment, pair_loss) / count
+        emb_loss = 0
+        for emb in [user_emb, pos_item_emb, neg_item_emb]:
+            square = torch.zeros(n_clients, device=out.device).index_add_(0, segment, emb.pow(2).sum(dim=1))
+            emb_loss += torch.sqrt(square) / count
+        return loss + emb_loss * self.reg / self.batch_size
+
+    def step(self, batches):
+        """Input: one (user_idx, pos_idx, neg_idx) batch per client.
+        Returns the loss of every client and its update as a RowDelta against the round-start state."""
+        group = self.optimizer.param_groups[0]
+        lr, (beta1, beta2), eps = group['lr'], group['betas'], group['eps']
+        user_num = self.params[0].shape[0]
+        with torch.no_grad():
+            ego_embeddings = torch.cat(self.params, 0)
+            step, exp_avg, exp_avg_sq = self._adam_state()
+            bias_correction1, bias_correction2 = 1 - beta1 ** step, 1 - beta2 ** step
+            # change of every row that no client touches: Adam keeps moving it with its momentum
+            drift = -lr * (beta1 * exp_avg / bias_correction1) / ((beta2 * exp_avg_sq / bias_correction2).sqrt() + eps)
+            shared = SharedDrift(zip(self.keys, torch.split(drift, [user_num, drift.shape[0] - user_num])))
+            grad_sum = torch.zeros_like(ego_embeddings)
+            grad_sq_sum = torch.zeros_like(ego_embeddings)
+        n_nodes, dim = ego_embeddings.shape
+        device = ego_embeddings.device
+        losses, updates = [], []
+        for start in range(0, len(batches), self.chunk):
+            chunk = batches[start:start + self.chunk]
+            n_clients = len(chunk)
+            segment = torch.cat([torch.full((len(b[0]),), c, dtype=torch.long) for c, b in enumerate(chunk)]).to(device)
+            user_idx = torch.tensor([u for b in chunk for u in b[0]], dtype=torch.long, device=device)
+            pos_idx = torch.tensor([i for b in chunk for i in b[1]], dtype=torch.long, device=device) + user_num
+            neg_idx = torch.tensor([j for b in chunk for j in b[2]], dtype=torch.long, device=device) + user_num
+            stacked = ego_embeddings.unsqueeze(1).repeat(1, n_clients, 1).requires_grad_()
+            out = self.model.propagate(stacked.view(n_nodes, n_clients * dim)).view(n_nodes, n_clients, dim)
+            loss = self.client_losses(out, user_idx, pos_idx, neg_idx, segment, n_clients)
+            grad = torch.autograd.grad(loss.sum(), stacked)[0]
+            losses += loss.tolist()
+            with torch.no_grad():
+                grad_sum += grad.sum(dim=1)
+                grad_sq_sum += grad.pow(2).sum(dim=1)
+                m = beta1 * exp_avg.unsqueeze(1) + (1 - beta1) * grad
+                v = beta2 * exp_avg_sq.unsqueeze(1) + (1 - beta2) * grad.pow(2)
+                delta = -lr * (m / bias_correction1) / ((v / bias_correction2).sqrt() + eps)
+                touched = (grad != 0).any(dim=2)
+                client_rows, client_values = [], []
+                for key, lo, hi in [(self.keys[0], 0, user_num), (self.keys[1], user_num, n_nodes)]:
+                    client, row = touched[lo:hi].t().nonzero(as_tuple=True)
+                    counts = torch.bincount(client, minlength=n_clients).tolist()
+                    values = delta[row + lo, client] - drift[row + lo]
+                    client_rows.append(torch.split(row, counts))
+                    client_values.append(torch.split(values, counts))
+                for c in range(n_clients):
+                    rows = {key: client_rows[k][c] for k, key in enumerate(self.keys)}
+                    values = {key: client_values[k][c] for k, key in enumerate(self.keys)}
+                    updates.append(RowDelta(rows, values, shared))
+        with torch.no_grad():
+            n = len(batches)
+            sizes = [user_num, n_nodes - user_num]
+            exp_avg.mul_(beta1).add_(grad_sum / n, alpha=1 - beta1)
+            exp_avg_sq.mul_(beta2).add_(grad_sq_sum / n, alpha=1 - beta2)
+            for param, m, v in zip(self.params, torch.split(exp_avg, sizes), torch.split(exp_avg_sq, sizes)):
+                state = self.optimizer.state[param]
+                state['exp_avg'].copy_(m)
+                state['exp_avg_sq'].copy_(v)
+                state['step'] += 1
+        return losses, updates
+
+
+class SharedPropagation(object):
+    """Round-start propagation reused by every client of the round.
+    Every client starts from the same state, so the full-graph forward is computed once per round and each
+    client only backpropagates its loss through the rows it reaches: the output gradient of its batch is
+    pushed back layer by layer over the one-hop neighbourhood of the rows reached so far, slicing those rows
+    from a CSR copy of the adjacency, so that a layer costs the edges of the reached rows. Only the output
+    gradient (and the scan for its non-zero rows) and the parameter gradients the optimizer takes stay dense,
+    one N x d pass each per client.
+    The model must expose `propagate(ego_embeddings)`, `sparse_norm_adj`, `layers` and an
+    `embedding_dict` with user_emb and item_emb."""
+    def __init__(self, model):
+        self.model = model
+        self.params = [model.embedding_dict['user_emb'], model.embedding_dict['item_emb']]
+        self.embeddings = None
+        self.output = None
+        self.adj = None
+        self.csr = None
+
+    def refresh(self):
+        with torch.no_grad():
+            self.embeddings = self.model.propagate(torch.cat(self.params, 0))
+        if self.adj is not self.model.sparse_norm_adj:
+            self.adj = self.model.sparse_norm_adj
+            # a coalesced COO tensor is sorted by row, so its columns and values are already in CSR order
+            adj = self.adj.coalesce()
+            row, col = adj.indices()
+            counts = torch.bincount(row, minlength=adj.shape[0])
+            crow = torch.cat([counts.new_zeros(1), torch.cumsum(counts, 0)])
+            self.csr = (crow, col, adj.values())
+
+    def forward(self):
+        self.output = self.embeddings.detach().requires_grad_()
+        return torch.split(self.output, [self.params[0].shape[0], self.params[1].shape[0]])
+
+    def edges(self, rows):
+        """The edges of the adjacency rows `rows`: their positions in `rows`, columns and values."""
+        crow, col, values = self.csr
+        start = crow[rows]
+        counts = crow[rows + 1] - start
+        owner = torch.repeat_interleave(torch.arange(len(rows), device=rows.device), counts)
+        first = torch.cumsum(counts, 0) - counts
+        edge = torch.arange(owner.shape[0], device=rows.device) - first[owner] + start[owner]
+        return owner, col[edge], values[edge]
+
+    def backward(self, loss):
+        """Set the parameter gradients of `loss`, which must be computed from the last forward()."""
+        loss.backward()
+        grad = self.output.grad
+        rows = (grad != 0).any(dim=1).nonzero().flatten()
+        grad = grad[rows] / self.model.layers
+        reached, reached_grad = [], []
+        with torch.no_grad():
+            for k in range(self.model.layers):
+                # A^T g: every edge (r, c) of a row carrying gradient sends A[r, c] * g[r] to row c
+                owner, cols, values = self.edges(rows)
+                rows, position = torch.unique(cols, return_inverse=True)
+                grad = torch.zeros(len(rows), grad.shape[1], dtype=grad.dtype, device=grad.device)\
+                    .index_add_(0, position, values.unsqueeze(1) * grad[owner])
+                reached.append(rows)
+                reached_grad.append(grad)
+            ego_grad = torch.zeros_like(self.embeddings).index_put_(
+                (torch.cat(reached),), torch.cat(reached_grad), accumulate=True)
+        for param, param_grad in zip(self.params, torch.split(ego_grad, [self.params[0].shape[0], self.params[1].shape[0]])):
+            if param.grad is None:
+                param.grad = param_grad
+            else:
+                param.grad += param_grad
@@ -0,0 +1,66 @@
+import torch
+
+
+class HistoricalEmbedding(object):
+    """Per-layer store of propagated node embeddings (GNNAutoScale).
+    Layer outputs of nodes outside the current batch and its one-hop neighbourhood are read from
+    here instead of being recomputed. The store is rebuilt with a full propagation every `refresh` steps,
+    or only after expire() when refresh is None."""
+    def __init__(self, refresh=None):
+        self.refresh = refresh
+        self.layers = None
+        self.steps = 0
+
+    def stale(self):
+        return self.layers is None or (self.refresh is not None and self.steps >= self.refresh)
+
+    def expire(self):
+        self.layers = None
+
+    def step(self):
+        self.steps += 1
+
+    def rebuild(self, ego_embeddings, adj, n_layers):
+        with torch.no_grad():
+            self.layers = []
+            embeddings = ego_embeddings.detach()
+            for k in range(1, n_layers):
+                embeddings = torch.sparse.mm(adj, embeddings)
+                self.layers.append(embeddings)
+        self.steps = 0
+
+    def push(self, k, nodes, embeddings):
+        self.layers[k - 1].index_copy_(0, nodes, embeddings.detach())
+
+    def pull(self, k, nodes, embeddings):
+        """Layer k of every node: fresh rows for `nodes`, historical rows for the rest."""
+        return self.layers[k - 1].index_copy(0, nodes, embeddings)
+
+
+def batch_nodes(user_num, device, user_idx, *item_idx):
+    """Merge the user and item indices of a batch into sorted unique node ids and return, for every
+    input list, the positions of its entries among those nodes."""
+    index = [torch.as_tensor(user_idx, dtype=torch.long, device=device)]
+    index += [torch.as_tensor(i, dtype=torch.long, device=device) + user_num for i in item_idx]
+    nodes, inverse = torch.unique(torch.cat(index), return_inverse=True)
+    positions = list(torch.split(inverse, [len(i) for i in index]))
+    return nodes, positions
+
+
+def propagate_batch(ego_embeddings, adj, nodes, n_layers, history):
+    """Exact propagation for `nodes` and their one-hop neighbours, everything further away is read from
+    `history`. Returns the outputs of `nodes` for layers 0..n_layers."""
+    nodes_adj = adj.index_select(0, nodes).coalesce()
+    support = torch.unique(torch.cat([nodes, nodes_adj.indices()[1]]))
+    support_adj = adj.index_select(0, support)
+    position = torch.searchsorted(support, nodes)
+    outputs = [ego_embeddings[nodes]]
+    embeddings = ego_embeddings
+    for k in range(1, n_layers):
+        fresh = torch.sparse.mm(support_adj, embeddings)
+        outputs.append(fresh[position])
+        history.push(k, support, fresh)
+        embeddings = history.pull(k, support, fresh)
+    outputs.append(torch.sparse.mm(nodes_adj, embeddings))
+    history.step()
+    return outputs
@@ -0,0 +1,52 @@
+import torch
+
+
+class LocalModelStore(object):
+    """Personalized models of one round's clients, stored as sparse deltas against the round-start global tables.
+    A client keeps its own user row and the item rows its local step changed (plus a reference to the dense
+    change shared by all clients of the round, if any), so the store costs O(model + clients x touched rows)
+    instead of a full state per client. Scores are reconstructed on demand."""
+    def __init__(self, base, user_key='embedding_dict.user_emb', item_key='embedding_dict.item_emb'):
+        # referenced, not copied: the round-start state is not modified afterwards
+        self.user_table = base[user_key]
+        self.item_table = base[item_key]
+        self.user_key = user_key
+        self.item_key = item_key
+        self.clients = {}
+
+    def add(self, user, update, scale=1.):
+        """Keep the part of a RowDelta that predict needs: the user's row and the changed item rows, scaled."""
+        user_delta = torch.zeros_like(self.user_table[user])
+        shared = None
+        if update.shared is not None:
+            user_delta += update.shared[self.user_key][user]
+            shared = update.shared[self.item_key]
+        own = (update.rows[self.user_key] == user).nonzero().flatten()
+        if len(own) > 0:
+            user_delta += update.values[self.user_key][own[0]]
+        user_row = self.user_table[user] + scale * user_delta
+        self.clients[user] = (user_row, update.rows[self.item_key], scale * update.values[self.item_key], shared, scale)
+
+    def __contains__(self, user):
+        return user in self.clients
+
+    def __len__(self):
+        return len(self.clients)
+
+    def user_row(self, user):
+        return self.clients[user][0]
+
+    def score(self, user):
+        """Scores of every item under the client's personalized model."""
+        user_row, rows, values, shared, scale = self.clients[user]
+        score = torch.matmul(self.item_table, user_row)
+        if shared is not None:
+            score += scale * torch.matmul(shared, user_row)
+        score[rows] += torch.matmul(values, user_row)
+        return score
+
+    def nbytes(self):
+        total = 0
+        for user_row, rows, values, _, _ in self.clients.values():
+            total += user_row.element_size() * user_row.numel() + rows.element_size() * rows.numel() + values.element_size() * values.numel()
+        return total
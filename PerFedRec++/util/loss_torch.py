@@ -1,5 +1,6 @@
 import torch
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 
 def bpr_loss(user_emb, pos_item_emb, neg_item_emb):
@@ -42,6 +43,22 @@ def InfoNCE(view1, view2, temperature, b_cos = True):
     return torch.mean(cl_loss)
 
 
+def _block_logsumexp(view1, block, temperature):
+    return torch.logsumexp(torch.matmul(view1, block.transpose(0, 1)) / temperature, dim=1)
+
+def chunked_InfoNCE(view1, view2, temperature, chunk=1024, b_cos=True):
+    """InfoNCE with the denominator accumulated as a running logsumexp over blocks of `chunk` negatives.
+    Every block is recomputed in backward (checkpointing), so memory is O(batch x chunk) instead of O(batch^2)."""
+    if b_cos:
+        view1, view2 = F.normalize(view1, dim=1), F.normalize(view2, dim=1)
+    pos_score = (view1 * view2).sum(dim=-1) / temperature
+    ttl_score = None
+    for start in range(0, view2.shape[0], chunk):
+        block = checkpoint(_block_logsumexp, view1, view2[start:start + chunk], temperature, use_reentrant=False)
+        ttl_score = block if ttl_score is None else torch.logaddexp(ttl_score, block)
+    return torch.mean(ttl_score - pos_score)
+
+
 def kl_divergence(p_logit, q_logit):
     p = F.softmax(p_logit, dim=-1)
     kl = torch.sum(p * (F.log_softmax(p_logit, dim=-1) - F.log_softmax(q_logit, dim=-1)), 1)
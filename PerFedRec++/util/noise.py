@@ -0,0 +1,49 @@
+import math
+import torch
+
+
+class LDPNoise(object):
+    """Average of the local DP noise of n_clients clients, drawn directly on the target device.
+    Laplace noise is summed over the clients in chunks of at most `max_elements` samples, so memory stays at
+    O(shape) whatever the number of clients or the catalog size. The average of Gaussian noise is itself
+    Gaussian, with the scale divided by sqrt(n_clients), and is drawn in one go."""
+    def __init__(self, loc, scale, n_clients, mechanism='laplace', device='cpu', seed=None, max_elements=2 ** 26):
+        if mechanism not in ['laplace', 'gaussian']:
+            raise ValueError('unknown noise mechanism %s' % mechanism)
+        self.loc = loc
+        self.scale = scale
+        self.n_clients = n_clients
+        self.mechanism = mechanism
+        self.device = torch.device(device)
+        self.max_elements = max_elements
+        self.generator = torch.Generator(device=self.device)
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
+
+    def laplace(self, *size):
+        # inverse CDF of Laplace(loc, scale); torch.rand can return exactly 0, whose inverse CDF is -inf
+        u = torch.rand(*size, generator=self.generator, device=self.device).clamp_(min=torch.finfo(torch.float32).eps) - 0.5
+        return self.loc - self.scale * torch.sign(u) * torch.log1p(-2 * u.abs())
+
+    def mean(self, shape):
+        """Average of n_clients independent noise tensors of the given shape."""
+        if self.mechanism == 'gaussian':
+            noise = torch.randn(*shape, generator=self.generator, device=self.device)
+            return noise.mul_(self.scale / math.sqrt(self.n_clients)).add_(self.loc)
+        numel = math.prod(shape)
+        total = torch.zeros(numel, device=self.device)
+        clients_per_chunk = max(1, self.max_elements // numel)
+        rows_per_chunk = max(1, self.max_elements // (numel // shape[0])) if clients_per_chunk == 1 else shape[0]
+        for start in range(0, self.n_clients, clients_per_chunk):
+            n = min(clients_per_chunk, self.n_clients - start)
+            if n > 1:
+                total += self.laplace(n, numel).sum(dim=0)
+                continue
+            # a single client's noise does not fit: draw it in slices of rows
+            view = total.view(shape[0], -1)
+            for row in range(0, shape[0], rows_per_chunk):
+                block = view[row:row + rows_per_chunk]
+                block += self.laplace(*block.shape)
+        return (total / self.n_clients).view(*shape)
@@ -0,0 +1,85 @@
+import torch
+import torch.nn.functional as F
+
+
+def lookup(table, idx, sparse=True):
+    """Rows of an embedding table; with sparse=True the gradient of the table is a sparse tensor of those rows."""
+    idx = torch.as_tensor(idx, dtype=torch.long, device=table.device)
+    return F.embedding(idx, table, sparse=sparse)
+
+
+def touched_rows(grad):
+    """Indices and gradient values of the rows that received a gradient (sparse or dense)."""
+    if grad.is_sparse:
+        grad = grad.coalesce()
+        return grad.indices()[0], grad.values()
+    rows = grad.reshape(grad.shape[0], -1).ne(0).any(dim=1).nonzero().flatten()
+    return rows, grad[rows]
+
+
+class LazyAdam(torch.optim.Optimizer):
+    """Adam that only updates the rows with a gradient: untouched rows keep their moments and values.
+    Every row counts its own steps, so the bias correction of a row is deferred to the steps it is actually
+    updated in. The cost of a step grows with the number of touched rows, not with the size of the table."""
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8):
+        super(LazyAdam, self).__init__(params, dict(lr=lr, betas=betas, eps=eps))
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = closure() if closure is not None else None
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                state = self.state[p]
+                if len(state) == 0:
+                    state['step'] = torch.zeros(p.shape[0], device=p.device)
+                    state['exp_avg'] = torch.zeros_like(p)
+                    state['exp_avg_sq'] = torch.zeros_like(p)
+                rows, grad = touched_rows(p.grad)
+                step = state['step'][rows] + 1
+                state['step'][rows] = step
+                m = state['exp_avg'][rows].mul_(beta1).add_(grad, alpha=1 - beta1)
+                v = state['exp_avg_sq'][rows].mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                state['exp_avg'][rows] = m
+                state['exp_avg_sq'][rows] = v
+                shape = (-1,) + (1,) * (p.dim() - 1)
+                bias_correction1 = (1 - beta1 ** step).view(shape)
+                bias_correction2 = (1 - beta2 ** step).view(shape)
+                denom = (v / bias_correction2).sqrt_().add_(group['eps'])
+                p[rows] -= group['lr'] * (m / bias_correction1) / denom
+        return loss
+
+
+class LazyAdagrad(torch.optim.Optimizer):
+    """Adagrad that only touches the rows with a gradient (its update of an untouched row is zero anyway)."""
+    def __init__(self, params, lr=1e-2, eps=1e-10):
+        super(LazyAdagrad, self).__init__(params, dict(lr=lr, eps=eps))
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = closure() if closure is not None else None
+        for group in self.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                state = self.state[p]
+                if len(state) == 0:
+                    state['sum'] = torch.zeros_like(p)
+                rows, grad = touched_rows(p.grad)
+                total = state['sum'][rows].addcmul_(grad, grad)
+                state['sum'][rows] = total
+                p[rows] -= group['lr'] * grad / total.sqrt().add_(group['eps'])
+        return loss
+
+
+def make_optimizer(name, params, lr):
+    """adam (dense torch Adam), lazy_adam or lazy_adagrad."""
+    if name == 'adam':
+        return torch.optim.Adam(params, lr=lr)
+    if name == 'lazy_adam':
+        return LazyAdam(params, lr=lr)
+    if name == 'lazy_adagrad':
+        return LazyAdagrad(params, lr=lr)
+    raise ValueError('unknown optimizer %s' % name)
@@ -0,0 +1,34 @@
+import torch
+
+DTYPES = {'fp32': torch.float32, 'bf16': torch.bfloat16}
+
+
+class MixedPrecision(object):
+    """Mixin of the LightGCN-style encoders: the embedding tables stay fp32 master weights, while the adjacency
+    and every propagated layer are stored in `compute_dtype` and the layer mean is taken back in fp32.
+    bf16 has the exponent range of fp32, so no loss scaling is needed; fp16 is not offered for that reason."""
+    compute_dtype = torch.float32
+    _low_adj = None
+
+    def set_precision(self, name):
+        if name not in DTYPES:
+            raise ValueError('unknown precision %s' % name)
+        self.compute_dtype = DTYPES[name]
+        self._low_adj = None
+
+    def low_adj(self, adj):
+        """The adjacency in compute_dtype; the cast of the model's own adjacency is cached."""
+        if self.compute_dtype == torch.float32:
+            return adj
+        if adj is not self.sparse_norm_adj:
+            return adj.to(self.compute_dtype)
+        if self._low_adj is None or self._low_adj[0] is not adj:
+            self._low_adj = (adj, adj.to(self.compute_dtype))
+        return self._low_adj[1]
+
+    def to_compute(self, x):
+        return x.to(self.compute_dtype)
+
+    @staticmethod
+    def layer_mean(layers):
+        return torch.mean(torch.stack(layers, dim=1).float(), dim=1)
@@ -0,0 +1,47 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+def same_arguments(a, b):
+    """Equality of two argument tuples whose entries may be NumPy arrays."""
+    if len(a) != len(b):
+        return False
+    for x, y in zip(a, b):
+        if isinstance(x, np.ndarray) or isinstance(y, np.ndarray):
+            if not np.array_equal(x, y):
+                return False
+        elif isinstance(x, tuple) and isinstance(y, tuple):
+            # a (name, value) keyword argument
+            if not same_arguments(x, y):
+                return False
+        elif x != y:
+            return False
+    return True
+
+
+class Prefetcher(object):
+    """Runs a producer in a background thread so that the next epoch's (or round's) augmented graphs are
+    built while the current one trains. get() returns the pending result if it was submitted with the same
+    arguments, and otherwise (or when nothing was submitted) calls the producer directly."""
+    def __init__(self, producer):
+        self.producer = producer
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        self.arguments = None
+
+    def submit(self, *args, **kwargs):
+        self.pending = self.executor.submit(self.producer, *args, **kwargs)
+        self.arguments = args + tuple(sorted(kwargs.items()))
+
+    def get(self, *args, **kwargs):
+        pending, self.pending = self.pending, None
+        if pending is not None and same_arguments(self.arguments, args + tuple(sorted(kwargs.items()))):
+            return pending.result()
+        if pending is not None:
+            # prefetched for other arguments: discard it
+            pending.cancel()
+        return self.producer(*args, **kwargs)
+
+    def close(self):
+        self.pending = None
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,51 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+
+def file_digest(path, block=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(block), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PretrainCache(object):
+    """Pretrained user and item tables stored under `root`, addressed by a hash of the training data and the
+    pretraining settings. Tables are .npy files loaded memory-mapped; an entry is written to a temporary
+    directory and renamed into place, so a crashed or concurrent run never leaves a half-written entry."""
+    def __init__(self, root, data_file, settings):
+        self.root = root
+        digest = hashlib.sha256(file_digest(data_file).encode())
+        digest.update(json.dumps(settings, sort_keys=True).encode())
+        self.key = digest.hexdigest()[:32]
+        self.path = os.path.join(root, self.key)
+
+    def load(self):
+        """(user table, item table) as read-only memmaps, or None on a miss."""
+        if not os.path.isdir(self.path):
+            return None
+        return (np.load(os.path.join(self.path, 'user_emb.npy'), mmap_mode='r'),
+                np.load(os.path.join(self.path, 'item_emb.npy'), mmap_mode='r'))
+
+    def store(self, user_emb, item_emb, settings=None):
+        os.makedirs(self.root, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=self.root, prefix='.tmp-')
+        try:
+            np.save(os.path.join(tmp, 'user_emb.npy'), np.asarray(user_emb))
+            np.save(os.path.join(tmp, 'item_emb.npy'), np.asarray(item_emb))
+            if settings is not None:
+                with open(os.path.join(tmp, 'settings.json'), 'w') as f:
+                    json.dump(settings, f, sort_keys=True)
+            os.rename(tmp, self.path)
+        except OSError:
+            # another run stored the same entry first
+            if not os.path.isdir(self.path):
+                raise
+        finally:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
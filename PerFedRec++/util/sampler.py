@@ -29,6 +29,22 @@ def next_batch_pairwise(data,batch_size,n_negs=1):
         yield u_idx, i_idx, j_idx
 
 
+def next_batch_pairwise_subgraph(data, nodes, n_users, edges, batch_size):
+    """Pairwise batches restricted to an induced subgraph. Indices are local to `nodes`."""
+    n_nodes = len(nodes)
+    if n_users == 0 or n_users == n_nodes:
+        return
+    edges = edges[np.random.permutation(len(edges))]
+    for ptr in range(0, len(edges), batch_size):
+        u_idx, i_idx = edges[ptr:ptr + batch_size, 0], edges[ptr:ptr + batch_size, 1]
+        j_idx = np.random.randint(n_users, n_nodes, len(u_idx))
+        for _ in range(10):
+            rated = np.asarray(data.interaction_mat[nodes[u_idx], nodes[j_idx] - data.user_num]).flatten() > 0
+            if not rated.any():
+                break
+            j_idx[rated] = np.random.randint(n_users, n_nodes, rated.sum())
+        yield u_idx.tolist(), i_idx.tolist(), j_idx.tolist()
+
 def next_batch_pairwise_fl(data,batch_size,select_user_list, n_negs=1):
     training_data = data.training_data
     df = pd.DataFrame(training_data, columns=['user', 'item', 'rating'])
@@ -0,0 +1,67 @@
+import numpy as np
+
+
+class ClientScheduler(object):
+    """Picks the clients of the next round with NumPy index arrays and boolean masks, in O(users) per round.
+    Strategies:
+        uniform      every eligible user equally likely
+        cluster      each cluster contributes in proportion to its size, topped up uniformly
+        interaction  sampled without replacement with probability proportional to the user's interactions
+    With exclude_last the clients of the previous round are not eligible (unless too few users are left)."""
+    strategies = ['uniform', 'cluster', 'interaction']
+
+    def __init__(self, n_users, n_select, strategy='uniform', exclude_last=True, interactions=None, seed=None):
+        if strategy not in self.strategies:
+            raise ValueError('unknown selection strategy %s' % strategy)
+        self.n_users = n_users
+        self.n_select = min(n_select, n_users)
+        self.strategy = strategy
+        self.exclude_last = exclude_last
+        self.interactions = None if interactions is None else np.asarray(interactions, dtype=np.float64).reshape(-1)
+        self.rng = np.random.default_rng(seed)
+        self.mask = np.zeros(n_users, dtype=bool)
+
+    def eligible(self):
+        if self.exclude_last and self.n_users - self.mask.sum() >= self.n_select:
+            return ~self.mask
+        return np.ones(self.n_users, dtype=bool)
+
+    def _keys(self, strategy):
+        """Random sort keys: the n_select largest keys among the eligible users are selected."""
+        if strategy == 'interaction':
+            # Efraimidis-Spirakis keys u^(1/w) give weighted sampling without replacement
+            weights = np.maximum(self.interactions, 1e-12)
+            return np.log(self.rng.random(self.n_users)) / weights
+        return self.rng.random(self.n_users)
+
+    @staticmethod
+    def _top(keys, k):
+        if k <= 0:
+            return np.empty(0, dtype=np.int64)
+        if k >= len(keys):
+            return np.argsort(-keys)
+        return np.argpartition(-keys, k - 1)[:k]
+
+    def select(self, clusters=None, strategy=None):
+        """Return the selected user ids (in random order) and the selection mask; clusters holds the
+        cluster id of every user and is required by the cluster strategy."""
+        strategy = self.strategy if strategy is None else strategy
+        eligible = self.eligible()
+        keys = self._keys(strategy)
+        keys[~eligible] = -np.inf
+        if strategy == 'cluster':
+            clusters = np.asarray(clusters)
+            quota = np.floor(np.bincount(clusters) / self.n_users * self.n_select).astype(np.int64)
+            # rank of every user inside its cluster by decreasing key
+            order = np.lexsort((-keys, clusters))
+            sorted_clusters = clusters[order]
+            rank = np.arange(self.n_users) - np.searchsorted(sorted_clusters, sorted_clusters, side='left')
+            chosen = order[(rank < quota[sorted_clusters]) & eligible[order]]
+            # top up uniformly among the remaining eligible users
+            keys = self.rng.random(self.n_users)
+            keys[~eligible] = -np.inf
+            keys[chosen] = np.inf
+        selected = self._top(keys, self.n_select)
+        self.mask = np.zeros(self.n_users, dtype=bool)
+        self.mask[selected] = True
+        return self.rng.permutation(selected), self.mask
@@ -0,0 +1,21 @@
+
+import os
+import sys
+import torch
+import pytest
+
+# Add the parent directory of PerFedRec++ to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../PerFedRec++')))
+
+from util.arena import ParameterArena
+
+def test_clip_modes():
+    """
+    Test per-coordinate and per-client L2 clipping on a (clients x params) matrix.
+    """
+    deltas = torch.tensor([[3., 4.], [0.3, -0.4]])
+    assert torch.equal(ParameterArena.clip(deltas.clone(), 1.), torch.tensor([[1., 1.], [0.3, -0.4]]))
+    clipped = ParameterArena.clip(deltas.clone(), 1., mode='l2')
+    assert torch.allclose(clipped, torch.tensor([[0.6, 0.8], [0.3, -0.4]]))
+    with pytest.raises(ValueError):
+        ParameterArena.clip(deltas, 1., mode='max')
@@ -0,0 +1,106 @@
+import os
+import sys
+import asyncio
+import torch
+import pytest
+
+# Add the parent directory of PerFedRec++ to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../PerFedRec++')))
+
+from util.async_fed import staleness_weight, ClientProfile, VirtualClock, FedBuff, AsyncFederation
+from util.federated import RowDelta
+
+@pytest.fixture
+def state():
+    """
+    Fixture creating a small server state with one table.
+    """
+    return {'emb': torch.zeros(4, 2)}
+
+def row_update(row, value):
+    """
+    Build a RowDelta changing one row of the 'emb' table by `value`.
+    """
+    return RowDelta({'emb': torch.tensor([row])}, {'emb': torch.full((1, 2), float(value))})
+
+def test_virtual_clock_wakes_in_order():
+    """
+    Test that sleepers wake in order of their wake-up time and that the clock jumps to it.
+    """
+    clock = VirtualClock()
+    woken = []
+
+    async def sleeper(name, delay):
+        await clock.sleep(delay)
+        woken.append((name, clock.now))
+
+    async def main():
+        tasks = [asyncio.ensure_future(sleeper(name, delay)) for name, delay in [('a', 3.), ('b', 1.), ('c', 2.)]]
+        while await clock.advance():
+            pass
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+    assert woken == [('b', 1.), ('c', 2.), ('a', 3.)]
+
+def test_fedbuff_steps_every_buffer_with_staleness(state):
+    """
+    Test that the server steps once per buffer of updates and down-weights stale updates.
+    """
+    server = FedBuff(state, buffer_size=2)
+    assert not server.receive(row_update(0, 1.), version=0)
+    assert server.receive(row_update(1, 1.), version=0)
+    assert server.version == 1
+    assert torch.allclose(state['emb'][:2], torch.full((2, 2), 0.5))
+    server.receive(row_update(2, 1.), version=0)
+    server.receive(row_update(3, 1.), version=1)
+    assert torch.allclose(state['emb'][2], torch.full((2,), staleness_weight(1) / 2))
+    assert torch.allclose(state['emb'][3], torch.full((2,), 0.5))
+    assert server.mean_staleness() == pytest.approx(0.25)
+    with pytest.raises(ValueError):
+        staleness_weight(1, 'exponential')
+
+def test_stragglers_do_not_block_the_server(state):
+    """
+    Test that the simulation takes the requested steps while a straggler is still in flight, and that the
+    fast clients contribute the updates.
+    """
+    profile = ClientProfile(8, compute=1., sigma=0., latency=0., seed=0)
+    profile.speed[0] = 1000.
+    server = FedBuff(state, buffer_size=2)
+    trained = []
+
+    def train(batch):
+        trained.append(batch)
+        return 0., row_update(batch % 4, 1.)
+
+    def clients():
+        while True:
+            for user in range(8):
+                yield user, user
+
+    steps = []
+    simulation = AsyncFederation(server, profile, train, clients(), concurrency=4)
+    now = simulation.run(5, lambda version, now, losses: steps.append((version, now, len(losses))))
+    assert [version for version, _, _ in steps] == [1, 2, 3, 4, 5]
+    assert all(n == 2 for _, _, n in steps)
+    assert now < 1000.
+    assert trained.count(0) == 1
+
+def test_concurrency_above_the_number_of_clients(state):
+    """
+    Test that the simulation does not hang when more clients may be in flight than there are users.
+    """
+    profile = ClientProfile(3, sigma=0., latency=0., seed=0)
+    server = FedBuff(state, buffer_size=2)
+
+    def clients():
+        while True:
+            for user in range(3):
+                yield user, user
+
+    steps = []
+    simulation = AsyncFederation(server, profile, lambda batch: (0., row_update(batch, 1.)), clients(), concurrency=8)
+    simulation.run(3, lambda version, now, losses: steps.append(version))
+    assert steps == [1, 2, 3]
+    assert len(simulation.in_flight) <= 3
@@ -0,0 +1,73 @@
+
+import os
+import sys
+import random
+import numpy as np
+import scipy.sparse as sp
+import pytest
+import torch
+
+# Add the parent directory of PerFedRec++ to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../PerFedRec++')))
+
+from data.augmentor import GraphAugmentor, TorchGraphAugmentor
+from data.graph import Graph
+
+def bipartite_laplacian(interaction_mat):
+    adj = sp.bmat([[None, interaction_mat], [interaction_mat.T, None]]).tocsr()
+    return Graph.normalize_graph_mat(adj).toarray()
+
+@pytest.fixture
+def interaction_mat():
+    """
+    Fixture building a random user-item interaction matrix.
+    """
+    rng = np.random.default_rng(0)
+    dense = (rng.random((20, 15)) < 0.2).astype(np.float32)
+    return sp.csr_matrix(dense)
+
+def test_laplacian_without_dropout(interaction_mat):
+    """
+    Test that keeping every edge reproduces the normalized bipartite adjacency.
+    """
+    augmentor = TorchGraphAugmentor(interaction_mat)
+    adj = augmentor.laplacian(torch.ones_like(augmentor.ratings))
+    assert np.allclose(adj.to_dense().numpy(), bipartite_laplacian(interaction_mat), atol=1e-6)
+
+def test_laplacian_with_dropped_edges(interaction_mat):
+    """
+    Test that masked edges give the normalized adjacency of the remaining edges.
+    """
+    augmentor = TorchGraphAugmentor(interaction_mat)
+    keep = torch.bernoulli(torch.full_like(augmentor.ratings, 0.5), generator=torch.Generator().manual_seed(0))
+    coo = interaction_mat.tocoo()
+    kept = keep.numpy() > 0
+    dropped = sp.csr_matrix((coo.data[kept], (coo.row[kept], coo.col[kept])), shape=coo.shape)
+    adj = augmentor.laplacian(keep)
+    assert adj._nnz() == 2 * int(kept.sum())
+    assert np.allclose(adj.to_dense().numpy(), bipartite_laplacian(dropped), atol=1e-6)
+
+def test_node_dropout_shape(interaction_mat):
+    """
+    Test that node dropout returns a square adjacency over all users and items.
+    """
+    augmentor = TorchGraphAugmentor(interaction_mat)
+    adj = augmentor.node_dropout(0.2)
+    assert adj.shape == (35, 35)
+    assert adj._nnz() <= 2 * interaction_mat.nnz
+
+def test_dropout_draws_only_from_the_given_rngs(interaction_mat):
+    """
+    Test that dropout with its own seeded RNGs gives the same views whatever the global RNGs draw in between.
+    """
+    augmentor = TorchGraphAugmentor(interaction_mat)
+    views = []
+    for global_seed in (1, 2):
+        random.seed(global_seed)
+        torch.manual_seed(global_seed)
+        rng, generator = random.Random(7), torch.Generator().manual_seed(7)
+        views.append((GraphAugmentor.edge_dropout(interaction_mat, 0.3, rng).toarray(),
+                      GraphAugmentor.node_dropout(interaction_mat, 0.3, rng).toarray(),
+                      augmentor.edge_dropout(0.3, generator).to_dense(), augmentor.node_dropout(0.3, generator).to_dense()))
+    for first, second in zip(*views):
+        assert np.array_equal(np.asarray(first), np.asarray(second))
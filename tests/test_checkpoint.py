@@ -0,0 +1,48 @@
+import os
+import sys
+import random
+import numpy as np
+import torch
+import pytest
+
+# Add the parent directory of PerFedRec++ to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../PerFedRec++')))
+
+from util.checkpoint import Checkpointer, rng_state, set_rng_state
+
+@pytest.fixture
+def checkpointer(tmp_path):
+    """
+    Fixture creating a checkpointer writing every 3 rounds under a missing directory.
+    """
+    checkpointer = Checkpointer(str(tmp_path / 'ckpt' / 'model.pt'), every=3)
+    yield checkpointer
+    checkpointer.close()
+
+def test_save_copies_and_replaces(checkpointer):
+    """
+    Test that save() snapshots the state at call time and that the file is replaced without leftovers.
+    """
+    assert checkpointer.load() is None
+    assert [checkpointer.due(epoch) for epoch in range(6)] == [False, False, True, False, False, True]
+    weights = torch.zeros(4)
+    checkpointer.save({'epoch': 2, 'weights': weights})
+    weights += 1
+    checkpointer.wait()
+    state = checkpointer.load()
+    assert state['epoch'] == 2 and torch.equal(state['weights'], torch.zeros(4))
+    checkpointer.save({'epoch': 5, 'weights': weights})
+    checkpointer.wait()
+    assert checkpointer.load()['epoch'] == 5
+    assert os.listdir(os.path.dirname(checkpointer.path)) == ['model.pt']
+
+def test_rng_state_round_trip():
+    """
+    Test that restoring the RNG states replays the same python, numpy and torch draws.
+    """
+    state = rng_state()
+    first = (random.random(), np.random.rand(), torch.rand(3))
+    set_rng_state(state)
+    second = (random.random(), np.random.rand(), torch.rand(3))
+    assert first[:2] == second[:2]
+    assert torch.equal(first[2], second[2])
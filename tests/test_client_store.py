@@ -0,0 +1,72 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+# Add the parent directory of PerFedRec++ to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../PerFedRec++')))
+
+from util.client_store import ClientStateStore
+
+def test_lru_evicts_to_disk(tmp_path):
+    """
+    Test that rows evicted from the in-memory tier are written back and read again from disk.
+    """
+    store = ClientStateStore(str(tmp_path), 10, 3, capacity=2)
+    store.put([1, 2, 3], np.arange(9).reshape(3, 3), round_id=4, clusters=[0, 1, 1])
+    assert list(store.cache.keys()) == [2, 3]
+    rows, last_round, cluster = store.get([1, 3, 5])
+    assert np.array_equal(rows, [[0, 1, 2], [6, 7, 8], [0, 0, 0]])
+    assert last_round.tolist() == [4, 4, -1]
+    assert cluster.tolist() == [0, 1, -1]
+    assert store.seen([1, 5]).tolist() == [True, False]
+    assert len(store.cache) == 2
+
+def test_state_persists_across_instances(tmp_path):
+    """
+    Test that a flushed store is resumed by a new store opened on the same directory with resume, and that a
+    store opened without it starts empty.
+    """
+    store = ClientStateStore(str(tmp_path), 10, 3)
+    store.put([7], np.ones((1, 3)), round_id=2, clusters=[1])
+    store.flush()
+    reopened = ClientStateStore(str(tmp_path), 10, 3, resume=True)
+    rows, last_round, _ = reopened.get([7])
+    assert np.array_equal(rows, np.ones((1, 3)))
+    assert last_round.tolist() == [2]
+    fresh = ClientStateStore(str(tmp_path), 10, 3)
+    rows, last_round, cluster = fresh.get([7])
+    assert np.array_equal(rows, np.zeros((1, 3)))
+    assert last_round.tolist() == [-1] and cluster.tolist() == [-1]
+    assert not fresh.seen([7]).any()
+
+def test_metadata_reaches_disk_with_its_row(tmp_path):
+    """
+    Test that an unflushed row leaves no trace on disk, and that an evicted row is written with its metadata.
+    """
+    store = ClientStateStore(str(tmp_path), 10, 3, capacity=1)
+    store.put([4], np.ones((1, 3)), round_id=7, clusters=[2])
+    assert store.seen([4]).tolist() == [True]
+    crashed = ClientStateStore(str(tmp_path), 10, 3, resume=True)
+    assert crashed.seen([4]).tolist() == [False]
+    store.put([5], np.ones((1, 3)), round_id=8)
+    reopened = ClientStateStore(str(tmp_path), 10, 3, resume=True)
+    rows, last_round, cluster = reopened.get([4])
+    assert np.array_equal(rows, np.ones((1, 3)))
+    assert last_round.tolist() == [7] and cluster.tolist() == [2]
+
+def test_snapshot_restores_the_checkpointed_state(tmp_path):
+    """
+    Test that restoring a snapshot drops the rows and rounds written after it.
+    """
+    path, snapshot = str(tmp_path / 'store'), str(tmp_path / 'snapshot')
+    store = ClientStateStore(path, 10, 3)
+    store.put([1], np.ones((1, 3)), round_id=3, clusters=[0])
+    store.snapshot(snapshot)
+    store.put([1, 2], np.full((2, 3), 2.), round_id=5, clusters=[1, 1])
+    store.flush()
+    ClientStateStore.restore(snapshot, path)
+    resumed = ClientStateStore(path, 10, 3, resume=True)
+    rows, last_round, cluster = resumed.get([1, 2])
+    assert np.array_equal(rows, [[1, 1, 1], [0, 0, 0]])
+    assert last_round.tolist() == [3, -1] and cluster.tolist() == [0, -1]
@@ -0,0 +1,43 @@
+
+import os
+import sys
+import torch
+import pytest
+
+# Add the parent directory of PerFedRec++ to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../PerFedRec++')))
+
+from util.cluster import MiniBatchKMeans
+
+@pytest.fixture
+def blobs():
+    """
+    Fixture building three well separated Gaussian blobs of 200 points each.
+    """
+    torch.manual_seed(0)
+    centres = torch.tensor([[0., 0.], [10., 0.], [0., 10.]])
+    return torch.cat([centre + torch.randn(200, 2) for centre in centres]), centres
+
+def test_fit_recovers_blobs(blobs):
+    """
+    Test that every blob ends up in a single cluster.
+    """
+    x, _ = blobs
+    labels = MiniBatchKMeans(3, batch_size=64, seed=0).fit(x)
+    for blob in range(3):
+        assert len(torch.unique(labels[blob * 200:(blob + 1) * 200])) == 1
+    assert len(torch.unique(labels)) == 3
+
+def test_drift_triggers_refit_only_when_clusters_move(blobs):
+    """
+    Test that drift is small on the fitted data, large once the points move, and that a warm refit resets it.
+    """
+    x, _ = blobs
+    kmeans = MiniBatchKMeans(3, batch_size=64, drift_threshold=0.1, seed=0)
+    assert kmeans.needs_refit(x)
+    kmeans.fit(x)
+    assert not kmeans.needs_refit(x)
+    moved = x + torch.tensor([5., 5.])
+    assert kmeans.needs_refit(moved)
+    kmeans.fit(moved)
+    assert not kmeans.needs_refit(moved)
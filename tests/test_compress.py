@@ -0,0 +1,111 @@
+import os
+import sys
+import torch
+import pytest
+
+# Add the parent directory of PerFedRec++ to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../PerFedRec++')))
+
+from util.compress import make_codec, UploadCompressor, pack_bits, unpack_bits
+from util.federated import RowDelta, StreamingFedAvg
+
+@pytest.fixture
+def delta():
+    """
+    Fixture creating a client update that changed 5 rows of a 20 x 8 table.
+    """
+    torch.manual_seed(0)
+    return RowDelta({'emb': torch.tensor([1, 4, 7, 12, 19])}, {'emb': torch.randn(5, 8)})
+
+@pytest.mark.parametrize('name', ['topk_rows', 'topk', 'int8', 'int4', 'sign'])
+def test_scatter_matches_decode(delta, name):
+    """
+    Test that scattering a compressed update equals adding its decoded RowDelta, and that it is smaller.
+    """
+    upload = make_codec(name, ratio=0.4).compress(delta)
+    scattered = upload.add_to({'emb': torch.zeros(20, 8)}, 0.5)
+    decoded = upload.to_delta().add_to({'emb': torch.zeros(20, 8)}, 0.5)
+    assert torch.allclose(scattered['emb'], decoded['emb'])
+    assert upload.nbytes() < delta.nbytes()
+
+def test_quantizers_are_unbiased(delta):
+    """
+    Test that stochastic 8 and 4 bit quantization decode to the update on average, within one level.
+    """
+    for name, levels in [('int8', 127), ('int4', 7)]:
+        codec = make_codec(name)
+        mean = sum(codec.compress(delta).to_delta().values['emb'] for _ in range(2000)) / 2000
+        assert torch.allclose(mean, delta.values['emb'], atol=0.05)
+        step = delta.values['emb'].abs().max(dim=1, keepdim=True).values / levels
+        assert ((codec.compress(delta).to_delta().values['emb'] - delta.values['emb']).abs() <= step + 1e-6).all()
+
+def test_pack_bits_round_trip():
+    """
+    Test that packed sign bits unpack to the original flags, also for a length not divisible by 8.
+    """
+    bits = torch.rand(13) > 0.5
+    assert torch.equal(unpack_bits(pack_bits(bits), 13), bits)
+    assert len(pack_bits(bits)) == 2
+
+def test_error_feedback_sends_the_dropped_part_later(delta):
+    """
+    Test that with error feedback the two uploads of a client add up to its two updates minus the last residual.
+    """
+    compressor = UploadCompressor(make_codec('topk_rows', ratio=0.2))
+    first = compressor.compress(0, delta)
+    assert len(first.to_delta().rows['emb']) == 1
+    second = compressor.compress(0, delta)
+    total = {'emb': torch.zeros(20, 8)}
+    first.add_to(total)
+    second.add_to(total)
+    residual = compressor.residuals[0].add_to({'emb': torch.zeros(20, 8)})
+    expected = delta.add_to({'emb': torch.zeros(20, 8)}, 2.)
+    assert torch.allclose(total['emb'] + residual['emb'], expected['emb'], atol=1e-6)
+    sent, raw = compressor.reset_counts()
+    assert sent == first.nbytes() + second.nbytes() and raw == 2 * delta.nbytes()
+
+def test_fedavg_adds_compressed_uploads_unclipped(delta):
+    """
+    Test that the streaming FedAvg scatters a client-clipped compressed upload as it is.
+    """
+    base = {'emb': torch.zeros(20, 8)}
+    compressor = UploadCompressor(make_codec('int8'), clip_value=0.1)
+    upload = compressor.compress(0, delta)
+    aggregator = StreamingFedAvg(base, clip_value=0.1)
+    aggregator.add(upload)
+    assert torch.allclose(aggregator.result()['emb'], upload.to_delta().add_to({'emb': torch.zeros(20, 8)})['emb'])
+    assert aggregator.result()['emb'].abs().max() <= 0.1 + 1e-6
+    with pytest.raises(ValueError):
+        make_codec('int2')
+
+def test_shared_drift_is_passed_through(delta):
+    """
+    Test that the shared drift of an update reaches the aggregate exactly, scaled along under L2 clipping,
+    while only the client's own rows are encoded and kept as residual.
+    """
+    shared = {'emb': 0.01 * torch.ones(20, 8)}
+    update = RowDelta(delta.rows, delta.values, shared)
+    compressor = UploadCompressor(make_codec('topk_rows', ratio=0.2))
+    upload = compressor.compress(0, update)
+    assert upload.nbytes() == make_codec('topk_rows', ratio=0.2).compress(delta).nbytes()
+    total = upload.add_to({'emb': torch.zeros(20, 8)})
+    residual = compressor.residuals[0].add_to({'emb': torch.zeros(20, 8)})
+    assert torch.allclose(total['emb'] + residual['emb'], update.apply_to({'emb': torch.zeros(20, 8)})['emb'], atol=1e-6)
+    assert compressor.residuals[0].shared is None
+    clipped = UploadCompressor(make_codec('topk_rows', ratio=1.), error_feedback=False, clip_value=0.5, clip='l2')
+    upload = clipped.compress(0, update)
+    assert upload.to_delta().norm() == pytest.approx(0.5, rel=1e-4)
+    assert torch.allclose(upload.add_to({'emb': torch.zeros(20, 8)})['emb'],
+                          upload.to_delta().add_to({'emb': torch.zeros(20, 8)})['emb'], atol=1e-6)
+
+def test_residuals_are_capped(delta):
+    """
+    Test that only the residuals of the most recently uploading clients are kept.
+    """
+    compressor = UploadCompressor(make_codec('topk_rows', ratio=0.2), max_residuals=2)
+    for user in [0, 1, 2, 1]:
+        compressor.compress(user, delta)
+    assert list(compressor.residuals.keys()) == [2, 1]
+    lossless = UploadCompressor(make_codec('topk_rows', ratio=1.))
+    lossless.compress(0, delta)
+    assert len(lossless.residuals) == 0
@@ -0,0 +1,33 @@
+import os
+import sys
+import torch
+
+# Add the parent directory of PerFedRec++ to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../PerFedRec++')))
+
+from util.early_stop import EarlyStopping, Snapshot
+
+def test_stops_after_patience_without_improvement():
+    """
+    Test that gains below min_delta count as no improvement and that training stops after `patience` of them.
+    """
+    stopper = EarlyStopping(patience=2, min_delta=0.01)
+    for epoch, ndcg in enumerate([0.10, 0.15, 0.155, 0.158]):
+        stopper.update({'NDCG': ndcg}, epoch)
+    assert stopper.best == 0.15 and stopper.best_epoch == 1
+    assert stopper.should_stop
+    stopper.reset()
+    assert not stopper.should_stop and stopper.best is None
+
+def test_snapshot_reuses_buffers():
+    """
+    Test that a snapshot is a copy, not an alias, and that later snapshots reuse the same memory.
+    """
+    table = torch.zeros(4, 2)
+    snapshot = Snapshot()
+    first = snapshot.take(table)[0]
+    table += 1
+    assert torch.equal(first, torch.zeros(4, 2))
+    second = snapshot.take(table)[0]
+    assert second.data_ptr() == first.data_ptr()
+    assert torch.equal(second, torch.ones(4, 2))
@@ -0,0 +1,64 @@
+
+import os
+import sys
+import torch
+import pytest
+
+# Add the parent directory of PerFedRec++ to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../PerFedRec++')))
+
+from data.ui_graph import Interaction
+from model.graph.FedMF import Matrix_Factorization
+from util.executor import ClientPool
+
+@pytest.fixture
+def data():
+    """
+    Fixture building a small interaction data set of 12 users and 10 items.
+    """
+    training = [[str(u), str((u + k) % 10), 1.] for u in range(12) for k in range(4)]
+    test = [[str(u), str((u + 5) % 10), 1.] for u in range(12)]
+    return Interaction(None, training, test, test)
+
+def run_round(data, n_workers, round_adam=False):
+    torch.manual_seed(0)
+    model = Matrix_Factorization(data, 4)
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.01)
+    pool = ClientPool(model, optimizer, data, 1e-4, 16, n_workers, seed=3, round_adam=round_adam)
+    try:
+        return pool.step(0, [str(u) for u in range(12)]), optimizer
+    finally:
+        pool.close()
+
+def test_client_pool_returns_one_update_per_client(data):
+    """
+    Test that every selected client comes back with its loss and a delta that covers its own user row.
+    """
+    (users, losses, updates), optimizer = run_round(data, 3)
+    assert sorted(users) == sorted(data.user[str(u)] for u in range(12))
+    assert len(losses) == len(updates) == 12
+    for user, update in zip(users, updates):
+        assert user in update.rows['embedding_dict.user_emb'].tolist()
+    assert all(float(state['step']) == 4. for state in optimizer.state.values())
+
+def test_client_pool_with_round_adam_sends_own_rows(data):
+    """
+    Test that with round_adam every delta holds only the client's own user row plus the round's shared drift,
+    and that the round advances the optimizer by one step.
+    """
+    (users, losses, updates), optimizer = run_round(data, 3, round_adam=True)
+    assert len(updates) == 12
+    for user, update in zip(users, updates):
+        assert update.rows['embedding_dict.user_emb'].tolist() == [user]
+        assert update.shared is updates[0].shared
+    assert all(float(state['step']) == 1. for state in optimizer.state.values())
+
+def test_client_pool_is_reproducible(data):
+    """
+    Test that the seeded workers give the same updates when the round is run again.
+    """
+    (users_a, losses_a, updates_a), _ = run_round(data, 2)
+    (users_b, losses_b, updates_b), _ = run_round(data, 2)
+    assert users_a == users_b and losses_a == losses_b
+    for a, b in zip(updates_a, updates_b):
+        assert all(torch.equal(a.values[key], b.values[key]) for key in a.values)
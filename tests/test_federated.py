@@ -0,0 +1,274 @@
+
+import os
+import sys
+import copy
+import torch
+import torch.nn as nn
+import pytest
+
+# Add the parent directory of PerFedRec++ to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../PerFedRec++')))
+
+from util.federated import RowDelta, SharedDrift, StreamingFedAvg, ClusterFedAvg, BatchedClients, SharedPropagation, RoundAdam
+
+@pytest.fixture
+def model():
+    """
+    Fixture building a small model with two embedding tables.
+    """
+    torch.manual_seed(0)
+    return nn.ParameterDict({'user_emb': nn.Parameter(torch.randn(20, 4)), 'item_emb': nn.Parameter(torch.randn(30, 4))})
+
+def local_step(model, rows):
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    loss = model['user_emb'][rows].sum() + model['item_emb'][rows].pow(2).sum()
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+
+def test_capture_rolls_back_and_keeps_changed_rows(model):
+    """
+    Test that capture() restores the round-start state and only stores the rows the step touched.
+    """
+    base = {key: value.clone() for key, value in model.state_dict().items()}
+    local_step(model, [1, 5])
+    after = {key: value.clone() for key, value in model.state_dict().items()}
+    update = RowDelta.capture(model, base)
+    assert update.rows['user_emb'].tolist() == [1, 5]
+    for key in base:
+        assert torch.equal(model.state_dict()[key], base[key])
+        assert torch.allclose(update.apply_to(base)[key], after[key])
+
+def test_average_matches_dense_fedavg(model):
+    """
+    Test that base + mean(delta) equals the mean of the full client states.
+    """
+    base = {key: value.clone() for key, value in model.state_dict().items()}
+    updates, states = [], []
+    for rows in ([0, 1], [1, 2], [7]):
+        local_step(model, rows)
+        states.append({key: value.clone() for key, value in model.state_dict().items()})
+        updates.append(RowDelta.capture(model, base))
+    average = RowDelta.average(base, updates)
+    for key in base:
+        assert torch.allclose(average[key], torch.stack([s[key] for s in states]).mean(0), atol=1e-6)
+
+def test_cluster_fedavg_matches_per_cluster_mean(model):
+    """
+    Test that every row of the cluster tensor is the mean of its clients' states, for row deltas and
+    full states alike, and that an empty cluster has no model.
+    """
+    base = {key: value.clone() for key, value in model.state_dict().items()}
+    clusters = [0, 2, 0, 2]
+    updates, states = [], []
+    for rows in ([0, 1], [1, 2], [7], [3, 4]):
+        local_step(model, rows)
+        states.append({key: value.clone() for key, value in model.state_dict().items()})
+        updates.append(RowDelta.capture(model, base))
+    streamed, full = ClusterFedAvg(base, 3), ClusterFedAvg(base, 3)
+    for update, state, cluster in zip(updates, states, clusters):
+        streamed.add(update, cluster)
+        full.add(state, cluster)
+    streamed.result()
+    full.result()
+    for cluster in (0, 2):
+        members = [s for s, c in zip(states, clusters) if c == cluster]
+        for key in base:
+            expected = torch.stack([s[key] for s in members]).mean(0)
+            assert torch.allclose(streamed.model(cluster)[key], expected, atol=1e-6)
+            assert torch.allclose(full.model(cluster)[key], expected, atol=1e-6)
+    assert streamed.model(1) is None
+    assert streamed.total.shape == (3, sum(value.numel() for value in base.values()))
+
+class TinyMF(nn.Module):
+    def __init__(self):
+        super(TinyMF, self).__init__()
+        torch.manual_seed(0)
+        self.embedding_dict = nn.ParameterDict({'user_emb': nn.Parameter(torch.randn(6, 4)), 'item_emb': nn.Parameter(torch.randn(8, 4))})
+
+    def propagate(self, ego_embeddings):
+        return ego_embeddings
+
+    def forward(self):
+        return self.embedding_dict['user_emb'], self.embedding_dict['item_emb']
+
+def test_batched_clients_match_separate_adam_steps():
+    """
+    Test that every client's batched update equals one Adam step taken on its own from the round-start state.
+    """
+    from util.loss_torch import bpr_loss, l2_reg_loss
+    batches = [([0, 0, 0], [1, 2, 3], [4, 5, 6]), ([3, 3], [0, 7], [2, 1]), ([5], [6], [0])]
+    model = TinyMF()
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.01)
+    for _ in range(2):
+        base = copy.deepcopy(model.state_dict())
+        start = copy.deepcopy(optimizer.state_dict())
+        expected = []
+        for user_idx, pos_idx, neg_idx in batches:
+            client = copy.deepcopy(model)
+            client_optimizer = torch.optim.Adam(client.parameters(), lr=0.01)
+            client_optimizer.load_state_dict(copy.deepcopy(start))
+            user_emb, item_emb = client()
+            user_emb, pos_item_emb, neg_item_emb = user_emb[user_idx], item_emb[pos_idx], item_emb[neg_idx]
+            loss = bpr_loss(user_emb, pos_item_emb, neg_item_emb) + l2_reg_loss(0.1, user_emb, pos_item_emb, neg_item_emb) / 4
+            client_optimizer.zero_grad()
+            loss.backward()
+            client_optimizer.step()
+            expected.append((loss.item(), client.state_dict()))
+        losses, updates = BatchedClients(model, optimizer, 0.1, 4, chunk=2).step(batches)
+        for loss, update, (expected_loss, expected_state) in zip(losses, updates, expected):
+            assert loss == pytest.approx(expected_loss, abs=1e-5)
+            for key in base:
+                assert torch.allclose(update.apply_to(base)[key], expected_state[key], atol=1e-6)
+        model.load_state_dict(RowDelta.average(base, updates))
+
+def test_round_adam_keeps_own_rows_and_matches_batched_clients():
+    """
+    Test that sequential RoundAdam updates carry only the rows each client has gradient for, equal one Adam
+    step from the round-start state, and leave the same optimizer state as BatchedClients.
+    """
+    from util.loss_torch import bpr_loss, l2_reg_loss
+    batches = [([0, 0, 0], [1, 2, 3], [4, 5, 6]), ([3, 3], [0, 7], [2, 1]), ([5], [6], [0])]
+    model, batched = TinyMF(), TinyMF()
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.01)
+    batched_optimizer = torch.optim.Adam(batched.parameters(), lr=0.01)
+    round_adam = RoundAdam(model, optimizer)
+    for _ in range(2):
+        base = copy.deepcopy(model.state_dict())
+        _, expected = BatchedClients(batched, batched_optimizer, 0.1, 4).step(batches)
+        round_adam.begin()
+        updates = []
+        for user_idx, pos_idx, neg_idx in batches:
+            user_emb, item_emb = model()
+            user_emb, pos_item_emb, neg_item_emb = user_emb[user_idx], item_emb[pos_idx], item_emb[neg_idx]
+            loss = bpr_loss(user_emb, pos_item_emb, neg_item_emb) + l2_reg_loss(0.1, user_emb, pos_item_emb, neg_item_emb) / 4
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            updates.append(round_adam.capture(base))
+        round_adam.end()
+        for (user_idx, pos_idx, neg_idx), update, expected_update in zip(batches, updates, expected):
+            assert update.rows['embedding_dict.user_emb'].tolist() == sorted(set(user_idx))
+            assert update.rows['embedding_dict.item_emb'].tolist() == sorted(set(pos_idx + neg_idx))
+            for key in base:
+                assert torch.equal(model.state_dict()[key], base[key])
+                assert torch.allclose(update.apply_to(base)[key], expected_update.apply_to(base)[key], atol=1e-6)
+        for param, batched_param in zip(model.parameters(), batched.parameters()):
+            state, batched_state = optimizer.state[param], batched_optimizer.state[batched_param]
+            assert float(state['step']) == float(batched_state['step'])
+            assert torch.allclose(state['exp_avg'], batched_state['exp_avg'], atol=1e-7)
+            assert torch.allclose(state['exp_avg_sq'], batched_state['exp_avg_sq'], atol=1e-9)
+        average = RowDelta.average(base, updates)
+        model.load_state_dict(average)
+        batched.load_state_dict(average)
+
+class TinyGCN(TinyMF):
+    def __init__(self, layers):
+        super(TinyGCN, self).__init__()
+        self.layers = layers
+        torch.manual_seed(1)
+        adj = (torch.rand(14, 14) < 0.2).float()
+        adj = torch.triu(adj, diagonal=1)
+        self.sparse_norm_adj = ((adj + adj.t()) / 3).to_sparse()
+
+    def propagate(self, ego_embeddings):
+        all_embeddings = []
+        for k in range(self.layers):
+            ego_embeddings = torch.sparse.mm(self.sparse_norm_adj, ego_embeddings)
+            all_embeddings.append(ego_embeddings)
+        return torch.mean(torch.stack(all_embeddings, dim=1), dim=1)
+
+    def forward(self):
+        return torch.split(self.propagate(torch.cat([self.embedding_dict['user_emb'], self.embedding_dict['item_emb']], 0)), [6, 8])
+
+@pytest.mark.parametrize('layers', [1, 2, 3])
+def test_shared_propagation_gradients_match_autograd(layers):
+    """
+    Test that the per-client backward from the shared round-start forward gives the full autograd gradients.
+    """
+    model = TinyGCN(layers)
+    shared = SharedPropagation(model)
+    shared.refresh()
+    for user_idx, pos_idx, neg_idx in [([0, 0], [1, 2], [4, 5]), ([3], [7], [2])]:
+        def client_loss(user_emb, item_emb):
+            return (user_emb[user_idx] * (item_emb[pos_idx] - item_emb[neg_idx])).sum()
+        model.zero_grad()
+        client_loss(*model()).backward()
+        expected = [param.grad.clone() for param in model.parameters()]
+        model.zero_grad()
+        shared.backward(client_loss(*shared.forward()))
+        for param, grad in zip(model.parameters(), expected):
+            assert torch.allclose(param.grad, grad, atol=1e-6)
+
+def test_shared_propagation_follows_a_new_adjacency():
+    """
+    Test that a refresh after the adjacency is replaced backpropagates over the new, here asymmetric, one.
+    """
+    model = TinyGCN(2)
+    shared = SharedPropagation(model)
+    shared.refresh()
+    torch.manual_seed(2)
+    model.sparse_norm_adj = (torch.rand(14, 14) * (torch.rand(14, 14) < 0.3)).to_sparse()
+    shared.refresh()
+    model.zero_grad()
+    model()[0][[1, 4]].sum().backward()
+    expected = [param.grad.clone() for param in model.parameters()]
+    model.zero_grad()
+    shared.backward(shared.forward()[0][[1, 4]].sum())
+    for param, grad in zip(model.parameters(), expected):
+        assert torch.allclose(param.grad, grad, atol=1e-6)
+
+def test_streaming_fedavg_weighted_and_clipped():
+    """
+    Test that the running aggregator gives the weighted mean of the clipped client changes, for deltas and full states alike.
+    """
+    base = {'w': torch.zeros(3, 2)}
+    states = [{'w': torch.full((3, 2), 1.)}, {'w': torch.full((3, 2), -0.2)}]
+    aggregator = StreamingFedAvg(base, clip_value=0.5)
+    aggregator.add(states[0], weight=3.)
+    aggregator.add(RowDelta({'w': torch.arange(3)}, {'w': states[1]['w']}), weight=1.)
+    assert torch.allclose(aggregator.result()['w'], torch.full((3, 2), (3 * 0.5 - 0.2) / 4))
+    assert torch.equal(StreamingFedAvg(base).result()['w'], base['w'])
+
+@pytest.mark.parametrize('clip', [None, 'coordinate', 'l2'])
+def test_shared_drift_is_folded_once(clip):
+    """
+    Test that updates sharing a drift aggregate, globally and per cluster, to the same result as their dense
+    client states, with the drift clamped once and kept out of the running sum until it is folded in.
+    """
+    torch.manual_seed(0)
+    base = {'a': torch.randn(6, 2), 'b': torch.randn(4)}
+    drift = SharedDrift({'a': 0.4 * torch.randn(6, 2), 'b': 0.4 * torch.randn(4)})
+    updates = [RowDelta({'a': torch.tensor(rows), 'b': torch.tensor(rows[:1])},
+                        {'a': torch.randn(len(rows), 2), 'b': torch.randn(1)}, drift) for rows in ([0, 2], [2, 5], [1])]
+    clip_value = None if clip is None else 0.5
+    assert updates[0].clamp(0.5).shared is updates[1].clamp(0.5).shared
+    streamed, dense = StreamingFedAvg(base, clip_value, clip or 'coordinate'), StreamingFedAvg(base, clip_value, clip or 'coordinate')
+    clusters, dense_clusters = ClusterFedAvg(base, 2), ClusterFedAvg(base, 2)
+    for k, (update, weight) in enumerate(zip(updates, [1., 2., 0.5])):
+        streamed.add(update, weight)
+        dense.add(update.apply_to(base), weight)
+        clusters.add(update, k % 2, weight)
+        dense_clusters.add(update.apply_to(base), k % 2, weight)
+    assert len(streamed.shared) == 1
+    for key, value in dense.result().items():
+        assert torch.allclose(streamed.result()[key], value, atol=1e-6)
+    assert torch.allclose(clusters.result(), dense_clusters.result(), atol=1e-6)
+
+def test_streaming_fedavg_l2_clipping():
+    """
+    Test that clip='l2' scales every client change down to the clipping norm.
+    """
+    base = {'a': torch.zeros(4, 2), 'b': torch.zeros(3)}
+    update = RowDelta({'a': torch.tensor([1, 3]), 'b': torch.tensor([0])},
+                      {'a': torch.full((2, 2), 2.), 'b': torch.tensor([2.])},
+                      shared={'a': torch.full((4, 2), 0.5), 'b': torch.zeros(3)})
+    dense = update.apply_to(base)
+    norm = float(torch.sqrt(sum(value.pow(2).sum() for value in dense.values())))
+    assert update.norm() == pytest.approx(norm, rel=1e-6)
+    for client in (update, dense):
+        aggregator = StreamingFedAvg(base, clip_value=1., clip='l2')
+        aggregator.add(client)
+        result = aggregator.result()
+        for key in base:
+            assert torch.allclose(result[key], dense[key] / norm, atol=1e-6)
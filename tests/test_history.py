@@ -0,0 +1,69 @@
+
+import os
+import sys
+import pytest
+import torch
+
+# Add the parent directory of PerFedRec++ to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../PerFedRec++')))
+
+from util.history import HistoricalEmbedding, batch_nodes, propagate_batch
+
+def full_propagation(ego_embeddings, adj, n_layers):
+    outputs = [ego_embeddings]
+    for k in range(n_layers):
+        outputs.append(torch.sparse.mm(adj, outputs[-1]))
+    return outputs
+
+@pytest.fixture
+def random_graph():
+    """
+    Fixture building a random symmetric sparse adjacency matrix and node embeddings.
+    """
+    torch.manual_seed(0)
+    dense = (torch.rand(30, 30) < 0.1).float()
+    dense = ((dense + dense.t()) > 0).float()
+    return dense.to_sparse(), torch.randn(30, 4)
+
+def test_batch_nodes_positions():
+    """
+    Test that batch_nodes returns positions pointing back to the original users and items.
+    """
+    nodes, positions = batch_nodes(10, None, [3, 1, 3], [0, 2], [2])
+    assert nodes.tolist() == [1, 3, 10, 12]
+    assert nodes[positions[0]].tolist() == [3, 1, 3]
+    assert (nodes[positions[1]] - 10).tolist() == [0, 2]
+    assert (nodes[positions[2]] - 10).tolist() == [2]
+
+@pytest.mark.parametrize('n_layers', [1, 2, 3])
+def test_propagate_batch_matches_full_propagation(random_graph, n_layers):
+    """
+    Test that a freshly rebuilt history gives the same layer outputs as a full propagation.
+    """
+    adj, ego_embeddings = random_graph
+    history = HistoricalEmbedding()
+    history.rebuild(ego_embeddings, adj, n_layers)
+    nodes = torch.tensor([2, 7, 19])
+    outputs = propagate_batch(ego_embeddings, adj, nodes, n_layers, history)
+    expected = full_propagation(ego_embeddings, adj, n_layers)
+    for out, exp in zip(outputs, expected):
+        assert torch.allclose(out, exp[nodes], atol=1e-6)
+
+def test_history_refresh_schedule():
+    """
+    Test that the store goes stale after `refresh` steps or when expired.
+    """
+    history = HistoricalEmbedding(refresh=2)
+    assert history.stale()
+    history.rebuild(torch.zeros(3, 2), torch.eye(3).to_sparse(), 2)
+    history.step()
+    assert not history.stale()
+    history.step()
+    assert history.stale()
+    manual = HistoricalEmbedding()
+    manual.rebuild(torch.zeros(3, 2), torch.eye(3).to_sparse(), 2)
+    for _ in range(10):
+        manual.step()
+    assert not manual.stale()
+    manual.expire()
+    assert manual.stale()
@@ -0,0 +1,47 @@
+import os
+import sys
+import torch
+import pytest
+
+# Add the parent directory of PerFedRec++ to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../PerFedRec++')))
+
+from util.federated import RowDelta
+from util.local_store import LocalModelStore
+
+@pytest.fixture
+def base():
+    """
+    Fixture building a round-start state with a user and an item table.
+    """
+    torch.manual_seed(0)
+    return {'embedding_dict.user_emb': torch.randn(10, 4), 'embedding_dict.item_emb': torch.randn(15, 4)}
+
+def dense_score(state, user):
+    return torch.matmul(state['embedding_dict.user_emb'][user], state['embedding_dict.item_emb'].t())
+
+@pytest.mark.parametrize('with_shared', [False, True])
+def test_scores_match_dense_local_model(base, with_shared):
+    """
+    Test that the reconstructed scores equal those of the dense base + scale * delta state.
+    """
+    rows = {'embedding_dict.user_emb': torch.tensor([3]), 'embedding_dict.item_emb': torch.tensor([0, 7, 11])}
+    values = {'embedding_dict.user_emb': torch.randn(1, 4), 'embedding_dict.item_emb': torch.randn(3, 4)}
+    shared = {key: 0.01 * torch.randn_like(value) for key, value in base.items()} if with_shared else None
+    update = RowDelta(rows, values, shared)
+    store = LocalModelStore(base)
+    store.add(3, update, 0.5)
+    assert 3 in store and 4 not in store
+    assert torch.allclose(store.score(3), dense_score(update.apply_to(base, 0.5), 3), atol=1e-6)
+
+def test_store_only_keeps_touched_rows(base):
+    """
+    Test that the store grows with the touched rows, not with the size of the tables.
+    """
+    store = LocalModelStore(base)
+    for user in range(10):
+        rows = {'embedding_dict.user_emb': torch.tensor([user]), 'embedding_dict.item_emb': torch.tensor([user])}
+        values = {'embedding_dict.user_emb': torch.ones(1, 4), 'embedding_dict.item_emb': torch.ones(1, 4)}
+        store.add(user, RowDelta(rows, values))
+    assert len(store) == 10
+    assert store.nbytes() < 10 * sum(value.numel() * value.element_size() for value in base.values())
@@ -0,0 +1,27 @@
+import os
+import sys
+import torch
+import torch.nn.functional as F
+import pytest
+
+# Add the parent directory of PerFedRec++ to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../PerFedRec++')))
+
+from util.loss_torch import chunked_InfoNCE
+
+@pytest.mark.parametrize('chunk', [7, 32, 100])
+def test_chunked_infonce_matches_full_softmax(chunk):
+    """
+    Test that the chunked loss and its gradients equal the InfoNCE computed on the full similarity matrix.
+    """
+    torch.manual_seed(0)
+    view1 = torch.randn(50, 8, requires_grad=True)
+    view2 = torch.randn(50, 8, requires_grad=True)
+    loss = chunked_InfoNCE(view1, view2, 0.2, chunk)
+    grads = torch.autograd.grad(loss, [view1, view2])
+    v1, v2 = F.normalize(view1, dim=1), F.normalize(view2, dim=1)
+    reference = F.cross_entropy(torch.matmul(v1, v2.t()) / 0.2, torch.arange(50))
+    reference_grads = torch.autograd.grad(reference, [view1, view2])
+    assert torch.allclose(loss, reference, atol=1e-5)
+    for grad, reference_grad in zip(grads, reference_grads):
+        assert torch.allclose(grad, reference_grad, atol=1e-5)
@@ -0,0 +1,44 @@
+
+import os
+import sys
+import torch
+import pytest
+
+# Add the parent directory of PerFedRec++ to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../PerFedRec++')))
+
+from util.noise import LDPNoise
+
+@pytest.mark.parametrize('max_elements', [2 ** 20, 1000, 10])
+def test_laplace_mean_variance(max_elements):
+    """
+    Test that the averaged Laplace noise has variance 2 * scale^2 / n_clients whatever the chunk size.
+    """
+    noise = LDPNoise(0., 0.5, 16, device='cpu', seed=0, max_elements=max_elements).mean((200, 20))
+    assert noise.shape == (200, 20)
+    assert noise.mean().item() == pytest.approx(0., abs=0.02)
+    assert noise.var().item() == pytest.approx(2 * 0.5 ** 2 / 16, rel=0.1)
+
+def test_gaussian_mean_variance():
+    """
+    Test that the averaged Gaussian noise has variance scale^2 / n_clients.
+    """
+    noise = LDPNoise(1., 0.5, 16, mechanism='gaussian', seed=0).mean((200, 20))
+    assert noise.mean().item() == pytest.approx(1., abs=0.02)
+    assert noise.var().item() == pytest.approx(0.5 ** 2 / 16, rel=0.1)
+
+def test_seeded_noise_is_reproducible():
+    """
+    Test that two engines with the same seed draw the same noise, and that unknown mechanisms are rejected.
+    """
+    assert torch.equal(LDPNoise(0., 0.1, 4, seed=3).mean((5, 3)), LDPNoise(0., 0.1, 4, seed=3).mean((5, 3)))
+    with pytest.raises(ValueError):
+        LDPNoise(0., 0.1, 4, mechanism='uniform')
+
+def test_laplace_is_finite_at_the_interval_end(monkeypatch):
+    """
+    Test that a uniform draw of exactly 0 (the closed end of torch.rand) still gives finite noise.
+    """
+    monkeypatch.setattr(torch, 'rand', lambda *size, **kwargs: torch.zeros(*size))
+    noise = LDPNoise(0., 0.1, 4, seed=0).mean((5, 3))
+    assert torch.isfinite(noise).all()
@@ -0,0 +1,51 @@
+import os
+import sys
+import torch
+import pytest
+
+# Add the parent directory of PerFedRec++ to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../PerFedRec++')))
+
+from util.optim import lookup, LazyAdam, LazyAdagrad
+
+def run(optimizer_class, sparse, steps=5, rows=(0, 3, 3, 7), **kwargs):
+    torch.manual_seed(0)
+    table = torch.nn.Parameter(torch.randn(10, 4))
+    target = torch.randn(len(rows), 4)
+    optimizer = optimizer_class([table], **kwargs)
+    for _ in range(steps):
+        optimizer.zero_grad()
+        (lookup(table, list(rows), sparse) - target).pow(2).sum().backward()
+        optimizer.step()
+    return table.detach()
+
+@pytest.mark.parametrize('lazy, dense, kwargs', [(LazyAdam, torch.optim.Adam, {'lr': 0.1}),
+                                                  (LazyAdagrad, torch.optim.Adagrad, {'lr': 0.1})])
+@pytest.mark.parametrize('sparse', [False, True])
+def test_matches_dense_optimizer_on_touched_rows(lazy, dense, kwargs, sparse):
+    """
+    Test that rows touched at every step follow the dense optimizer exactly, and that other rows never move.
+    """
+    ours = run(lazy, sparse, **kwargs)
+    reference = run(dense, False, **kwargs)
+    torch.manual_seed(0)
+    initial = torch.randn(10, 4)
+    touched = [0, 3, 7]
+    untouched = [1, 2, 4, 5, 6, 8, 9]
+    assert torch.allclose(ours[touched], reference[touched], atol=1e-5)
+    assert torch.equal(ours[untouched], initial[untouched])
+
+def test_lazy_adam_defers_bias_correction():
+    """
+    Test that a row updated for the first time late gets the same first step as a fresh Adam.
+    """
+    torch.manual_seed(0)
+    table = torch.nn.Parameter(torch.zeros(3, 2))
+    optimizer = LazyAdam([table], lr=0.1)
+    for rows in ([0], [0], [0], [2]):
+        optimizer.zero_grad()
+        lookup(table, rows).sum().backward()
+        optimizer.step()
+    # the first Adam step moves every coordinate by lr whatever the gradient scale
+    assert torch.allclose(table[2].detach(), torch.full((2,), -0.1), atol=1e-6)
+    assert torch.equal(table[1].detach(), torch.zeros(2))
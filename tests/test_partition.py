@@ -0,0 +1,51 @@
+
+import os
+import sys
+import numpy as np
+import scipy.sparse as sp
+import pytest
+
+# Add the parent directory of PerFedRec++ to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../PerFedRec++')))
+
+from data.partition import GraphPartitioner
+
+@pytest.fixture
+def two_community_graph():
+    """
+    Fixture building a symmetric graph made of two dense communities joined by a few edges.
+    """
+    rng = np.random.default_rng(0)
+    rows, cols = [], []
+    for _ in range(3000):
+        community = rng.integers(2)
+        a, b = rng.integers(100, size=2) + 100 * community
+        rows += [a, b]
+        cols += [b, a]
+    for _ in range(20):
+        a, b = rng.integers(100), rng.integers(100) + 100
+        rows += [a, b]
+        cols += [b, a]
+    return sp.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(200, 200))
+
+def test_label_propagation_is_balanced(two_community_graph):
+    """
+    Test that every part stays under its capacity.
+    """
+    parts = GraphPartitioner.label_propagation(two_community_graph, 4, imbalance=0.05, seed=1)
+    assert parts.shape == (200,)
+    assert np.bincount(parts, minlength=4).max() <= int(np.ceil(200 / 4 * 1.05))
+
+def test_label_propagation_reduces_edge_cut(two_community_graph):
+    """
+    Test that the partition cuts far fewer edges than a random assignment.
+    """
+    parts = GraphPartitioner.label_propagation(two_community_graph, 2, seed=1)
+    random_parts = np.random.default_rng(1).permutation(200) % 2
+    assert GraphPartitioner.edge_cut(two_community_graph, parts) < 0.5 * GraphPartitioner.edge_cut(two_community_graph, random_parts)
+
+def test_edge_cut_of_single_part(two_community_graph):
+    """
+    Test that a single part cuts no edge.
+    """
+    assert GraphPartitioner.edge_cut(two_community_graph, np.zeros(200, dtype=int)) == 0.
@@ -0,0 +1,53 @@
+import os
+import sys
+import torch
+import torch.nn as nn
+import pytest
+
+# Add the parent directory of PerFedRec++ to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../PerFedRec++')))
+
+from model.graph.PerFedRec import PerFedRec_LGCN_Encoder
+
+@pytest.fixture
+def encoder():
+    """
+    Fixture building a two-layer PerFedRec encoder over a random normalized graph.
+    """
+    torch.manual_seed(0)
+    dense = (torch.rand(50, 50) < 0.1).float()
+    dense = ((dense + dense.t()) > 0).float()
+    dense = dense / dense.sum(1, keepdim=True).clamp(min=1)
+    model = PerFedRec_LGCN_Encoder.__new__(PerFedRec_LGCN_Encoder)
+    nn.Module.__init__(model)
+    model.layers = 2
+    model.sparse_norm_adj = dense.to_sparse()
+    model.embedding_dict = nn.ParameterDict({'user_emb': nn.Parameter(torch.randn(20, 8)), 'item_emb': nn.Parameter(torch.randn(30, 8))})
+    return model
+
+def test_bf16_propagation_close_to_fp32(encoder):
+    """
+    Test that bf16 propagation returns fp32 outputs and fp32 gradients close to the fp32 ones.
+    """
+    ego = torch.cat([encoder.embedding_dict['user_emb'], encoder.embedding_dict['item_emb']], 0)
+    reference = encoder.propagate(ego)
+    reference.sum().backward()
+    reference_grad = encoder.embedding_dict['item_emb'].grad.clone()
+    encoder.zero_grad()
+    encoder.set_precision('bf16')
+    ego = torch.cat([encoder.embedding_dict['user_emb'], encoder.embedding_dict['item_emb']], 0)
+    output = encoder.propagate(ego)
+    output.sum().backward()
+    assert output.dtype == torch.float32
+    assert encoder.embedding_dict['item_emb'].dtype == torch.float32
+    assert encoder.embedding_dict['item_emb'].grad.dtype == torch.float32
+    assert torch.allclose(output, reference, atol=5e-2)
+    assert torch.allclose(encoder.embedding_dict['item_emb'].grad, reference_grad, atol=5e-2)
+    assert encoder.low_adj(encoder.sparse_norm_adj).dtype == torch.bfloat16
+
+def test_unknown_precision(encoder):
+    """
+    Test that an unsupported precision is rejected.
+    """
+    with pytest.raises(ValueError):
+        encoder.set_precision('fp8')
@@ -0,0 +1,46 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+# Add the parent directory of PerFedRec++ to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../PerFedRec++')))
+
+from util.prefetch import Prefetcher
+
+@pytest.fixture
+def prefetcher():
+    """
+    Fixture creating a prefetcher around a producer that records its calls.
+    """
+    calls = []
+
+    def producer(mask, scale=1):
+        calls.append(mask.copy())
+        return int(mask.sum()) * scale
+
+    prefetcher = Prefetcher(producer)
+    prefetcher.calls = calls
+    yield prefetcher
+    prefetcher.close()
+
+def test_get_returns_the_prefetched_result(prefetcher):
+    """
+    Test that get() with the submitted arguments returns the prefetched result without calling the producer again.
+    """
+    mask = np.array([True, False, True])
+    prefetcher.submit(mask)
+    assert prefetcher.get(mask.copy()) == 2
+    assert len(prefetcher.calls) == 1
+    assert prefetcher.get(mask) == 2
+    assert len(prefetcher.calls) == 2
+
+def test_get_recomputes_for_other_arguments(prefetcher):
+    """
+    Test that a result prefetched for other arguments is discarded and the producer is called directly.
+    """
+    prefetcher.submit(np.array([True, True, True]))
+    assert prefetcher.get(np.array([True, False, False])) == 1
+    prefetcher.submit(np.array([True, True, True]), scale=2)
+    assert prefetcher.get(np.array([True, True, True])) == 3
+    assert prefetcher.get(np.array([True, True, True]), scale=2) == 6
@@ -0,0 +1,39 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+# Add the parent directory of PerFedRec++ to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../PerFedRec++')))
+
+from util.pretrain_cache import PretrainCache
+
+@pytest.fixture
+def data_file(tmp_path):
+    """
+    Fixture writing a tiny training set.
+    """
+    path = tmp_path / 'train.txt'
+    path.write_text('u1 i1 1\nu2 i2 1\n')
+    return str(path)
+
+def test_round_trip_and_keys(tmp_path, data_file):
+    """
+    Test that a stored entry is found again memory-mapped, and that other settings or data miss.
+    """
+    root = str(tmp_path / 'cache')
+    cache = PretrainCache(root, data_file, {'pretrain_epoch': 2})
+    assert cache.load() is None
+    user, item = np.random.rand(3, 4).astype(np.float32), np.random.rand(5, 4).astype(np.float32)
+    cache.store(user, item)
+    loaded_user, loaded_item = PretrainCache(root, data_file, {'pretrain_epoch': 2}).load()
+    assert isinstance(loaded_user, np.memmap)
+    assert np.array_equal(loaded_user, user) and np.array_equal(loaded_item, item)
+    assert PretrainCache(root, data_file, {'pretrain_epoch': 3}).load() is None
+    with open(data_file, 'a') as f:
+        f.write('u3 i1 1\n')
+    assert PretrainCache(root, data_file, {'pretrain_epoch': 2}).load() is None
+    # storing the same entry twice keeps the first one
+    cache.store(user * 0, item * 0)
+    assert np.array_equal(cache.load()[0], user)
+    assert [name for name in os.listdir(root) if name.startswith('.tmp-')] == []
@@ -0,0 +1,47 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+# Add the parent directory of PerFedRec++ to the Python path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../PerFedRec++')))
+
+from util.selection import ClientScheduler
+
+def test_uniform_excludes_last_round():
+    """
+    Test that consecutive rounds select distinct users, and that the mask matches the selection.
+    """
+    scheduler = ClientScheduler(100, 30, seed=0)
+    first, mask = scheduler.select()
+    assert len(np.unique(first)) == 30
+    assert mask.sum() == 30 and mask[first].all()
+    second, _ = scheduler.select()
+    assert len(np.intersect1d(first, second)) == 0
+
+def test_cluster_quotas():
+    """
+    Test that every cluster contributes at least its proportional share of the round.
+    """
+    clusters = np.repeat([0, 1, 2], [50, 30, 20])
+    scheduler = ClientScheduler(100, 20, seed=0)
+    selected, _ = scheduler.select(clusters, strategy='cluster')
+    assert len(np.unique(selected)) == 20
+    counts = np.bincount(clusters[selected], minlength=3)
+    assert (counts >= [10, 6, 4]).all()
+
+def test_interaction_prefers_active_users():
+    """
+    Test that interaction-weighted selection picks heavy users far more often than light ones.
+    """
+    interactions = np.array([100.] * 10 + [1.] * 90)
+    scheduler = ClientScheduler(100, 10, 'interaction', exclude_last=False, interactions=interactions, seed=0)
+    hits = sum(np.isin(scheduler.select()[0], np.arange(10)).sum() for _ in range(50))
+    assert hits > 0.7 * 500
+
+def test_unknown_strategy():
+    """
+    Test that an unknown strategy is rejected.
+    """
+    with pytest.raises(ValueError):
+        ClientScheduler(10, 2, 'random')